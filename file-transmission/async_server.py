@@ -0,0 +1,624 @@
+#!/usr/bin/env python3
+''' Receives many uploads at once with asyncio, each saved as N.raw.
+    At most --max-concurrency connections are served, further ones
+    are not accepted and wait in listen backlog. Besides plain
+    uploads accepts range uploads (see protocol.py), which are
+    assembled in N.raw.part and renamed to next free N.raw when
+    complete, and resumable uploads, kept as <transfer id>.part with
+    journal of verified chunks till complete. Batches of files are
+    written by pool of writer threads into N.batch.part directory,
+    renamed to N.batch when complete. Deduplicated uploads are rebuilt
+    into N.raw from chunk store, which keeps every chunk received.
+'''
+
+import argparse
+import asyncio
+import concurrent.futures
+import hashlib
+import os
+import zlib
+
+import compression
+import dedup
+import protocol
+import server
+
+MAX_CONCURRENCY = 64
+# Two per connection, plus PENDING_WRITES blocks of batches shared by
+# all connections, so receive buffers take (2 * MAX_CONCURRENCY +
+# PENDING_WRITES) * BUFFER_SIZE at most. Chunks of resumable and
+# deduplicated uploads are up to protocol.MAX_CHUNK_SIZE each instead.
+BUFFER_SIZE = 2**20
+LISTEN_BACKLOG = 512
+# Seconds unfinished range transfer waits for new connections
+TRANSFER_TIMEOUT = 60
+# Threads writing received data, shared by all connections
+WRITERS = 4
+# Blocks of batches all connections together may have waiting for writers
+PENDING_WRITES = 64
+# Directory of chunks of deduplicated uploads
+CHUNK_STORE = 'chunks'
+
+
+async def recv_exactly(loop, conn, size, timeout=None):
+    ''' Same as protocol.recv_exactly, but yields while waiting '''
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    filled = 0
+    while filled < size:
+        n = await asyncio.wait_for(loop.sock_recv_into(conn, view[filled:]), timeout)
+        if n == 0:
+            if filled == 0:
+                return None
+            raise ConnectionError('Connection closed after {} of {} bytes'.format(filled, size))
+        filled += n
+    return bytes(buffer)
+
+
+async def recv_upto(loop, conn, size, timeout=None):
+    ''' Receives *size* bytes, or fewer if connection is closed
+        before them
+    '''
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    filled = 0
+    while filled < size:
+        n = await asyncio.wait_for(loop.sock_recv_into(conn, view[filled:]), timeout)
+        if n == 0:
+            break
+        filled += n
+    return bytes(buffer[:filled])
+
+
+async def receive_file(loop, conn, f, buffers, timeout=None, executor=None):
+    ''' Same as server.receive_buffered, but yields to other
+        connections while waiting for data. Full buffer is written
+        in *executor* while next one of two *buffers* is received,
+        so slow disk stalls neither this connection nor others.
+        Connection silent for *timeout* seconds is dropped.
+    '''
+    views = [memoryview(buffer) for buffer in buffers]
+    view = views[0]
+    write = None
+    filled = 0
+    received = 0
+    try:
+        while True:
+            n = await asyncio.wait_for(loop.sock_recv_into(conn, view[filled:]), timeout)
+            if n == 0:
+                break
+            filled += n
+            received += n
+            if filled == len(view):
+                if write is not None:
+                    await write
+                write = loop.run_in_executor(executor, server.write_all, f, view)
+                view = views[1] if view is views[0] else views[0]
+                filled = 0
+
+        if write is not None:
+            await write
+        await loop.run_in_executor(executor, server.write_all, f, view[:filled])
+    finally:
+        if write is not None:
+            # Buffer and file must outlive write in progress
+            await asyncio.gather(write, return_exceptions=True)
+
+    return received
+
+
+def batch_path(root, name):
+    ''' Path of file *name* of batch under *root*. Names which
+        could escape *root* are refused.
+    '''
+    parts = name.split('/')
+    if any(part in ('', '.', '..') for part in parts):
+        raise ValueError('Bad path {!r}'.format(name))
+    return os.path.join(root, *parts)
+
+
+def write_block(path, data, offset, mode=None):
+    ''' Writes *data* at *offset* of file *path*, creating it
+        and its directories. Runs in writer threads, so blocks
+        of one file may be written in any order. So *mode* is
+        given only with sole block of file, larger files get theirs
+        from set_modes after all blocks are written.
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        server.pwrite_all(fd, memoryview(data), offset)
+        if mode is not None:
+            os.fchmod(fd, mode)
+    finally:
+        os.close(fd)
+
+
+def publish(path):
+    ''' Gives complete file *path* next free N.raw name. Name is
+        reserved exclusively first, so file of earlier run is never
+        overwritten. Returns the name.
+    '''
+    name, f = server.open_output_file()
+    f.close()
+    os.replace(path, name)
+    return name
+
+
+def set_modes(modes):
+    ''' Sets modes of files written in several blocks '''
+    for path, mode in modes:
+        os.chmod(path, mode)
+
+
+class RangeTransfer(object):
+    ''' File assembled from ranges, which may come over
+        several connections. Writes must wait for *preparing*,
+        future of preallocation, which runs in writer thread.
+    '''
+
+    def __init__(self, transfer_id, size, loop, executor):
+        self.transfer_id = transfer_id
+        self.size = size
+        self.name, self.file = server.open_output_file(suffix='.raw.part')
+        self.preparing = loop.run_in_executor(executor, server.preallocate, self.file.fileno(), size)
+        # Dictionary offset -> length of received ranges
+        self.ranges = {}
+        self.received = 0
+        self.connections = 0
+
+    def complete(self, offset, length):
+        if offset not in self.ranges:
+            self.ranges[offset] = length
+            self.received += length
+
+    def done(self):
+        return self.received >= self.size
+
+    def finish(self):
+        ''' Closes file and gives it next N.raw name '''
+        self.file.close()
+        return publish(self.name)
+
+    def abandon(self):
+        ''' Closes file, keeping partial data '''
+        self.file.close()
+
+
+class ResumableTransfer(object):
+    ''' Partial file of resumable upload. Survives connections and
+        server restarts: data is in <id>.part and journal <id>.journal
+        lists chunks (offset, length, crc32) written to it.
+    '''
+
+    def __init__(self, transfer_id, size, directory='.'):
+        self.size = size
+        base = os.path.join(directory, transfer_id.hex())
+        self.part_name = base + '.part'
+        self.journal_name = base + '.journal'
+
+        self.fd = os.open(self.part_name, os.O_RDWR | os.O_CREAT, 0o644)
+        self.journal = open(self.journal_name, 'ab+', buffering=0)
+        # New transfer has nothing to resume, it is preallocated by verify
+        self.new = os.fstat(self.fd).st_size != size
+        if self.new:
+            self.journal.truncate(0)
+        self.offset = 0
+
+    def verify(self):
+        ''' Rereads journaled chunks and checks them against file,
+            as data may have not reached disk before crash. Journal
+            is cut at first bad chunk. Returns offset to resume from.
+            Blocking, reads whole received part.
+        '''
+        if self.new:
+            server.preallocate(self.fd, self.size)
+            self.new = False
+        self.journal.seek(0)
+        journal = self.journal.read()
+
+        offset = 0
+        valid = 0
+        for position in range(0, len(journal) - protocol.CHUNK.size + 1, protocol.CHUNK.size):
+            chunk_offset, length, crc = protocol.CHUNK.unpack_from(journal, position)
+            if chunk_offset != offset or offset + length > self.size:
+                break
+            if zlib.crc32(os.pread(self.fd, length, offset)) != crc:
+                break
+            offset += length
+            valid = position + protocol.CHUNK.size
+
+        self.journal.truncate(valid)
+        self.journal.seek(valid)
+        self.offset = offset
+
+        return offset
+
+    def write(self, view, crc):
+        ''' Writes verified chunk at current offset '''
+        server.pwrite_all(self.fd, view, self.offset)
+        self.journal.write(protocol.CHUNK.pack(self.offset, len(view), crc))
+        self.offset += len(view)
+
+    def finish(self):
+        ''' Gives complete file next N.raw name '''
+        self.close()
+        name = publish(self.part_name)
+        os.remove(self.journal_name)
+        return name
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.journal.close()
+            self.fd = None
+
+
+class Server(object):
+    ''' Accepts connections while there are free slots '''
+
+    def __init__(self, listener, max_concurrency=MAX_CONCURRENCY,
+            buffer_size=BUFFER_SIZE, timeout=None, verbose=True, writers=WRITERS,
+            chunk_store=CHUNK_STORE):
+        self.listener = listener
+        self.listener.setblocking(False)
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+        self.verbose = verbose
+        # Buffers of finished connections, reused by new ones
+        self.free_buffers = []
+        self.tasks = set()
+        # Dictionary transfer id -> RangeTransfer in progress
+        self.transfers = {}
+        # Dictionary transfer id -> task receiving resumable transfer
+        self.resuming = {}
+        self.writers = concurrent.futures.ThreadPoolExecutor(writers, 'writer')
+        # Blocks of batches waiting for writers, of all connections
+        self.pending_writes = asyncio.Semaphore(PENDING_WRITES)
+        self.chunks = dedup.ChunkStore(chunk_store)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Backpressure: no accept, until some connection finishes
+            await self.slots.acquire()
+            try:
+                conn, addr = await loop.sock_accept(self.listener)
+            except BaseException:
+                self.slots.release()
+                raise
+
+            task = loop.create_task(self.handle(loop, conn, addr))
+            self.tasks.add(task)
+            task.add_done_callback(self.finished)
+
+    def finished(self, task):
+        self.tasks.discard(task)
+        self.slots.release()
+
+    async def handle(self, loop, conn, addr):
+        if self.verbose:
+            print('Connected by', addr)
+
+        # One is received into, while other is written
+        buffers = [self.free_buffers.pop() if self.free_buffers else bytearray(self.buffer_size)
+                for k in range(2)]
+        buffer = buffers[0]
+        try:
+            with conn:
+                head = await recv_upto(loop, conn, protocol.MAGIC_SIZE, self.timeout)
+                if head == protocol.RANGE_MAGIC:
+                    await self.receive_ranges(loop, conn, buffers)
+                    return
+                if head == protocol.OLD_RESUME_MAGIC:
+                    await loop.sock_sendall(conn, protocol.STATUS_FAILED)
+                    return
+                if head == protocol.RESUME_MAGIC:
+                    await self.receive_resumable(loop, conn, buffer)
+                    return
+                if head == protocol.BATCH_MAGIC:
+                    await self.receive_batch(loop, conn)
+                    return
+                if head == protocol.DEDUP_MAGIC:
+                    await self.receive_dedup(loop, conn)
+                    return
+
+                name, f = server.open_output_file()
+                with f:
+                    # Short plain upload may not even fill magic
+                    server.write_all(f, memoryview(head))
+                    if len(head) == protocol.MAGIC_SIZE:
+                        await receive_file(loop, conn, f, buffers, self.timeout, self.writers)
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            print('Transfer from {} failed: {!r}'.format(addr, e))
+        finally:
+            self.free_buffers.extend(buffers)
+
+    async def receive_ranges(self, loop, conn, buffers):
+        ''' Writes ranges received over *conn* into place, block
+            received into one of *buffers* is written by writer
+            thread while next one is received into other
+        '''
+        views = [memoryview(buffer) for buffer in buffers]
+        view = views[0]
+        write = None
+        transfer = None
+        try:
+            while True:
+                header = await recv_exactly(loop, conn, protocol.RANGE_HEADER.size, self.timeout)
+                if header is None:
+                    break
+                transfer_id, size, offset, length = protocol.RANGE_HEADER.unpack(header)
+
+                if transfer is None:
+                    transfer = self.transfers.get(transfer_id)
+                    if transfer is None:
+                        transfer = self.transfers[transfer_id] = RangeTransfer(transfer_id, size,
+                                loop, self.writers)
+                    transfer.connections += 1
+                    await transfer.preparing
+                if transfer.transfer_id != transfer_id or transfer.size != size or offset + length > size:
+                    raise ValueError('Bad range header')
+
+                position = offset
+                end = offset + length
+                while position < end:
+                    filled = 0
+                    block = min(len(view), end - position)
+                    while filled < block:
+                        n = await asyncio.wait_for(loop.sock_recv_into(conn, view[filled:block]), self.timeout)
+                        if n == 0:
+                            raise ConnectionError('Range cut short')
+                        filled += n
+                    if write is not None:
+                        await write
+                    write = loop.run_in_executor(self.writers, server.pwrite_all,
+                            transfer.file.fileno(), view[:filled], position)
+                    view = views[1] if view is views[0] else views[0]
+                    position += filled
+
+                # Range is complete, only when it is on disk
+                if write is not None:
+                    await write
+                    write = None
+                transfer.complete(offset, length)
+                if transfer.done() and self.transfers.get(transfer_id) is transfer:
+                    del self.transfers[transfer_id]
+                    transfer.finish()
+
+            await loop.sock_sendall(conn, protocol.STATUS_OK)
+        finally:
+            if write is not None:
+                # Buffer and file must outlive write in progress
+                await asyncio.gather(write, return_exceptions=True)
+            if transfer is not None:
+                transfer.connections -= 1
+                if transfer.connections == 0:
+                    # Other streams of transfer may be still connecting
+                    loop.call_later(TRANSFER_TIMEOUT, self.expire, transfer)
+
+    async def receive_resumable(self, loop, conn, buffer):
+        ''' Negotiates offset of resumable transfer and receives
+            verified chunks from it
+        '''
+        hello = await recv_exactly(loop, conn, protocol.HELLO.size, self.timeout)
+        if hello is None:
+            return
+        transfer_id, size, chunk_size, codecs = protocol.HELLO.unpack(hello)
+        if chunk_size > protocol.MAX_CHUNK_SIZE:
+            await loop.sock_sendall(conn, protocol.STATUS_FAILED)
+            return
+
+        if len(buffer) < chunk_size:
+            buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+
+        # Same transfer can't be written by two connections. Client
+        # reconnects when it gave up on old one, which may be half-open
+        # and never noticed by server, so new connection takes over.
+        task = asyncio.current_task()
+        while transfer_id in self.resuming:
+            old = self.resuming[transfer_id]
+            old.cancel()
+            await asyncio.gather(old, return_exceptions=True)
+        self.resuming[transfer_id] = task
+
+        transfer = None
+        # Last job given to writers, which must end before file is closed
+        job = None
+        try:
+            transfer = ResumableTransfer(transfer_id, size)
+            job = loop.run_in_executor(None, transfer.verify)
+            offset = await job
+            codecs &= compression.SUPPORTED
+            await loop.sock_sendall(conn, protocol.STATUS_OK + protocol.OFFER.pack(offset, codecs))
+
+            while transfer.offset < size:
+                header = await recv_exactly(loop, conn, protocol.DATA.size, self.timeout)
+                if header is None:
+                    raise ConnectionError('Transfer interrupted at {} of {} bytes'.format(transfer.offset, size))
+                offset, length, crc, codec, wire_length = protocol.DATA.unpack(header)
+                if (offset != transfer.offset or length > chunk_size or offset + length > size
+                        or wire_length > length or (codec == compression.RAW and wire_length != length)
+                        or (codec != compression.RAW and not codecs & (1 << codec))):
+                    raise ValueError('Bad chunk header')
+
+                filled = 0
+                while filled < wire_length:
+                    n = await asyncio.wait_for(loop.sock_recv_into(conn, view[filled:wire_length]), self.timeout)
+                    if n == 0:
+                        raise ConnectionError('Chunk cut short')
+                    filled += n
+
+                data = view[:length]
+                if codec != compression.RAW:
+                    # Codecs release GIL, so other connections go on meanwhile
+                    data = await loop.run_in_executor(None, compression.decompress,
+                            codec, bytes(view[:wire_length]), length)
+
+                if zlib.crc32(data) != crc:
+                    await loop.sock_sendall(conn, protocol.STATUS_FAILED)
+                    raise ValueError('Checksum mismatch at {}'.format(offset))
+                job = loop.run_in_executor(self.writers, transfer.write, memoryview(data), crc)
+                await job
+
+            transfer.finish()
+            await loop.sock_sendall(conn, protocol.STATUS_OK)
+        finally:
+            if job is not None:
+                # Verification and writes use file, which must stay open till they end
+                await asyncio.gather(job, return_exceptions=True)
+            if transfer is not None:
+                transfer.close()
+            if self.resuming.get(transfer_id) is task:
+                del self.resuming[transfer_id]
+
+    async def receive_batch(self, loop, conn):
+        ''' Receives files of batch, handing blocks of them to
+            writer threads. Reading goes on while they write, till
+            PENDING_WRITES blocks of all batches are waiting.
+        '''
+        root = server.make_output_directory(suffix='.batch.part')
+        pending = self.pending_writes
+        writes = set()
+        # (path, mode) of files written in several blocks
+        modes = []
+        names = set()
+
+        def written(future):
+            pending.release()
+            if not future.cancelled() and future.exception() is None:
+                writes.discard(future)
+
+        try:
+            while True:
+                header = await recv_exactly(loop, conn, protocol.ENTRY.size, self.timeout)
+                if header is None:
+                    raise ConnectionError('Batch interrupted after {} files'.format(len(names)))
+                name_length, size, mode = protocol.ENTRY.unpack(header)
+                if name_length == 0:
+                    break
+
+                name = os.fsdecode(await recv_exactly(loop, conn, name_length, self.timeout) or b'')
+                if name in names:
+                    raise ValueError('Duplicate path {!r}'.format(name))
+                names.add(name)
+                path = batch_path(root, name)
+                mode &= 0o777
+
+                offset = 0
+                while True:
+                    length = min(self.buffer_size, size - offset)
+                    data = await recv_exactly(loop, conn, length, self.timeout)
+                    if data is None and length > 0:
+                        raise ConnectionError('File {!r} cut short'.format(name))
+                    last = offset + length == size
+
+                    await pending.acquire()
+                    write = loop.run_in_executor(self.writers, write_block, path, data or b'', offset,
+                            mode if last and offset == 0 else None)
+                    writes.add(write)
+                    write.add_done_callback(written)
+
+                    offset += length
+                    if last:
+                        break
+                if size > self.buffer_size:
+                    modes.append((path, mode))
+
+            # Raises first error of writers
+            await asyncio.gather(*writes)
+            await loop.run_in_executor(self.writers, set_modes, modes)
+            # Empty directory reserved exclusively is replaced, so
+            # batch of earlier run is never overwritten
+            name = server.make_output_directory()
+            os.rename(root, name)
+            await loop.sock_sendall(conn, protocol.STATUS_OK)
+            if self.verbose:
+                print('Received {} files into {}'.format(len(names), name))
+        finally:
+            # Writers must be done with files, whatever happened to connection
+            await asyncio.gather(*writes, return_exceptions=True)
+
+    async def receive_dedup(self, loop, conn):
+        ''' Asks client for chunks of manifest missing in chunk
+            store, stores them and rebuilds file from the store
+        '''
+        header = await recv_exactly(loop, conn, protocol.MANIFEST.size, self.timeout)
+        if header is None:
+            return
+        size, count = protocol.MANIFEST.unpack(header)
+        if count > protocol.MAX_MANIFEST_CHUNKS:
+            await loop.sock_sendall(conn, protocol.STATUS_FAILED)
+            raise ValueError('Manifest of {} chunks is too long'.format(count))
+
+        refs = await recv_exactly(loop, conn, count * protocol.CHUNK_REF.size, self.timeout) or b''
+        manifest = list(protocol.CHUNK_REF.iter_unpack(refs))
+        if (len(manifest) != count or sum(length for digest, length in manifest) != size
+                or any(length == 0 or length > protocol.MAX_CHUNK_SIZE for digest, length in manifest)):
+            raise ValueError('Bad manifest')
+
+        # Stats of every chunk would stall other connections
+        missing = await loop.run_in_executor(self.writers, self.chunks.missing, manifest)
+        bitmap = bytearray((count + 7) // 8)
+        for index in missing:
+            bitmap[index >> 3] |= 0x80 >> (index & 7)
+        await loop.sock_sendall(conn, protocol.STATUS_OK + bitmap)
+
+        for index in missing:
+            digest, length = manifest[index]
+            data = await recv_exactly(loop, conn, length, self.timeout)
+            if data is None:
+                raise ConnectionError('Transfer interrupted at chunk {} of {}'.format(index, count))
+            if hashlib.sha256(data).digest() != digest:
+                await loop.sock_sendall(conn, protocol.STATUS_FAILED)
+                raise ValueError('Chunk {} does not match its hash'.format(index))
+            await loop.run_in_executor(self.writers, self.chunks.put, digest, data)
+
+        part_name, f = server.open_output_file(suffix='.raw.part')
+        with f:
+            await loop.run_in_executor(self.writers, self.chunks.rebuild, manifest, f)
+        name = publish(part_name)
+        await loop.sock_sendall(conn, protocol.STATUS_OK)
+        if self.verbose:
+            print('Received {} of {} chunks of {}'.format(len(missing), count, name))
+
+    def expire(self, transfer):
+        ''' Drops transfer, which got no connections for a while '''
+        if transfer.connections == 0 and self.transfers.get(transfer.transfer_id) is transfer:
+            del self.transfers[transfer.transfer_id]
+            transfer.abandon()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default=server.SERVER_HOST)
+    parser.add_argument('--port', type=int, default=server.SERVER_PORT)
+    parser.add_argument('--max-concurrency', type=int, default=MAX_CONCURRENCY)
+    parser.add_argument('--buffer-size', type=int, default=BUFFER_SIZE,
+            help='bytes gathered before write, per connection')
+    parser.add_argument('--rcvbuf', type=int, default=None,
+            help='socket receive buffer size (SO_RCVBUF)')
+    parser.add_argument('--timeout', type=float, default=None,
+            help='drop connections silent for that many seconds')
+    parser.add_argument('--writers', type=int, default=WRITERS,
+            help='threads writing received data')
+    parser.add_argument('--chunk-store', default=CHUNK_STORE,
+            help='directory of chunks of deduplicated uploads')
+    parser.add_argument('--quiet', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+
+    listener = server.create_listener(arguments.host, arguments.port,
+            arguments.rcvbuf, LISTEN_BACKLOG)
+    print('Listening on {}:{}'.format(*listener.getsockname()), flush=True)
+    try:
+        asyncio.run(Server(listener, arguments.max_concurrency, arguments.buffer_size,
+            arguments.timeout, not arguments.quiet, arguments.writers,
+            arguments.chunk_store).serve())
+    except KeyboardInterrupt:
+        pass
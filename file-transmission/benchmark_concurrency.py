@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+''' Runs async_server.py on loopback and uploads same file from
+    1..256 concurrent clients, reporting aggregate throughput and
+    per-client transfer time.
+'''
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import client
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(address, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(address).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    raise RuntimeError('Server did not start')
+
+
+def upload(path, address, times, index):
+    start = time.perf_counter()
+    with open(path, 'rb', buffering=0) as f, socket.create_connection(address) as s:
+        client.send_file(s, f)
+        s.shutdown(socket.SHUT_WR)
+        # Waiting till server closes, so whole file is received
+        s.recv(1)
+    times[index] = time.perf_counter() - start
+
+
+def run(path, address, clients):
+    ''' Returns (wall seconds, list of per-client seconds) '''
+    times = [None] * clients
+    threads = [threading.Thread(target=upload, args=(path, address, times, k)) for k in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, sorted(times)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=4, help='file size, MiB')
+    parser.add_argument('--clients', default='1,2,4,8,16,32,64,128,256')
+    parser.add_argument('--max-concurrency', type=int, default=64)
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'upload.bin')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(arguments.size * 2**20))
+
+        received = os.path.join(directory, 'received')
+        os.mkdir(received)
+        address = ('127.0.0.1', free_port())
+        process = subprocess.Popen([sys.executable, os.path.join(DIRECTORY, 'async_server.py'),
+            '--host', address[0], '--port', str(address[1]), '--quiet',
+            '--max-concurrency', str(arguments.max_concurrency)], cwd=received)
+        try:
+            wait_for_server(address)
+            print('{:>7} {:>10} {:>12} {:>12}'.format('clients', 'MB/s', 'p50 s', 'p99 s'))
+            for clients in map(int, arguments.clients.split(',')):
+                wall, times = run(path, address, clients)
+                print('{:>7} {:>10.1f} {:>12.3f} {:>12.3f}'.format(clients,
+                    clients * arguments.size * 2**20 / wall / 1e6,
+                    percentile(times, 50), percentile(times, 99)))
+                for name in os.listdir(received):
+                    os.remove(os.path.join(received, name))
+        finally:
+            process.terminate()
+            process.wait()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+''' Loopback throughput benchmark of client.py and servers.
+
+    Starts server on ephemeral localhost port for every combination
+    of transfer mode, chunk size and socket buffer size, uploads
+    generated files with client.py and records MB/s, CPU time and
+    peak RSS of both sides, context switches, read/write syscalls
+    from /proc/<pid>/io and, with --strace, all syscalls. Figures of
+    client traced by strace include strace itself.
+'''
+
+import argparse
+import csv
+import json
+import os
+import platform
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Mode -> (server script, server arguments, client arguments)
+MODES = {
+    'sendfile': ('async_server.py', [], []),
+    'buffered': ('async_server.py', [], ['--buffered']),
+    'splice': ('server.py', ['--splice'], []),
+    'inline': ('server.py', ['--queue-depth', '0'], []),
+    'behind': ('server.py', [], []),
+    'streams': ('async_server.py', [], ['--streams', '4']),
+    'resume': ('async_server.py', [], ['--resume', '--compress', 'raw']),
+    'compress': ('async_server.py', [], ['--resume']),
+    'dedup': ('async_server.py', [], ['--dedup']),
+}
+
+SUFFIXES = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1:] in SUFFIXES:
+        return int(float(text[:-1]) * SUFFIXES[text[-1]])
+    return int(text)
+
+
+def parse_sizes(text):
+    return [parse_size(size) for size in text.split(',')]
+
+
+def generate_file(path, size, content):
+    ''' Random content repeats 1 MiB block, which is still
+        incompressible with windows of fast presets of stdlib codecs.
+        Text is CSV of small numbers, like heightmaps. Block is small,
+        because peak RSS of client includes RSS of this process at fork.
+    '''
+    if content == 'random':
+        block = os.urandom(min(size, 2**20))
+    else:
+        line = b'12,0,7,33,40,18,5,26,9,31\n'
+        block = line * (min(size, 2**20) // len(line) + 1)
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            written += f.write(block[:size - written])
+
+
+def process_cpu_time(pid):
+    ''' User + system CPU seconds of running process *pid* '''
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def process_peak_rss(pid):
+    ''' Peak resident set size of running process, KiB '''
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return None
+
+
+def process_io_calls(pid):
+    ''' Read and write syscalls (syscr + syscw) made so far by
+        process, which also works for zombie not yet reaped. Rough
+        substitute of strace counts: sendfile, splice and other
+        syscalls are not counted.
+    '''
+    with open('/proc/{}/io'.format(pid)) as f:
+        fields = dict(line.split(':') for line in f)
+    return int(fields['syscr']) + int(fields['syscw'])
+
+
+def strace_calls(path):
+    ''' Total number of syscalls from strace -c summary. Columns of
+        total line may be blank, so it is cut at dashes of separator
+        under header, and calls column is found by its name.
+    '''
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+        header = next(k for k, line in enumerate(lines) if 'calls' in line.split())
+        spans = [match.span() for match in re.finditer(r'-+', lines[header + 1])]
+        columns = [lines[header][start:end].strip() for start, end in spans]
+        start, end = spans[columns.index('calls')]
+        for line in lines[header + 2:]:
+            if line.split()[-1:] == ['total']:
+                return int(line[start:end])
+    except (OSError, ValueError, IndexError, StopIteration):
+        pass
+    return None
+
+
+class Server(object):
+    ''' Server subprocess listening on ephemeral port '''
+
+    def __init__(self, script, arguments, directory):
+        self.process = subprocess.Popen([sys.executable, os.path.join(DIRECTORY, script),
+            '--host', '127.0.0.1', '--port', '0'] + arguments,
+            cwd=directory, stdout=subprocess.PIPE, text=True)
+        line = self.process.stdout.readline()
+        match = re.match(r'Listening on ([\d.]+):(\d+)', line)
+        if match is None:
+            self.process.kill()
+            raise RuntimeError('Server did not start: {!r}'.format(line))
+        self.address = (match.group(1), int(match.group(2)))
+        self.pid = self.process.pid
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def wait_for_file(directory, size, timeout=60):
+    ''' Waits till server gives received file its final name '''
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.raw') and os.path.getsize(path) == size:
+                return path
+        time.sleep(0.01)
+    raise RuntimeError('Server did not store file')
+
+
+def run_client(arguments, strace_path=None):
+    ''' Runs client.py, returns (rusage, read and write syscalls).
+        Under strace the process waited for is strace itself: rusage
+        is of strace together with client it reaped, and /proc/<pid>/io
+        is of strace alone, so syscalls are None then.
+    '''
+    command = [sys.executable, os.path.join(DIRECTORY, 'client.py')] + arguments
+    if strace_path:
+        command = ['strace', '-f', '-c', '-o', strace_path] + command
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    # Reading counters of exited client before it is reaped
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    io_calls = None if strace_path else process_io_calls(process.pid)
+    pid, status, usage = os.wait4(process.pid, 0)
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError('Client failed with {}'.format(os.waitstatus_to_exitcode(status)))
+    return usage, io_calls
+
+
+def measure(mode, file_path, size, chunk_size, sockbuf, directory, use_strace):
+    script, server_arguments, client_arguments = MODES[mode]
+    received = os.path.join(directory, 'received')
+    os.makedirs(received, exist_ok=True)
+
+    server_arguments = server_arguments + ['--buffer-size', str(chunk_size)]
+    if script == 'async_server.py':
+        server_arguments.append('--quiet')
+    if sockbuf:
+        server_arguments += ['--rcvbuf', str(sockbuf)]
+    server = Server(script, server_arguments, received)
+
+    client_arguments = [file_path, '--host', server.address[0], '--port', str(server.address[1]),
+            '--buffer-size', str(chunk_size), '--range-size', str(chunk_size),
+            '--chunk-size', str(min(chunk_size, 2**24))] + client_arguments
+    if sockbuf:
+        client_arguments += ['--sndbuf', str(sockbuf)]
+
+    client_strace = os.path.join(directory, 'client.strace') if use_strace else None
+    server_strace = os.path.join(directory, 'server.strace') if use_strace else None
+    tracer = None
+    try:
+        if use_strace:
+            tracer = subprocess.Popen(['strace', '-f', '-c', '-o', server_strace, '-p', str(server.pid)],
+                    stderr=subprocess.DEVNULL)
+            time.sleep(0.2)
+
+        server_cpu = process_cpu_time(server.pid)
+        server_io_calls = process_io_calls(server.pid)
+        # Includes interpreter startup of client, which dominates small files
+        start = time.perf_counter()
+        usage, client_io_calls = run_client(client_arguments, client_strace)
+        wait_for_file(received, size)
+        wall = time.perf_counter() - start
+        server_cpu = process_cpu_time(server.pid) - server_cpu
+        server_io_calls = process_io_calls(server.pid) - server_io_calls
+        server_rss = process_peak_rss(server.pid)
+
+        if tracer is not None:
+            tracer.send_signal(signal.SIGINT)
+            tracer.wait()
+    finally:
+        server.stop()
+        shutil.rmtree(received)
+
+    return {
+        'mode': mode,
+        'size': size,
+        'chunk size': chunk_size,
+        'socket buffer': sockbuf or 0,
+        'seconds': wall,
+        'MB/s': size / wall / 1e6,
+        'client CPU s': usage.ru_utime + usage.ru_stime,
+        'server CPU s': server_cpu,
+        'client peak RSS KiB': usage.ru_maxrss,
+        'server peak RSS KiB': server_rss,
+        'client context switches': usage.ru_nvcsw + usage.ru_nivcsw,
+        # CPU, RSS and context switches of client add those of strace
+        'client traced': use_strace,
+        'client read/write syscalls': client_io_calls,
+        'server read/write syscalls': server_io_calls,
+        'client syscalls': strace_calls(client_strace) if use_strace else None,
+        'server syscalls': strace_calls(server_strace) if use_strace else None,
+    }
+
+
+def print_result(result):
+    print('{:>9} {:>11} {:>9} {:>9} {:>10.1f} {:>8.3f} {:>8.3f} {:>9} {:>9} {:>8} {:>8}'.format(
+        result['mode'], result['size'], result['chunk size'], result['socket buffer'],
+        result['MB/s'], result['client CPU s'], result['server CPU s'],
+        result['client peak RSS KiB'], result['server peak RSS KiB'],
+        # Not counted for client traced by strace
+        '-' if result['client read/write syscalls'] is None else result['client read/write syscalls'],
+        result['server read/write syscalls']), flush=True)
+
+
+def save(results, filename):
+    if filename.endswith('.json'):
+        with open(filename, 'w') as f:
+            json.dump({
+                'python': sys.version,
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'results': results
+                }, f, indent=2)
+    else:
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1K,1M,64M,1G', help='file sizes, e.g. 1K,1M,4G')
+    parser.add_argument('--chunk-sizes', default='64K,1M,4M', help='buffer, chunk and range sizes')
+    parser.add_argument('--socket-buffers', default='0,4M', help='SO_SNDBUF/SO_RCVBUF, 0 - default')
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--content', choices=['random', 'text'], default='random')
+    parser.add_argument('--strace', action='store_true', help='count syscalls with strace')
+    parser.add_argument('--directory', default=None, help='where to keep generated files')
+    parser.add_argument('--json', help='save results as JSON')
+    parser.add_argument('--csv', help='save results as CSV')
+    arguments = parser.parse_args()
+
+    if arguments.strace and shutil.which('strace') is None:
+        print('strace not found, syscalls are not counted', file=sys.stderr)
+        arguments.strace = False
+    elif arguments.strace:
+        print('client CPU, RSS and context switches include strace', file=sys.stderr)
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=arguments.directory) as directory:
+        print('{:>9} {:>11} {:>9} {:>9} {:>10} {:>8} {:>8} {:>9} {:>9} {:>8} {:>8}'.format('mode', 'size',
+            'chunk', 'sockbuf', 'MB/s', 'cli CPU', 'srv CPU', 'cli KiB', 'srv KiB', 'cli r/w', 'srv r/w'))
+        for size in parse_sizes(arguments.sizes):
+            file_path = os.path.join(directory, 'upload.bin')
+            generate_file(file_path, size, arguments.content)
+            for mode in arguments.modes.split(','):
+                for chunk_size in parse_sizes(arguments.chunk_sizes):
+                    for sockbuf in parse_sizes(arguments.socket_buffers):
+                        result = measure(mode, file_path, size, chunk_size, sockbuf, directory, arguments.strace)
+                        results.append(result)
+                        print_result(result)
+            os.remove(file_path)
+
+    if arguments.json:
+        save(results, arguments.json)
+    if arguments.csv:
+        save(results, arguments.csv)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+''' Compares CPU time per GB of sendfile(2) and buffered send paths
+    of client.py over loopback.
+'''
+
+import argparse
+import multiprocessing
+import os
+import resource
+import socket
+import tempfile
+import time
+
+import client
+
+
+def sink(listener):
+    ''' Receives and drops everything, in separate process,
+        so its CPU time isn't counted.
+    '''
+    buffer = bytearray(2**20)
+    while True:
+        conn, addr = listener.accept()
+        with conn:
+            while conn.recv_into(buffer):
+                pass
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(path, address, zero_copy):
+    ''' Returns (wall seconds, CPU seconds, bytes sent) '''
+    with open(path, 'rb', buffering=0) as f:
+        s = socket.create_connection(address)
+        wall, cpu = time.perf_counter(), cpu_time()
+        sent = client.send_file(s, f, zero_copy=zero_copy)
+        cpu, wall = cpu_time() - cpu, time.perf_counter() - wall
+        s.close()
+    return wall, cpu, sent
+
+
+def create_file(size):
+    f = tempfile.NamedTemporaryFile(delete=False)
+    block = os.urandom(2**20)
+    with f:
+        for offset in range(0, size, len(block)):
+            f.write(block[:size - offset])
+    return f.name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=1024, help='file size, MiB')
+    parser.add_argument('--repeat', type=int, default=3)
+    arguments = parser.parse_args()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('localhost', 0))
+    listener.listen(1)
+    receiver = multiprocessing.Process(target=sink, args=(listener,), daemon=True)
+    receiver.start()
+
+    path = create_file(arguments.size * 2**20)
+    try:
+        # Warming page cache, both paths should read from memory
+        with open(path, 'rb') as f:
+            while f.read(2**22):
+                pass
+
+        print('{:>9} {:>10} {:>10} {:>12}'.format('path', 'MB/s', 'CPU s', 'CPU s / GB'))
+        for name, zero_copy in [('sendfile', True), ('buffered', False)]:
+            for attempt in range(arguments.repeat):
+                wall, cpu, sent = measure(path, listener.getsockname(), zero_copy)
+                print('{:>9} {:>10.1f} {:>10.3f} {:>12.3f}'.format(
+                    name, sent / wall / 1e6, cpu, cpu / (sent / 1e9)))
+    finally:
+        os.remove(path)
+        receiver.terminate()
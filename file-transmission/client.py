@@ -1,23 +1,434 @@
-#!/usr/bin/env python3 
+#!/usr/bin/env python3
 
+import argparse
+import errno
+import os
+import queue
 import socket
 import sys
+import threading
+import time
+import uuid
+import zlib
 
-if len(sys.argv) < 2:
-    print('Specify file.', file=sys.stderr)
-    exit(1)
+import compression
+import dedup
+import protocol
 
 SERVER_HOST = '4.8.15.16'
 #SERVER_HOST = 'localhost'
 SERVER_PORT = 13337
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.connect((SERVER_HOST, SERVER_PORT))
 
-with open(sys.argv[1], 'rb') as f:
-    data = f.read(2**22)
-    while len(data) > 0:
-        s.sendall(data)
-        data = f.read(2**22)
+# Size of reusable buffer of fallback path
+BUFFER_SIZE = 2**22
+# Max bytes asked from single sendfile(2) call
+SENDFILE_BLOCK = 2**30
 
-s.close()
+# Size of ranges parallel streams take from shared queue
+RANGE_SIZE = 2**23
+# Limit of auto-tuned number of streams
+MAX_STREAMS = 16
+# Seconds between checks of throughput while probing streams
+PROBE_INTERVAL = 0.25
+# Longest measurement before next doubling of streams
+MAX_PROBE_TIME = 5
+# Bytes sent by stream between updates of progress
+PROGRESS_BLOCK = 2**20
 
+# Size of checksummed chunks of resumable upload
+CHUNK_SIZE = 2**20
+# Reconnections of resumable upload before giving up
+RETRIES = 5
+
+# Files of batch up to that size are gathered into buffer with their entries
+SMALL_FILE_SIZE = 2**16
+
+# sendfile(2) refuses such files or sockets, so buffered path is used
+SENDFILE_UNSUPPORTED = {errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSOCK}
+
+
+def connect(address, sndbuf=None):
+    ''' Connects to server, with *sndbuf* socket send buffer size '''
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if sndbuf:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    try:
+        s.connect(address)
+    except OSError:
+        s.close()
+        raise
+    return s
+
+
+def file_size(f):
+    return os.fstat(f.fileno()).st_size
+
+
+def send_zero_copy(sock, f, offset=0, count=None, progress=None):
+    ''' Sends file straight from page cache with sendfile(2),
+        data never enters user space. Returns number of bytes sent.
+        *progress* (list) gets number of bytes sent so far, which
+        caller needs, when sendfile(2) fails part way.
+    '''
+    if count is None:
+        count = file_size(f) - offset
+    if progress is None:
+        progress = [0]
+
+    while progress[0] < count:
+        sent = os.sendfile(sock.fileno(), f.fileno(), offset + progress[0],
+                min(count - progress[0], SENDFILE_BLOCK))
+        if sent == 0:
+            break
+        progress[0] += sent
+
+    return progress[0]
+
+
+def send_buffered(sock, f, offset=0, count=None, buffer=None):
+    ''' Reads file into one reusable buffer and sends slices of it,
+        so no bytes object is created per chunk.
+        Returns number of bytes sent.
+    '''
+    if buffer is None:
+        buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+
+    f.seek(offset)
+    sent_total = 0
+    while count is None or sent_total < count:
+        size = len(view) if count is None else min(len(view), count - sent_total)
+        read = f.readinto(view[:size])
+        if not read:
+            break
+        sock.sendall(view[:read])
+        sent_total += read
+
+    return sent_total
+
+
+def send_file(sock, f, offset=0, count=None, zero_copy=True, buffer=None):
+    ''' Sends file with sendfile(2) when possible, else
+        with buffered path. Returns number of bytes sent.
+    '''
+    sent = 0
+    if zero_copy and hasattr(os, 'sendfile'):
+        progress = [0]
+        try:
+            return send_zero_copy(sock, f, offset, count, progress)
+        except OSError as e:
+            if e.errno not in SENDFILE_UNSUPPORTED:
+                raise
+            # Refused, maybe part way: rest goes buffered
+            sent = progress[0]
+
+    if count is not None:
+        count -= sent
+    return sent + send_buffered(sock, f, offset + sent, count, buffer)
+
+
+class ParallelUpload(object):
+    ''' Sends file as ranges over several connections. Every
+        stream takes next range from shared queue, so fast streams
+        send more. Number of streams is fixed or doubled while
+        total throughput keeps growing.
+    '''
+
+    def __init__(self, address, path, range_size=RANGE_SIZE, zero_copy=True, sndbuf=None):
+        self.address = address
+        self.path = path
+        self.zero_copy = zero_copy
+        self.sndbuf = sndbuf
+        self.size = os.path.getsize(path)
+        self.range_size = range_size
+        self.transfer_id = uuid.uuid4().bytes
+
+        self.ranges = queue.Queue()
+        for offset in range(0, self.size, range_size):
+            self.ranges.put((offset, min(range_size, self.size - offset)))
+        if self.size == 0:
+            # Server still has to create empty file
+            self.ranges.put((0, 0))
+
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.streams = []
+        self.errors = []
+
+    def stream(self):
+        try:
+            with connect(self.address, self.sndbuf) as s, open(self.path, 'rb', buffering=0) as f:
+                s.sendall(protocol.RANGE_MAGIC)
+                while True:
+                    try:
+                        offset, length = self.ranges.get_nowait()
+                    except queue.Empty:
+                        break
+                    s.sendall(protocol.RANGE_HEADER.pack(self.transfer_id, self.size, offset, length))
+                    # Sent in blocks, so slow links show progress before range ends
+                    for position in range(offset, offset + length, PROGRESS_BLOCK):
+                        block = min(PROGRESS_BLOCK, offset + length - position)
+                        if send_file(s, f, position, block, self.zero_copy) != block:
+                            raise RuntimeError('File was truncated while sending')
+                        with self.lock:
+                            self.sent += block
+
+                s.shutdown(socket.SHUT_WR)
+                if protocol.recv_exactly(s, 1) != protocol.STATUS_OK:
+                    raise ConnectionError('Server failed to write ranges')
+        except Exception as e:
+            self.errors.append(e)
+
+    def start_stream(self):
+        thread = threading.Thread(target=self.stream)
+        thread.start()
+        self.streams.append(thread)
+
+    def measure(self):
+        ''' Bytes per second sent by all streams, measured till
+            at least one range worth of data is sent
+        '''
+        sent = self.sent
+        start = time.perf_counter()
+        while True:
+            time.sleep(PROBE_INTERVAL)
+            elapsed = time.perf_counter() - start
+            if (self.sent - sent >= self.range_size or elapsed >= MAX_PROBE_TIME
+                    or self.ranges.empty() or self.errors):
+                return (self.sent - sent) / elapsed
+
+    def auto_tune(self, max_streams):
+        ''' Doubles streams while throughput grows by 10% '''
+        self.start_stream()
+        best = 0
+        while len(self.streams) < max_streams and not self.ranges.empty() and not self.errors:
+            rate = self.measure()
+            # No progress tells nothing about more streams
+            if rate <= 0 or rate < best * 1.1:
+                break
+            best = rate
+            for k in range(min(len(self.streams), max_streams - len(self.streams))):
+                self.start_stream()
+
+    def run(self, streams=None, max_streams=MAX_STREAMS):
+        ''' Sends file over *streams* connections, None - auto.
+            Returns number of streams used.
+        '''
+        if streams:
+            for k in range(streams):
+                self.start_stream()
+        else:
+            self.auto_tune(max_streams)
+
+        for thread in self.streams:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+        return len(self.streams)
+
+
+def send_file_resumable(address, path, chunk_size=CHUNK_SIZE, retries=RETRIES, codecs=(), sndbuf=None):
+    ''' Sends file in checksummed chunks, starting from offset
+        server already holds. Reconnects and resumes after
+        failures. Chunks are compressed with one of *codecs*
+        server accepts, when that pays off.
+        Returns (offset transfer was resumed from, compression.Policy).
+    '''
+    transfer_id = protocol.transfer_id(path)
+    size = os.path.getsize(path)
+    view = memoryview(bytearray(chunk_size))
+
+    attempt = 0
+    while True:
+        try:
+            with connect(address, sndbuf) as s, open(path, 'rb', buffering=0) as f:
+                s.sendall(protocol.RESUME_MAGIC + protocol.HELLO.pack(transfer_id, size, chunk_size,
+                    compression.mask(codecs)))
+                if protocol.recv_exactly(s, 1) != protocol.STATUS_OK:
+                    raise ConnectionError('Server refused transfer')
+                offer = protocol.recv_exactly(s, protocol.OFFER.size)
+                if offer is None:
+                    raise ConnectionError('Server closed connection before offer')
+                offset, accepted = protocol.OFFER.unpack(offer)
+                resumed_from = offset
+                policy = compression.Policy(compression.codecs(accepted))
+
+                f.seek(offset)
+                while offset < size:
+                    read = f.readinto(view[:min(chunk_size, size - offset)])
+                    if not read:
+                        raise RuntimeError('File was truncated while sending')
+                    codec, data = policy.encode(view[:read])
+                    s.sendall(protocol.DATA.pack(offset, read, zlib.crc32(view[:read]), codec, len(data)))
+                    s.sendall(data)
+                    offset += read
+
+                if protocol.recv_exactly(s, 1) != protocol.STATUS_OK:
+                    raise ConnectionError('Server rejected chunk')
+                return resumed_from, policy
+        except OSError as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            delay = min(2**attempt, 30)
+            print('Transfer interrupted ({}), resuming in {} s'.format(e, delay), file=sys.stderr)
+            time.sleep(delay)
+
+
+def send_file_dedup(address, path, zero_copy=True, sndbuf=None):
+    ''' Sends manifest of content-defined chunks of file, then
+        only chunks server doesn't store yet, runs of adjacent ones
+        in one go. Returns (chunks sent, chunks in file).
+    '''
+    with open(path, 'rb', buffering=0) as f:
+        size = file_size(f)
+        chunks = list(dedup.chunks(f))
+
+        with connect(address, sndbuf) as s:
+            s.sendall(protocol.DEDUP_MAGIC + protocol.MANIFEST.pack(size, len(chunks)))
+            s.sendall(b''.join(protocol.CHUNK_REF.pack(digest, length) for offset, length, digest in chunks))
+            if protocol.recv_exactly(s, 1) != protocol.STATUS_OK:
+                raise ConnectionError('Server refused manifest')
+            bitmap = protocol.recv_exactly(s, (len(chunks) + 7) // 8)
+            if bitmap is None:
+                raise ConnectionError('Server closed connection before asking for chunks')
+
+            missing = [chunks[k] for k in range(len(chunks)) if bitmap[k >> 3] & (0x80 >> (k & 7))]
+            # Runs (offset, length) of adjacent missing chunks
+            runs = []
+            for offset, length, digest in missing:
+                if runs and sum(runs[-1]) == offset:
+                    runs[-1][1] += length
+                else:
+                    runs.append([offset, length])
+            for offset, length in runs:
+                if send_file(s, f, offset, length, zero_copy) != length:
+                    raise RuntimeError('File was truncated while sending')
+
+            if protocol.recv_exactly(s, 1) != protocol.STATUS_OK:
+                raise ConnectionError('Server failed to rebuild file')
+
+    return len(missing), len(chunks)
+
+
+def walk_files(directory):
+    ''' Relative paths of regular files under *directory* '''
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                yield os.path.relpath(path, directory)
+
+
+def send_directory(address, directory, zero_copy=True, sndbuf=None, buffer_size=BUFFER_SIZE):
+    ''' Sends all regular files under *directory* as one batch
+        over one connection. Small files are gathered with their
+        entries into buffer, so one send carries many of them;
+        larger ones go with sendfile(2). Returns number of files sent.
+    '''
+    buffer = bytearray(protocol.BATCH_MAGIC)
+    count = 0
+    with connect(address, sndbuf) as s:
+        for path in walk_files(directory):
+            with open(os.path.join(directory, path), 'rb', buffering=0) as f:
+                stat = os.fstat(f.fileno())
+                name = os.fsencode(path.replace(os.sep, '/'))
+                buffer += protocol.ENTRY.pack(len(name), stat.st_size, stat.st_mode & 0o777)
+                buffer += name
+                if stat.st_size <= SMALL_FILE_SIZE:
+                    data = f.read(stat.st_size)
+                    sent = len(data)
+                    buffer += data
+                else:
+                    s.sendall(buffer)
+                    buffer.clear()
+                    sent = send_file(s, f, 0, stat.st_size, zero_copy)
+                if sent != stat.st_size:
+                    raise RuntimeError('{} was truncated while sending'.format(path))
+            count += 1
+
+            if len(buffer) >= buffer_size:
+                s.sendall(buffer)
+                buffer.clear()
+
+        buffer += protocol.ENTRY.pack(0, 0, 0)
+        s.sendall(buffer)
+        if protocol.recv_exactly(s, 1) != protocol.STATUS_OK:
+            raise ConnectionError('Server failed to write batch')
+
+    return count
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Send file to server.')
+    parser.add_argument('file', help='file, or directory to send as batch '
+            '(needs async_server.py)')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--buffered', action='store_true',
+            help="don't use sendfile(2)")
+    parser.add_argument('--buffer-size', type=int, default=BUFFER_SIZE,
+            help='buffer size of buffered path')
+    parser.add_argument('--sndbuf', type=int, default=None,
+            help='socket send buffer size (SO_SNDBUF)')
+    parser.add_argument('--streams', default=None,
+            help="send ranges over N parallel connections, 'auto' - tune N "
+                 '(needs async_server.py)')
+    parser.add_argument('--range-size', type=int, default=RANGE_SIZE)
+    parser.add_argument('--resume', action='store_true',
+            help='send checksummed chunks, resume interrupted transfer '
+                 '(needs async_server.py)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--compress', default='zlib,bz2,lzma',
+            help="codecs resumable upload may use, 'raw' - none")
+    parser.add_argument('--dedup', action='store_true',
+            help="send only content-defined chunks server doesn't store "
+                 '(needs async_server.py)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+
+    if os.path.isdir(arguments.file):
+        count = send_directory((arguments.host, arguments.port), arguments.file,
+                not arguments.buffered, arguments.sndbuf, arguments.buffer_size)
+        print('Sent {} files'.format(count))
+        exit(0)
+
+    if not os.path.isfile(arguments.file):
+        print('Specify file.', file=sys.stderr)
+        exit(1)
+
+    if arguments.resume:
+        codecs = [compression.NAMES[name] for name in arguments.compress.split(',')]
+        resumed_from, policy = send_file_resumable((arguments.host, arguments.port), arguments.file,
+                arguments.chunk_size, codecs=[codec for codec in codecs if codec != compression.RAW],
+                sndbuf=arguments.sndbuf)
+        if resumed_from > 0:
+            print('Resumed from {} bytes'.format(resumed_from))
+        print('Chunks by codec: {}'.format(', '.join('{} {}'.format(name, policy.chosen.get(codec, 0))
+            for name, codec in compression.NAMES.items())))
+        exit(0)
+
+    if arguments.dedup:
+        sent, total = send_file_dedup((arguments.host, arguments.port), arguments.file,
+                not arguments.buffered, arguments.sndbuf)
+        print('Sent {} of {} chunks'.format(sent, total))
+        exit(0)
+
+    if arguments.streams is not None:
+        upload = ParallelUpload((arguments.host, arguments.port), arguments.file,
+                arguments.range_size, not arguments.buffered, arguments.sndbuf)
+        streams = upload.run(None if arguments.streams == 'auto' else int(arguments.streams))
+        print('Sent over {} streams'.format(streams))
+        exit(0)
+
+    s = connect((arguments.host, arguments.port), arguments.sndbuf)
+
+    with open(arguments.file, 'rb', buffering=0) as f:
+        send_file(s, f, zero_copy=not arguments.buffered, buffer=bytearray(arguments.buffer_size))
+
+    s.close()
@@ -0,0 +1,199 @@
+''' Per chunk compression of resumable uploads.
+
+    Codec is kept for a window of chunks and scored by raw bytes per
+    second the window got across, compression, sending and receiver
+    backpressure included. Codecs not tried lately are predicted from
+    their measured compression speed and ratio and link throughput;
+    promising ones, and raw from time to time, are tried again, so
+    estimates follow changing data and link.
+'''
+
+import bz2
+import lzma
+import time
+import zlib
+
+RAW = 0
+ZLIB = 1
+BZ2 = 2
+LZMA = 3
+
+NAMES = {'raw': RAW, 'zlib': ZLIB, 'bz2': BZ2, 'lzma': LZMA}
+
+# Fast presets, slow ones rarely pay off on the fly
+COMPRESSORS = {
+    ZLIB: lambda data: zlib.compress(data, 1),
+    BZ2: lambda data: bz2.compress(data, 1),
+    LZMA: lambda data: lzma.compress(data, preset=0),
+}
+
+DECOMPRESSORS = {
+    ZLIB: zlib.decompressobj,
+    BZ2: bz2.BZ2Decompressor,
+    LZMA: lzma.LZMADecompressor,
+}
+
+SUPPORTED = (1 << ZLIB) | (1 << BZ2) | (1 << LZMA)
+
+
+def mask(codecs):
+    ''' Bitmask of *codecs* for HELLO frame '''
+    result = 0
+    for codec in codecs:
+        result |= 1 << codec
+    return result
+
+
+def codecs(mask):
+    return [codec for codec in COMPRESSORS if mask & (1 << codec)]
+
+
+def decompress(codec, data, length):
+    ''' Decompresses chunk, which must be *length* bytes,
+        never producing more (so malicious chunk can't
+        exhaust memory).
+    '''
+    decompressor = DECOMPRESSORS[codec]()
+    result = decompressor.decompress(data, length + 1)
+    if len(result) != length:
+        raise ValueError('Chunk decompressed to {} bytes instead of {}'.format(len(result), length))
+    return result
+
+
+class Policy(object):
+    ''' Chooses codec of next chunks from measurements '''
+
+    # Weight of new measurement in moving averages
+    SMOOTHING = 0.3
+    # Chunks sent with one codec before it is scored, single chunks
+    # are dominated by per chunk costs and socket buffering
+    WINDOW_CHUNKS = 8
+    # Every that many windows codec predicted best after current one
+    # is tried, so estimates don't go stale
+    EXPLORE_PERIOD = 8
+    # Every that many explorations raw is tried, whatever predictions say
+    RAW_PERIOD = 4
+    # Bytes of chunk compressed when measuring all codecs
+    PROBE_SIZE = 2**14
+    # Compressed chunk is sent raw, unless it is that much smaller
+    MIN_SAVING = 0.05
+    # Wire bytes per second (100 Mbit/s) link is assumed to take till
+    # first window measures it, so first window is already chosen
+    # from probe and files shorter than one window get compressed too
+    ASSUMED_LINK_RATE = 12.5e6
+
+    def __init__(self, allowed):
+        self.allowed = list(allowed)
+        # Codec -> (raw bytes per second of compression, compressed / raw size)
+        self.stats = {}
+        # Codec -> raw bytes per second of its windows
+        self.rates = {}
+        # Wire bytes per second socket takes
+        self.link_rate = None
+        self.codec = RAW
+        self.windows = 0
+        self.explorations = 0
+        self.start_window()
+        self.chosen = {codec: 0 for codec in [RAW] + self.allowed}
+
+    def start_window(self):
+        self.window_start = None
+        self.window_chunks = 0
+        self.window_bytes = 0
+        self.window_wire_bytes = 0
+        self.window_compress_time = 0
+
+    def average(self, old, new):
+        return new if old is None else old + self.SMOOTHING * (new - old)
+
+    def measure(self, codec, data):
+        ''' Compresses *data*, updates codec stats, returns result '''
+        start = time.perf_counter()
+        compressed = COMPRESSORS[codec](data)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        self.window_compress_time += elapsed
+
+        speed, ratio = self.stats.get(codec, (None, None))
+        self.stats[codec] = (self.average(speed, len(data) / elapsed),
+                self.average(ratio, len(compressed) / max(1, len(data))))
+        return compressed
+
+    def probe(self, data):
+        ''' Measures all allowed codecs on sample of *data* '''
+        for codec in self.allowed:
+            self.measure(codec, data[:self.PROBE_SIZE])
+
+    def end_window(self, now):
+        ''' Scores codec by window, which ends at time *now* '''
+        elapsed = max(now - self.window_start, 1e-9)
+        self.rates[self.codec] = self.average(self.rates.get(self.codec), self.window_bytes / elapsed)
+        # Overestimated, when compression left socket idle, which
+        # trying raw corrects; underestimates would never be corrected.
+        # Compressed window before any raw one may leave link idle
+        # most of the time, so it doesn't tell link rate at all
+        if self.codec == RAW or self.link_rate is not None:
+            self.link_rate = self.average(self.link_rate,
+                    self.window_wire_bytes / max(elapsed - self.window_compress_time, 1e-9))
+        self.windows += 1
+        self.start_window()
+
+    def predict(self, codec):
+        ''' Expected raw bytes per second of codec from its
+            compression stats and link throughput
+        '''
+        link_rate = self.ASSUMED_LINK_RATE if self.link_rate is None else self.link_rate
+        if codec == RAW:
+            return link_rate
+        speed, ratio = self.stats[codec]
+        return 1 / (1 / speed + ratio / link_rate)
+
+    def estimate(self, codec):
+        return self.rates[codec] if codec in self.rates else self.predict(codec)
+
+    def choose(self):
+        ''' Codec of next window '''
+        if self.link_rate is None and self.windows > 0:
+            # First window was compressed, raw one measures link
+            return RAW
+        candidates = [RAW] + self.allowed
+        best = max(candidates, key=self.estimate)
+        if self.windows % self.EXPLORE_PERIOD != 0:
+            return best
+
+        self.explorations += 1
+        if best != RAW and self.explorations % self.RAW_PERIOD == 0:
+            return RAW
+        others = [codec for codec in candidates if codec != best]
+        runner_up = max(others, key=self.predict)
+        return runner_up if self.predict(runner_up) > self.estimate(best) else best
+
+    def encode(self, data):
+        ''' Returns (codec, bytes to send) for chunk *data* '''
+        if not self.allowed:
+            self.chosen[RAW] += 1
+            return RAW, data
+
+        now = time.perf_counter()
+        if self.window_chunks == self.WINDOW_CHUNKS:
+            self.end_window(now)
+        if self.window_chunks == 0:
+            if self.windows % self.EXPLORE_PERIOD == 0:
+                # Data changes, so stats of all codecs are refreshed before exploring
+                self.probe(data)
+            self.codec = self.choose()
+            self.window_start = time.perf_counter()
+            self.window_compress_time = 0
+        self.window_chunks += 1
+        self.window_bytes += len(data)
+
+        codec = self.codec
+        if codec != RAW:
+            compressed = self.measure(codec, data)
+            if len(compressed) <= len(data) * (1 - self.MIN_SAVING):
+                self.chosen[codec] += 1
+                self.window_wire_bytes += len(compressed)
+                return codec, compressed
+
+        self.chosen[RAW] += 1
+        self.window_wire_bytes += len(data)
+        return RAW, data
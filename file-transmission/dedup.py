@@ -0,0 +1,164 @@
+''' Content-defined chunking of deduplicated uploads.
+
+    Chunk ends where rolling hash of preceding bytes matches mask, so
+    boundaries depend only on content nearby: bytes inserted or removed
+    shift boundaries just around the edit, and the rest of changed file
+    keeps chunks server already stores. Stricter mask before average
+    size and looser one after it (normalized chunking of FastCDC) keep
+    chunk sizes close to average.
+
+    Hash takes two rounds, each maps bytes through random table and
+    multiplies them carry-less by fixed polynomial, so it is computed
+    for whole buffer at once with shifts and xors of one big integer.
+    Candidate boundaries are found with bytes.find and only the few
+    of them are checked against remaining bits of mask in Python.
+'''
+
+import hashlib
+import os
+import random
+import tempfile
+
+MIN_SIZE = 2**14
+AVERAGE_SIZE = 2**16
+MAX_SIZE = 2**18
+
+# Bytes of file read at once by chunker
+READ_SIZE = 2**22
+
+# Every client must cut same content the same way, so tables are fixed
+_random = random.Random(0x6765_6172)
+TABLES = tuple(bytes(_random.getrandbits(8) for k in range(256)) for table in range(2))
+
+# Factors of polynomial of each round: x^0 + x^9 + ... + x^279 spreads
+# byte over 35 following hash bytes at different bit shifts, second
+# round mixes those through table again
+SHIFTS = ((9, 18, 36, 72, 144), (9, 18))
+# Hash bytes past end of data the shifts reach
+SPILL = 40
+
+# Strict mask takes 18 bits: two hash bytes and low bits of previous
+# one, loose mask 14 bits: hash byte and low bits of previous one
+LOW_2 = 0x03
+LOW_6 = bytes(value & 0x3F for value in range(256))
+
+
+def hashes(data):
+    ''' Returns (hashed, low), bytes as long as *data*: hash byte
+        of every byte, depending on 40 preceding ones, and its low
+        six bits
+    '''
+    size = len(data)
+    result = data
+    for table, shifts in zip(TABLES, SHIFTS):
+        h = int.from_bytes(result.translate(table), 'little')
+        for shift in shifts:
+            h ^= h << shift
+        result = h.to_bytes(size + SPILL, 'little')[:size]
+    return result, result.translate(LOW_6)
+
+
+def cut(hashed, low, start, end):
+    ''' End of chunk starting at *start*, *end* is end of data,
+        *hashed* and *low* are its hashes
+    '''
+    if end - start <= MIN_SIZE:
+        return end
+    normal = start + min(end - start, AVERAGE_SIZE)
+    limit = start + min(end - start, MAX_SIZE)
+
+    # Chunk ends after second of two zero bytes
+    index = start + MIN_SIZE - 1
+    while True:
+        index = hashed.find(b'\0\0', index, normal)
+        if index < 0:
+            break
+        if not hashed[index - 1] & LOW_2:
+            return index + 2
+        index += 1
+    index = normal - 1
+    while True:
+        index = low.find(b'\0\0', index, limit)
+        if index < 0:
+            break
+        if not hashed[index + 1]:
+            return index + 2
+        index += 1
+    return limit
+
+
+def chunks(f):
+    ''' Yields (offset, length, sha256 digest) of chunks of file *f* '''
+    data = b''
+    hashed = low = b''
+    position = 0
+    offset = 0
+    eof = False
+    while True:
+        if not eof and len(data) - position < MAX_SIZE:
+            more = f.read(READ_SIZE)
+            if more:
+                data = data[position:] + more
+                hashed, low = hashes(data)
+                position = 0
+                continue
+            eof = True
+        if position == len(data):
+            return
+
+        end = cut(hashed, low, position, len(data))
+        yield offset, end - position, hashlib.sha256(memoryview(data)[position:end]).digest()
+        offset += end - position
+        position = end
+
+
+class ChunkStore(object):
+    ''' Chunks of deduplicated uploads, file per chunk named by
+        its sha256 under *directory*. Chunks are never removed.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, digest):
+        name = digest.hex()
+        return os.path.join(self.directory, name[:2], name)
+
+    def missing(self, manifest):
+        ''' Indices of chunks of *manifest*, list of (digest, length),
+            which store lacks. Chunk repeated in manifest is listed once.
+        '''
+        result = []
+        seen = set()
+        for index, (digest, length) in enumerate(manifest):
+            if digest not in seen and not os.path.exists(self.path(digest)):
+                result.append(index)
+            seen.add(digest)
+        return result
+
+    def put(self, digest, data):
+        ''' Stores chunk *data*, already checked against *digest* '''
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under temporary name, so crash never leaves broken chunk
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with open(fd, 'wb', buffering=0) as f:
+                view = memoryview(data)
+                while len(view) > 0:
+                    view = view[f.write(view):]
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def rebuild(self, manifest, f):
+        ''' Writes file of *manifest* chunks into *f* '''
+        for digest, length in manifest:
+            with open(self.path(digest), 'rb', buffering=0) as chunk:
+                data = chunk.read(length + 1)
+            if len(data) != length:
+                raise ValueError('Stored chunk {} has wrong size'.format(digest.hex()))
+            view = memoryview(data)
+            while len(view) > 0:
+                view = view[f.write(view):]
@@ -0,0 +1,102 @@
+''' Wire formats shared by client and servers.
+
+    Plain upload: file bytes till EOF, as first versions did.
+
+    Range upload: RANGE_MAGIC, then any number of RANGE_HEADER
+    (transfer id, file size, offset, length) each followed by
+    *length* bytes of file. Ranges of one transfer may come over
+    several connections at once. After client shuts down its side,
+    server answers STATUS_OK, when all ranges were written.
+
+    Resumable upload: RESUME_MAGIC, HELLO (transfer id, file size,
+    chunk size, bitmask of codecs client may use). Server answers
+    STATUS_OK and OFFER (offset, bitmask of codecs it accepts), where
+    offset is up to which it already holds verified data of that
+    transfer, or STATUS_FAILED, when transfer is refused. Client sends
+    DATA (offset, length, crc32, codec, wire length) followed by
+    *wire length* bytes, compressed with codec (see compression.py),
+    from offered offset till end of file. Length and crc32 are of
+    uncompressed data. Server answers STATUS_OK after
+    last chunk, or STATUS_FAILED on checksum mismatch or refused
+    transfer and closes connection; client may then reconnect and
+    resume.
+
+    Batch upload: BATCH_MAGIC, then ENTRY (path length, file size,
+    mode) followed by relative path, '/' separated, and file bytes,
+    for every file, and ENTRY with zero path length at end. Entries
+    are sent back to back, without waiting for server. Server answers
+    STATUS_OK, when all files were written.
+
+    Deduplicated upload: DEDUP_MAGIC, MANIFEST (file size, number of
+    chunks), then CHUNK_REF (sha256, length) of every content-defined
+    chunk of file in order (see dedup.py). Server answers STATUS_OK and
+    bitmap of chunks it lacks, one bit per chunk, first chunk in highest
+    bit of first byte, or STATUS_FAILED. Client sends bytes of those
+    chunks in order. Server answers STATUS_OK, when file was rebuilt
+    from its chunk store, or STATUS_FAILED, when chunk doesn't match
+    its hash.
+'''
+
+import hashlib
+import os
+import struct
+
+MAGIC_SIZE = 4
+RANGE_MAGIC = b'FTR\x01'
+
+RANGE_HEADER = struct.Struct('!16sQQQ')
+
+# Codecs were added to HELLO and OFFER, so magic changed: server
+# refuses clients of older layout instead of waiting for missing bytes
+RESUME_MAGIC = b'FTR\x05'
+OLD_RESUME_MAGIC = b'FTR\x02'
+
+HELLO = struct.Struct('!16sQIB')
+OFFER = struct.Struct('!QB')
+DATA = struct.Struct('!QIIBI')
+# Verified chunk in server journal: offset, length, crc32
+CHUNK = struct.Struct('!QII')
+
+BATCH_MAGIC = b'FTR\x03'
+
+ENTRY = struct.Struct('!HQI')
+
+DEDUP_MAGIC = b'FTR\x04'
+
+MANIFEST = struct.Struct('!QI')
+CHUNK_REF = struct.Struct('!32sI')
+
+# Longer manifests are refused, server keeps whole manifest in memory
+MAX_MANIFEST_CHUNKS = 2**20
+
+# Larger chunks are refused, server keeps whole chunk in memory
+MAX_CHUNK_SIZE = 2**24
+
+STATUS_OK = b'\x00'
+STATUS_FAILED = b'\x01'
+
+
+def recv_exactly(sock, size):
+    ''' Receives exactly *size* bytes. Returns None on EOF before
+        first byte, raises ConnectionError on EOF in the middle.
+    '''
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    filled = 0
+    while filled < size:
+        n = sock.recv_into(view[filled:])
+        if n == 0:
+            if filled == 0:
+                return None
+            raise ConnectionError('Connection closed after {} of {} bytes'.format(filled, size))
+        filled += n
+    return bytes(buffer)
+
+
+def transfer_id(path):
+    ''' Stable id of file *path*, so rerun of client resumes
+        same transfer, while changed file starts new one.
+    '''
+    stat = os.stat(path)
+    key = '{}\0{}\0{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha1(key.encode()).digest()[:16]
@@ -1,23 +1,335 @@
-#!/usr/bin/env python3 
+#!/usr/bin/env python3
 
+import argparse
+import errno
+import fcntl
+import itertools
+import os
+import queue
 import socket
-import sys
+import threading
 
 #SERVER_HOST = 'localhost'
 SERVER_HOST = '4.8.15.16'
 SERVER_PORT = 13337
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.bind((SERVER_HOST, SERVER_PORT))
-file_no = 0
-while True:
-    s.listen(1)
-    conn, addr = s.accept()
-    print('Connected by', addr)
-    with open('{}.raw'.format(file_no), 'wb') as f:
-        data = conn.recv(4096)
-        while len(data) > 0:
-            f.write(data)
-            data = conn.recv(4096)
-    conn.close()
-    file_no += 1
 
+# Bytes gathered in buffer before one write to disk
+BUFFER_SIZE = 2**22
+# Bytes moved by one splice(2) call
+SPLICE_BLOCK = 2**20
+# Filled buffers waiting for writer thread, 0 - write inline
+QUEUE_DEPTH = 4
+# Max bytes reserved ahead of writes, when file size is unknown
+PREALLOCATE_STEP = 2**26
+# Bytes written between fdatasync(2) calls of 'batch' durability
+SYNC_BYTES = 2**26
+
+# none - leave flushing to OS, close - fsync(2) complete file,
+# batch - also fdatasync(2) every SYNC_BYTES
+DURABILITY = ('none', 'close', 'batch')
+
+# splice(2) refuses such socket or file, so buffered path is used
+SPLICE_UNSUPPORTED = {errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP}
+
+file_numbers = itertools.count()
+
+
+def open_output_file(directory='.', suffix='.raw'):
+    ''' Creates next free N.raw file. File is created exclusively,
+        so concurrent connections, or other servers in same
+        directory, never get the same one. Returns (name, file).
+    '''
+    while True:
+        name = os.path.join(directory, '{}{}'.format(next(file_numbers), suffix))
+        try:
+            return name, open(name, 'xb', buffering=0)
+        except FileExistsError:
+            continue
+
+
+def make_output_directory(directory='.', suffix='.batch'):
+    ''' Same as open_output_file, but creates directory N.batch.
+        Returns its name.
+    '''
+    while True:
+        name = os.path.join(directory, '{}{}'.format(next(file_numbers), suffix))
+        try:
+            os.mkdir(name)
+            return name
+        except FileExistsError:
+            continue
+
+
+def write_all(f, view):
+    ''' Raw file may accept only part of data per write '''
+    while len(view) > 0:
+        view = view[f.write(view):]
+
+
+def pwrite_all(fd, view, offset):
+    ''' Writes whole *view* at *offset* of file *fd* '''
+    while len(view) > 0:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def preallocate(fd, size, offset=0):
+    ''' Reserves *size* bytes of file from *offset*, so writes
+        in any order don't fragment it
+    '''
+    try:
+        os.posix_fallocate(fd, offset, size)
+    except (OSError, AttributeError):
+        # Filesystem can't, file of right size is enough then
+        os.ftruncate(fd, offset + size)
+
+
+class WriteBehind(object):
+    ''' Writes received buffers to file in its own thread, so slow
+        disk doesn't stall socket. Reader takes free buffer, fills
+        it and queues it, writer thread writes and frees it. When
+        *depth* buffers are queued reader waits, so memory stays
+        bounded and sender is throttled by TCP window instead.
+    '''
+
+    def __init__(self, buffer_size=BUFFER_SIZE, depth=QUEUE_DEPTH,
+            durability='none', sync_bytes=SYNC_BYTES):
+        self.free = queue.Queue()
+        # One more buffer, which reader fills meanwhile
+        for k in range(depth + 1):
+            self.free.put(bytearray(buffer_size))
+        self.filled = queue.Queue(depth)
+        self.durability = durability
+        self.sync_bytes = sync_bytes
+        self.thread = None
+        self.error = None
+
+    def start(self, f, size=None):
+        ''' Starts writing to *f*, file of *size* bytes, if known '''
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(f, size))
+        self.thread.start()
+
+    def put(self, buffer, length):
+        ''' Queues first *length* bytes of *buffer* taken from free.
+            Buffer must be queued even when nothing is to be written,
+            writer frees it.
+        '''
+        self.filled.put((buffer, length))
+        if self.error is not None:
+            raise self.error
+
+    def finish(self):
+        ''' Waits till all queued buffers are written '''
+        self.filled.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self, f, size):
+        fd = f.fileno()
+        written = 0
+        reserved = 0
+        unsynced = 0
+        while True:
+            item = self.filled.get()
+            if item is None:
+                break
+            buffer, length = item
+            try:
+                # After error buffers are only freed, so reader never waits forever
+                if self.error is None:
+                    if written + length > reserved:
+                        # Size known upfront is reserved at once, else file
+                        # is doubled, by PREALLOCATE_STEP at most
+                        end = written + length
+                        reserved = max(size or 0, end + min(end, PREALLOCATE_STEP))
+                        preallocate(fd, reserved - written, written)
+                    write_all(f, memoryview(buffer)[:length])
+                    written += length
+                    unsynced += length
+                    if self.durability == 'batch' and unsynced >= self.sync_bytes:
+                        os.fdatasync(fd)
+                        unsynced = 0
+            except OSError as e:
+                self.error = e
+            finally:
+                self.free.put(buffer)
+
+        try:
+            if self.error is None:
+                if reserved > written:
+                    # Space reserved ahead is not part of file
+                    os.ftruncate(fd, written)
+                if self.durability != 'none':
+                    os.fsync(fd)
+        except OSError as e:
+            self.error = e
+
+
+def receive_buffered(conn, f, buffer):
+    ''' Receives into one reusable *buffer* and writes it to *f*
+        only when full, so there is a write per buffer,
+        not per recv. Returns number of bytes received.
+    '''
+    view = memoryview(buffer)
+    filled = 0
+    received = 0
+    while True:
+        n = conn.recv_into(view[filled:])
+        if n == 0:
+            break
+        filled += n
+        received += n
+        if filled == len(view):
+            write_all(f, view)
+            filled = 0
+
+    write_all(f, view[:filled])
+
+    return received
+
+
+def receive_splice(conn, f, block=SPLICE_BLOCK, progress=None):
+    ''' Moves data from socket to file through pipe with splice(2),
+        so it never enters user space. Returns number of bytes
+        received. *progress* (list) gets number of bytes written to
+        file so far, which caller needs, when splice(2) fails part way.
+    '''
+    if progress is None:
+        progress = [0]
+    read_end, write_end = os.pipe()
+    try:
+        try:
+            fcntl.fcntl(write_end, fcntl.F_SETPIPE_SZ, block)
+        except (OSError, AttributeError):
+            # Default pipe capacity still works, just more calls
+            pass
+
+        while True:
+            n = os.splice(conn.fileno(), write_end, block)
+            if n == 0:
+                break
+            left = n
+            try:
+                while left > 0:
+                    left -= os.splice(read_end, f.fileno(), left)
+            except OSError as e:
+                if e.errno not in SPLICE_UNSUPPORTED:
+                    raise
+                # Data already taken from socket must not stay in pipe
+                while left > 0:
+                    data = os.read(read_end, left)
+                    write_all(f, memoryview(data))
+                    left -= len(data)
+                progress[0] += n
+                raise
+            progress[0] += n
+    finally:
+        os.close(read_end)
+        os.close(write_end)
+
+    return progress[0]
+
+
+def receive_write_behind(conn, f, writer, size=None):
+    ''' Same as receive_buffered, but buffers are written by
+        *writer* (WriteBehind) while next ones are received.
+        Returns number of bytes received.
+    '''
+    writer.start(f, size)
+    received = 0
+    try:
+        while True:
+            buffer = writer.free.get()
+            view = memoryview(buffer)
+            filled = 0
+            try:
+                while filled < len(view):
+                    n = conn.recv_into(view[filled:])
+                    if n == 0:
+                        break
+                    filled += n
+            finally:
+                writer.put(buffer, filled)
+            received += filled
+            if filled < len(view):
+                break
+    finally:
+        writer.finish()
+
+    return received
+
+
+def receive_file(conn, f, buffer, use_splice=False):
+    ''' Receives whole stream of *conn* into file *f* '''
+    received = 0
+    if use_splice and hasattr(os, 'splice'):
+        progress = [0]
+        try:
+            return receive_splice(conn, f, progress=progress)
+        except OSError as e:
+            if e.errno not in SPLICE_UNSUPPORTED:
+                raise
+            # Refused, maybe part way: file position is after data written
+            received = progress[0]
+
+    return received + receive_buffered(conn, f, buffer)
+
+
+def create_listener(host, port, rcvbuf=None, backlog=1):
+    ''' Creates socket listening on (host, port) '''
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if rcvbuf:
+        # Set before listen, so window scale of accepted connections fits it
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    s.bind((host, port))
+    s.listen(backlog)
+    return s
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Receive files, save them as N.raw.')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--buffer-size', type=int, default=BUFFER_SIZE,
+            help='bytes gathered before write')
+    parser.add_argument('--rcvbuf', type=int, default=None,
+            help='socket receive buffer size (SO_RCVBUF)')
+    parser.add_argument('--splice', action='store_true',
+            help='move data from socket to file with splice(2)')
+    parser.add_argument('--queue-depth', type=int, default=QUEUE_DEPTH,
+            help='buffers waiting for writer thread, 0 - write inline')
+    parser.add_argument('--durability', choices=DURABILITY, default='none',
+            help="when to fsync(2): 'close' - once file is complete, "
+                 "'batch' - also every --sync-bytes")
+    parser.add_argument('--sync-bytes', type=int, default=SYNC_BYTES)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+
+    s = create_listener(arguments.host, arguments.port, arguments.rcvbuf)
+    print('Listening on {}:{}'.format(*s.getsockname()), flush=True)
+    if arguments.queue_depth > 0 and not arguments.splice:
+        writer = WriteBehind(arguments.buffer_size, arguments.queue_depth,
+                arguments.durability, arguments.sync_bytes)
+    else:
+        writer = None
+        buffer = bytearray(arguments.buffer_size)
+    while True:
+        conn, addr = s.accept()
+        print('Connected by', addr)
+        name, f = open_output_file()
+        with f:
+            if writer is not None:
+                receive_write_behind(conn, f, writer)
+            else:
+                receive_file(conn, f, buffer, arguments.splice)
+                if arguments.durability != 'none':
+                    # Inline paths only sync complete file
+                    os.fsync(f.fileno())
+        conn.close()
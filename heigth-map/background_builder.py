@@ -0,0 +1,96 @@
+import concurrent.futures
+import threading
+import traceback
+
+""" Runs CPU side builds of mesh and texture data in background thread,
+    keeping only the newest result. Builds, requested while previous
+    one still waits in queue, make it stale, so it is dropped.
+"""
+class BackgroundBuilder(object):
+
+    ''' Executor running builds '''
+    executor = None
+
+    ''' Guards all fields below '''
+    lock = None
+
+    ''' Generation of last requested build '''
+    requestedGeneration = 0
+    ''' Set of kinds requested by stale builds and not built yet '''
+    unbuiltKinds = None
+    ''' Whether worker is building now '''
+    building = False
+    ''' Dictionary kind -> (generation, payload) of completed
+        builds, not taken by OpenGL thread yet.
+    '''
+    completed = None
+    ''' Number of builds dropped as stale '''
+    droppedBuilds = 0
+
+    ''' Called from worker thread after every completed build '''
+    onCompleted = None
+
+    def __init__(self, onCompleted=None):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.unbuiltKinds = set()
+        self.completed = {}
+        self.onCompleted = onCompleted
+
+    def submit(self, kinds, function, *args):
+        ''' Queues build of *kinds* with function(kinds, *args).
+            *function* must return dictionary kind -> payload and
+            must not touch state changed by other threads, so
+            *args* should be snapshot of such state.
+        '''
+        with self.lock:
+            self.requestedGeneration += 1
+            generation = self.requestedGeneration
+            self.unbuiltKinds.update(kinds)
+
+        future = self.executor.submit(self.build, generation, function, args)
+        future.add_done_callback(self.reportError)
+
+    def build(self, generation, function, args):
+        with self.lock:
+            if generation != self.requestedGeneration:
+                self.droppedBuilds += 1
+                return
+#           Newest snapshot is fine for kinds of dropped builds too
+            kinds = self.unbuiltKinds
+            self.unbuiltKinds = set()
+            self.building = True
+
+        payloads = {}
+        try:
+            payloads = function(kinds, *args)
+        finally:
+            with self.lock:
+                for kind, payload in payloads.items():
+                    self.completed[kind] = (generation, payload)
+                self.building = False
+
+        if self.onCompleted is not None:
+            self.onCompleted()
+
+    def reportError(self, future):
+        if future.exception() is not None:
+            traceback.print_exception(None, future.exception(), future.exception().__traceback__)
+
+    def take(self):
+        ''' Returns dictionary kind -> payload of builds completed
+            since last call.
+        '''
+        with self.lock:
+            completed = self.completed
+            self.completed = {}
+
+        return {kind: payload for kind, (generation, payload) in completed.items()}
+
+    def busy(self):
+        ''' Whether there are requested, but not taken builds '''
+        with self.lock:
+            return self.building or len(self.unbuiltKinds) > 0 or len(self.completed) > 0
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+''' Headless render benchmark.
+
+    Renders scene into framebuffer object of offscreen surface
+    along scripted camera path, sweeping grid sizes, multisampling
+    and water. By default forces software Mesa (llvmpipe), so numbers
+    are repeatable on CPU-only machines.
+
+    Usage: benchmark.py [--sizes 10,20,30,60] [--frames 60]
+                        [--width 640] [--height 480] [--instanced]
+                        [--hardware] [--no-program-cache]
+                        [--json FILE] [--csv FILE]
+'''
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='Headless render benchmark')
+parser.add_argument('--sizes', default='10,20,30,60', help='comma separated grid sizes')
+parser.add_argument('--frames', type=int, default=60, help='frames per configuration')
+parser.add_argument('--width', type=int, default=640)
+parser.add_argument('--height', type=int, default=480)
+parser.add_argument('--instanced', action='store_true', help='draw instanced columns')
+parser.add_argument('--hardware', action='store_true', help="don't force software rendering")
+parser.add_argument('--no-program-cache', action='store_true', help='compile programs from source')
+parser.add_argument('--json', help='save results as JSON')
+parser.add_argument('--csv', help='save results as CSV')
+
+# Must be set before Qt and Mesa are loaded
+def forceSoftwareRendering():
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+    os.environ['GALLIUM_DRIVER'] = 'llvmpipe'
+
+if __name__ == '__main__':
+    arguments = parser.parse_args()
+    if not arguments.hardware: forceSoftwareRendering()
+
+from PyQt5.QtGui import (
+        QGuiApplication, QOffscreenSurface, QOpenGLContext, QSurfaceFormat,
+        QOpenGLFramebufferObject, QOpenGLFramebufferObjectFormat, QVector2D
+        )
+
+import openglwindow
+import logical_resources
+import opengl_resources
+import program_cache
+import renderer
+import telemetry
+
+""" Camera path: (degrees left/right, degrees up/down, zoom) per frame """
+CameraPath = [(3, 0, 0)] * 20 + [(0, 1, 0.02)] * 10 + [(2, -1, -0.02)] * 10
+
+
+""" Drives renderer.Renderer against framebuffer object of
+    offscreen surface and measures frame, mesh build and
+    upload time.
+"""
+class Benchmark(object):
+
+    ''' Size of rendered frame '''
+    width = 640
+    height = 480
+
+    ''' Draw instanced columns instead of meshes '''
+    instancedColumns = False
+
+    ''' Offscreen surface and its context '''
+    surface = None
+    context = None
+
+    ''' OpenGL functions of *context* '''
+    gl = None
+
+    logicalResources = None
+    openglResources = None
+    renderer = None
+
+    ''' telemetry.Telemetry, which keeps samples of every configuration '''
+    telemetry = None
+
+    ''' Milliseconds from benchmark start till resources are ready '''
+    startupTime = None
+
+    def __init__(self, width=640, height=480, instancedColumns=False, useProgramCache=True):
+        start = time.perf_counter()
+        self.width = width
+        self.height = height
+        self.instancedColumns = instancedColumns
+        self.telemetry = telemetry.Telemetry()
+        self.telemetry.enabled = True
+        self.telemetry.windowSize = None
+
+        format = QSurfaceFormat()
+        format.setDepthBufferSize(24)
+
+        self.surface = QOffscreenSurface()
+        self.surface.setFormat(format)
+        self.surface.create()
+
+        self.context = QOpenGLContext()
+        self.context.setFormat(format)
+        assert self.context.create(), "Can't create OpenGL context =\\"
+        assert self.context.makeCurrent(self.surface), "Can't make OpenGL context current =\\"
+
+        self.gl = openglwindow.createGlFunctions(self.context)
+
+        self.logicalResources = logical_resources.Resources()
+        self.openglResources = opengl_resources.Resources(self.logicalResources, instancedColumns)
+        if useProgramCache and program_cache.programBinarySupported(self.context):
+            self.openglResources.programCache = program_cache.ProgramCache(self.gl)
+        self.openglResources.initialize(self.gl)
+        self.renderer = renderer.Renderer(self.logicalResources, self.openglResources)
+
+        self.gl.glClearColor(*self.logicalResources.clearColor)
+        self.gl.glFinish()
+        self.startupTime = 1000 * (time.perf_counter() - start)
+
+    def rendererString(self):
+        return self.gl.glGetString(self.gl.GL_RENDERER)
+
+    def setGridSize(self, size):
+        ''' Generates *size* x *size* landscape, rebuilds and uploads
+            meshes. Returns (build, upload) time in milliseconds.
+        '''
+        gl = self.gl
+        resources = self.logicalResources
+        resources.n = resources.m = size
+        resources.landscapeHeightsMatrix = resources.generateLandscapeHeightsMatrix()
+        resources.generateWaterHeightsMatrix()
+        self.renderer.uniforms['Delta'] = QVector2D(1/resources.m, 1/resources.n)
+
+        kinds = {'heights'}
+        if not self.instancedColumns: kinds |= {'landscape', 'water'}
+
+        start = time.perf_counter()
+        payloads = self.openglResources.buildMeshesAndHeightsTextureData(kinds, resources.n, resources.m,
+                resources.landscapeHeightsMatrix, resources.waterHeightsMatrix)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.openglResources.uploadPayloads(gl, payloads)
+        gl.glFinish()
+        upload = time.perf_counter() - start
+
+        return 1000 * build, 1000 * upload
+
+    def createTargetFramebuffer(self, multisample):
+        format = QOpenGLFramebufferObjectFormat()
+        format.setAttachment(QOpenGLFramebufferObject.CombinedDepthStencil)
+        format.setSamples(4 if multisample else 0)
+        framebuffer = QOpenGLFramebufferObject(self.width, self.height, format)
+        assert framebuffer.isValid(), "Can't create target framebuffer =\\"
+
+        return framebuffer
+
+    def run(self, name, frames, multisample, water):
+        ''' Renders *frames* along camera path, records frame
+            times under *name*.
+        '''
+        gl = self.gl
+        resources = self.logicalResources
+        eye, up = resources.eye, resources.up
+
+        framebuffer = self.createTargetFramebuffer(multisample)
+        self.renderer.targetFramebuffer = framebuffer
+        self.renderer.multisample = multisample
+
+        for frame in range(frames):
+            leftRight, upDown, zoom = CameraPath[frame % len(CameraPath)]
+            resources.rotateLeftRight(leftRight)
+            resources.rotateUpDown(upDown)
+            resources.moveForwardBackward(zoom)
+
+            start = time.perf_counter()
+            assert framebuffer.bind()
+            gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+            self.renderer.render(gl, self.width, self.height, render_water=water)
+#           Waiting for GPU, otherwise only command submission is measured
+            gl.glFinish()
+            self.telemetry.record(name, 1000 * (time.perf_counter() - start), frame)
+
+        framebuffer.release()
+        self.renderer.targetFramebuffer = None
+        resources.eye, resources.up = eye, up
+
+    def sweep(self, sizes, frames):
+        ''' Returns list of result dictionaries for every
+            grid size and toggles combination.
+        '''
+        results = []
+        for size in sizes:
+            build, upload = self.setGridSize(size)
+            for multisample in [False, True]:
+                for water in [False, True]:
+                    name = 'size={} multisample={} water={}'.format(size, int(multisample), int(water))
+                    self.run(name, frames, multisample, water)
+                    p50, p95, p99 = self.telemetry.percentiles(name)
+                    results.append({
+                        'size': size,
+                        'multisample': multisample,
+                        'water': water,
+                        'instanced': self.instancedColumns,
+                        'frames': frames,
+                        'frame p50 ms': p50,
+                        'frame p95 ms': p95,
+                        'frame p99 ms': p99,
+                        'build ms': build,
+                        'upload ms': upload
+                        })
+                    printResult(results[-1])
+
+        return results
+
+
+def printResult(result):
+    print('{size:>4} {ms:>3} {water:>5} {p50:>9.2f} {p95:>9.2f} {p99:>9.2f} {build:>9.2f} {upload:>9.2f}'.format(
+        size=result['size'], ms=int(result['multisample']), water=int(result['water']),
+        p50=result['frame p50 ms'], p95=result['frame p95 ms'], p99=result['frame p99 ms'],
+        build=result['build ms'], upload=result['upload ms']))
+    sys.stdout.flush()
+
+def save(results, filename, renderer):
+    if filename.endswith('.json'):
+        with open(filename, 'w') as f:
+            json.dump({'renderer': renderer, 'results': results}, f, indent=2)
+    else:
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == '__main__':
+    app = QGuiApplication(sys.argv[:1])
+
+    benchmark = Benchmark(arguments.width, arguments.height, arguments.instanced, not arguments.no_program_cache)
+    print('Renderer: {}'.format(benchmark.rendererString()))
+    print('Startup: {:.0f} ms, programs: {}'.format(benchmark.startupTime,
+        ', '.join('{} {:.1f} ms from {}'.format(name, ms, source)
+            for name, (ms, source) in sorted(benchmark.openglResources.programLinkTimes.items()))))
+    print('{:>4} {:>3} {:>5} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'size', 'ms', 'water', 'p50 ms', 'p95 ms', 'p99 ms', 'build ms', 'upload ms'))
+
+    results = benchmark.sweep([int(size) for size in arguments.sizes.split(',')], arguments.frames)
+
+    if arguments.json: save(results, arguments.json, benchmark.rendererString())
+    if arguments.csv: save(results, arguments.csv, benchmark.rendererString())
+
+    benchmark.openglResources.builder.shutdown()
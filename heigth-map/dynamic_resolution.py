@@ -0,0 +1,105 @@
+import collections
+
+""" Chooses size of offscreen (refraction and depth) framebuffers,
+    lowering it while frames take longer than target frame time
+    and raising it back, when there is enough headroom.
+
+    Hysteresis: size goes down only when average of recent frames
+    exceeds target by *lowerMargin*, goes up only when it is below
+    target by *raiseMargin*, and after any change frame times are
+    collected anew for *cooldownFrames* frames.
+
+    Frames may be slow for reasons size doesn't affect (CPU bound
+    ones), so lowering, which didn't make frames faster by *minGain*,
+    is undone and size isn't lowered below that one again, till
+    frames get fast enough to raise it.
+"""
+class DynamicResolution(object):
+
+    ''' Whether size is adapted, else *fixedSize* is used '''
+    enabled = True
+
+    ''' Allowed framebuffer sizes in ascending order '''
+    sizes = [128, 192, 256, 384, 512, 768, 1024]
+    ''' Size used while disabled '''
+    fixedSize = 512
+
+    ''' Frame time in seconds to hold '''
+    targetFrameTime = 1/60
+
+    ''' Size is lowered, when average frame time is above
+        targetFrameTime * (1 + lowerMargin)
+    '''
+    lowerMargin = 0.15
+    ''' Size is raised, when average frame time is below
+        targetFrameTime * (1 - raiseMargin)
+    '''
+    raiseMargin = 0.35
+
+    ''' Part of frame time lowering size must save to be kept '''
+    minGain = 0.1
+
+    ''' Number of frames averaged before decision '''
+    sampleFrames = 15
+    ''' Number of frames ignored after size change '''
+    cooldownFrames = 30
+
+    ''' Index of current size in *sizes* '''
+    level = None
+    ''' Recent frame times '''
+    frameTimes = None
+    ''' Frames left till cooldown ends '''
+    cooldown = 0
+    ''' Lowest index size may be lowered to '''
+    floor = 0
+    ''' Average frame time before last lowering, None - not checked
+        yet or last change was not lowering
+    '''
+    lowered = None
+
+    ''' Number of size changes made '''
+    changes = 0
+
+    def __init__(self, targetFrameTime=None):
+        if targetFrameTime is not None: self.targetFrameTime = targetFrameTime
+        self.level = self.sizes.index(self.fixedSize)
+        self.frameTimes = collections.deque(maxlen=self.sampleFrames)
+
+    def size(self):
+        ''' Current framebuffer size '''
+        return self.sizes[self.level] if self.enabled else self.fixedSize
+
+    def update(self, frameTime):
+        ''' Accounts *frameTime* (seconds) of last frame and
+            returns framebuffer size to use for next one.
+        '''
+        if not self.enabled or frameTime is None: return self.size()
+
+        if self.cooldown > 0:
+            self.cooldown -= 1
+            return self.size()
+
+        self.frameTimes.append(frameTime)
+        if len(self.frameTimes) < self.sampleFrames: return self.size()
+
+        average = sum(self.frameTimes) / len(self.frameTimes)
+        level = self.level
+        lowered, self.lowered = self.lowered, None
+        if average < self.targetFrameTime * (1 - self.raiseMargin):
+            self.floor = 0
+            level = min(len(self.sizes) - 1, level + 1)
+        elif lowered is not None and average > lowered * (1 - self.minGain):
+#           Smaller size didn't help, going back
+            level = min(len(self.sizes) - 1, level + 1)
+            self.floor = level
+        elif average > self.targetFrameTime * (1 + self.lowerMargin) and level > self.floor:
+            level -= 1
+            self.lowered = average
+
+        if level != self.level:
+            self.level = level
+            self.changes += 1
+            self.cooldown = self.cooldownFrames
+            self.frameTimes.clear()
+
+        return self.size()
@@ -0,0 +1,74 @@
+import collections
+import time
+
+""" Accumulates landscape edits made by input events between
+    frames, so they are applied to model and meshes once per frame,
+    however fast user scrolls or presses keys.
+"""
+class EditQueue(object):
+
+    ''' Dictionary (i, j) -> accumulated landscape height change '''
+    heightDeltas = None
+
+    ''' Accumulated change of number of rows and columns '''
+    resize = (0, 0)
+
+    ''' Times of recent rebuilds, to compute rebuild rate '''
+    rebuildTimes = None
+
+    ''' Number of edits queued and number of rebuilds made '''
+    edits = 0
+    rebuilds = 0
+
+    def __init__(self):
+        self.heightDeltas = collections.defaultdict(int)
+        self.rebuildTimes = collections.deque()
+
+    def changeHeight(self, i, j, dh):
+        self.heightDeltas[i, j] += dh
+        self.edits += 1
+
+    def expand(self, dn, dm):
+        self.resize = (self.resize[0] + dn, self.resize[1] + dm)
+        self.edits += 1
+
+    def empty(self):
+        return len(self.heightDeltas) == 0 and self.resize == (0, 0)
+
+    def apply(self, logicalResources):
+        ''' Applies queued edits to *logicalResources*. Height
+            changes go first, as cells were picked on current grid.
+            Returns (list of changed cells, whether grid was resized).
+        '''
+        changedCells = []
+        for (i, j), dh in self.heightDeltas.items():
+            if dh == 0: continue
+            logicalResources.changeLandscapeHeight(i, j, dh)
+            changedCells.append((i, j))
+
+#       Clamping, otherwise whole accumulated resize would be refused
+        dn, dm = self.resize
+        dn = max(1, min(30, logicalResources.n + dn)) - logicalResources.n
+        dm = max(1, min(30, logicalResources.m + dm)) - logicalResources.m
+        resized = dn != 0 or dm != 0
+        if resized:
+            logicalResources.expandLandscapeHeightsMatrix(dn, dm)
+
+        self.clear()
+
+        return changedCells, resized
+
+    def clear(self):
+        self.heightDeltas.clear()
+        self.resize = (0, 0)
+
+    def recordRebuild(self):
+        self.rebuilds += 1
+        self.rebuildTimes.append(time.perf_counter())
+
+    def rebuildsPerSecond(self):
+        ''' Number of rebuilds during last second '''
+        now = time.perf_counter()
+        while len(self.rebuildTimes) > 0 and now - self.rebuildTimes[0] > 1:
+            self.rebuildTimes.popleft()
+        return len(self.rebuildTimes)
@@ -24,7 +24,12 @@ import openglwindow
 import logical_resources
 import opengl_resources
 import renderer
-import solver
+import picking
+import dynamic_resolution
+import program_cache
+import edit_queue
+import solver_process
+import telemetry
 app = None
 class WaterWindow(openglwindow.OpenGLWindow):
 
@@ -37,60 +42,107 @@ class WaterWindow(openglwindow.OpenGLWindow):
     """ Object dealing with rendering logic. """
     renderer = None
 
-    """ Object implementing core algo. """
-    solver = None
+    """ picking.Picker of landscape cells """
+    picker = None
+
+    """ telemetry.Telemetry of frame time """
+    telemetry = None
+
+    """ dynamic_resolution.DynamicResolution of refraction and 
+        depth framebuffers 
+    """
+    resolution = None
 
-    """ Time, when last algo step had place. """
-    timeOfLastSolverStep = None
+    """ edit_queue.EditQueue of landscape edits waiting for next frame """
+    edits = None
+
+    """ solver_process.SolverProcess running core algo. """
+    solver = None
 
-    drawRefraction = False
+    """ Whether linked GLSL programs are cached on disk """
+    useProgramCache = True
 
-    drawDepth = False
+    """ Time of window creation, to measure startup """
+    creationTime = None
 
-    def __init__(self):
+    def __init__(self, instancedColumns=False, useProgramCache=True):
         super(WaterWindow, self).__init__()
+        self.creationTime = time.perf_counter()
+        self.useProgramCache = useProgramCache
 
         self.logicalResources = logical_resources.Resources()
-        self.openglResources = opengl_resources.Resources(self.logicalResources)
+        self.openglResources = opengl_resources.Resources(self.logicalResources, instancedColumns)
         self.renderer = renderer.Renderer(self.logicalResources, self.openglResources)
+        self.picker = picking.Picker(self.logicalResources, self.openglResources)
+#       Uncapped window still aims at default target frame time
+        self.resolution = dynamic_resolution.DynamicResolution(1 / self.targetFps if self.targetFps else None)
+        self.edits = edit_queue.EditQueue()
+
+        self.telemetry = telemetry.Telemetry()
+        self.telemetry.gpuFrameTimed = self.resolution.enabled
+        self.renderer.telemetry = self.telemetry
+        self.openglResources.telemetry = self.telemetry
+
+        self.openglResources.builder.onCompleted = self.renderLaterFromThread
 
     def initialize(self, gl):
         gl.glClearColor(*self.logicalResources.clearColor)
 
+        self.telemetry.gpuTimersSupported = (self.m_context.format().version() >= (3, 3)
+                or self.m_context.hasExtension(b'GL_ARB_timer_query'))
+
+        if self.useProgramCache and program_cache.programBinarySupported(self.m_context):
+            self.openglResources.programCache = program_cache.ProgramCache(gl)
+
         self.openglResources.initialize(gl)
 
     def keyPressEvent(self, event):
 
         if event.key() == Qt.Key_Enter or event.key() == Qt.Key_Return:
-            self.m_context.makeCurrent(self)
             if self.solver:
 #               If solver alredy working - go to end in one step                
-                self.stepSolver(self.m_gl, proceedTillEnd=True)
+                self.solver.skipToEnd()
             else:
-                self.solver = solver.Solver(self.logicalResources.landscapeHeightsMatrix).compute()
-                self.timeOfLastSolverStep = time.time() 
+                self.solver = solver_process.SolverProcess(self.logicalResources.landscapeHeightsMatrix)
         elif event.key() == Qt.Key_Escape:
             self.logicalResources.saveLandscapeHeightsMatrix()
+            self.openglResources.builder.shutdown()
+            print(self.schedulerReport())
+            print(self.picker.latencyReport())
+            if self.solver: self.solver.close()
             app.exit()
         elif event.key() == Qt.Key_Space:
 #           Clearing water            
+            if self.solver: self.solver.close()
             self.solver = None
-            self.timeOfLastSolverStep = None
-            self.m_context.makeCurrent(self)
             self.logicalResources.generateWaterHeightsMatrix()
-            self.openglResources.updateMeshesAndHeightsTexture(self.m_gl, landscape=False)
+            self.openglResources.requestMeshesAndHeightsTexture(landscape=False)
         elif event.key() == Qt.Key_PageUp:
             self.logicalResources.moveForwardBackward(0.25)
         elif event.key() == Qt.Key_PageDown:
             self.logicalResources.moveForwardBackward(-0.25)
         elif event.key() == Qt.Key_M:
             self.renderer.multisample = not self.renderer.multisample
+        elif event.key() == Qt.Key_L:
+            self.renderer.levelOfDetail = not self.renderer.levelOfDetail
+        elif event.key() == Qt.Key_C:
+            self.renderer.cacheOffscreenPasses = not self.renderer.cacheOffscreenPasses
+        elif event.key() == Qt.Key_Z:
+            self.resolution.enabled = not self.resolution.enabled
+            self.telemetry.gpuFrameTimed = self.resolution.enabled
+        elif event.key() == Qt.Key_P:
+            self.picker.usePixelBuffer = not self.picker.usePixelBuffer
+        elif event.key() == Qt.Key_T and event.modifiers() & Qt.ShiftModifier:
+            self.telemetry.export('telemetry.csv')
+            self.telemetry.export('telemetry.json')
+        elif event.key() == Qt.Key_T:
+            self.telemetry.enabled = not self.telemetry.enabled
+        elif event.key() == Qt.Key_D and event.modifiers() & Qt.ShiftModifier:
+            self.toggleOverlay('shadow')
         elif event.key() == Qt.Key_D:
-            self.drawRefraction = False
-            self.drawDepth = not self.drawDepth
+            self.toggleOverlay('depth')
         elif event.key() == Qt.Key_R:
-            self.drawDepth = False
-            self.drawRefraction = not self.drawRefraction
+            self.toggleOverlay('refraction')
         elif event.key() == Qt.Key_F1:
             QMessageBox.information(None, 'Controls', """
 
@@ -113,7 +165,21 @@ Esc - exit, obviously.
 
 M - toggle multisampling.
 
+L - toggle simplified drawing of distant landscape parts.
+
+C - toggle reuse of depth and refraction passes of unchanged scene.
+
+Z - toggle dynamic resolution of refraction and depth framebuffers.
+
+P - toggle picking of landscape cells between framebuffer readback
+    and CPU ray casting.
+
+T - toggle frame time telemetry. Shift + T - save it to 
+    telemetry.csv and telemetry.json.
+
 D, R - draw additional framebuffers (depth and refraction).
+
+Shift + D - draw depth component of depth framebuffer.
             
             """)
         elif self.solver is None:
@@ -127,9 +193,7 @@ D, R - draw additional framebuffers (depth and refraction).
                     }
             expand = expandKeys.get(event.key())
             if expand is not None:
-                self.logicalResources.expandLandscapeHeightsMatrix(*expand)
-                self.m_context.makeCurrent(self)
-                self.openglResources.updateMeshesAndHeightsTexture(self.m_gl)
+                self.edits.expand(*expand)
 
         self.renderLater()
 
@@ -156,77 +220,130 @@ D, R - draw additional framebuffers (depth and refraction).
             self.logicalResources.moveForwardBackward(dy / 200.0)
         elif self.solver is None:
 #           Searching currently pointed landscape cell and changing it's height            
-            x = int((event.x() / self.width()) * self.openglResources.depthFramebuffer.width())
-            y = int((event.y() / self.height()) * self.openglResources.depthFramebuffer.height())
-            
-            image = self.openglResources.depthFramebuffer.toImage()
-            pixel = image.pixel(x, y)
-            if QtGui.qAlpha(pixel) != 0:
-#               In depthFramebuffer color texture indexes info coded as color                
-#               Maybe not so genious and handy, but pretty beautiful ;-)                
-                j = int((QtGui.qRed(pixel) / 256) * self.logicalResources.m)
-                i = int((QtGui.qGreen(pixel) / 256) * self.logicalResources.n)
-                self.logicalResources.changeLandscapeHeight(i, j, int(math.copysign(1, dy)))
-
-                self.m_context.makeCurrent(self)
-                self.openglResources.updateMeshesAndHeightsTexture(self.m_gl)
+#           (depthFramebuffer has indexes of cells coded as color)
+#           Maybe not so genious and handy, but pretty beautiful ;-)                
+            picks = self.picker.request(event.x(), event.y(), self.width(), self.height(), int(math.copysign(1, dy)))
+            self.queuePicks(picks)
 
         self.renderLater()
 
-    def stepSolver(self, gl, proceedTillEnd=False):
-        ''' Proceeds algo evaluation '''
-        heightsUpdated = False
+    def queuePicks(self, picks):
+        ''' Queues height changes of picked landscape cells '''
+        for dh, (i, j) in picks:
+            self.edits.changeHeight(i, j, dh)
 
-        while (self.timeOfLastSolverStep is not None
-                and (proceedTillEnd or time.time() - self.timeOfLastSolverStep >= 0.05)):
-            step = next(self.solver, None)
-            if step is None:
-                self.timeOfLastSolverStep = None
-                break
+    def applyEdits(self, gl):
+        ''' Applies edits queued since last frame with single
+            mesh and heights texture update.
+        '''
+        if self.edits.empty(): return
+        if self.solver is not None:
+#           Landscape is fixed while algo works
+            self.edits.clear()
+            return
 
-            stepWasMeaningful = True
+        changedCells, resized = self.edits.apply(self.logicalResources)
+        if resized or not self.openglResources.instancedColumns:
+            self.openglResources.requestMeshesAndHeightsTexture()
+        else:
+            for i, j in changedCells:
+                self.openglResources.updateHeightsTexel(gl, i, j)
+        self.edits.recordRebuild()
+
+    def pollSolver(self):
+        ''' Samples latest algo state '''
+        steps, waterHeightsMatrix = self.solver.poll()
+
+        for step in reversed(steps):
             if step[0] == 'Select':
                 self.logicalResources.selectedLandscapeCell = step[1][::-1]
-            elif step[0] == 'Zero':
-                p = step[1]
-                self.logicalResources.changeWaterHeight(p[0], p[1], 0)
-                heightsUpdated = True
-            elif step[0] == 'Lower height':
-                p = step[1]
-                self.logicalResources.changeWaterHeight(p[0], p[1], step[2])
-                heightsUpdated = True
-            else:
-                stepWasMeaningful = False
+                break
+
+        if waterHeightsMatrix is not None:
+            self.logicalResources.waterHeightsMatrix = waterHeightsMatrix
+            self.openglResources.requestMeshesAndHeightsTexture(landscape=False)
 
-            if stepWasMeaningful:
-                self.timeOfLastSolverStep = time.time()
-        
-        if heightsUpdated:
-            self.openglResources.updateMeshesAndHeightsTexture(gl, landscape=False)
+    def needsAnimation(self):
+#       Water waves move, solver proceeds, background builds and 
+#       pixel readbacks complete
+        return (self.solver is not None 
+                or self.openglResources.builder.busy()
+                or self.picker.busy())
 
     def render(self, gl):
-        if self.solver is not None:
-            self.stepSolver(gl)
+        self.telemetry.startFrame(gl)
+
+        with self.telemetry.cpu('cpu frame'):
+            if self.solver is not None:
+                self.pollSolver()
+
+            self.queuePicks(self.picker.collect(gl))
+            self.applyEdits(gl)
+
+            self.openglResources.uploadBuiltMeshesAndHeightsTexture(gl)
 
-        self.renderer.render(gl, self.width(), self.height(), render_water=(self.solver is not None))
+            self.openglResources.resizeOffscreenFramebuffers(gl, self.resolution.update(self.workFrameTime()))
+
+            self.renderer.render(gl, self.width(), self.height(), render_water=(self.solver is not None))
+
+            self.picker.readback(gl)
+
+        if self.m_frames == 0:
+            gl.glFinish()
+            print(self.startupReport())
+
+    def workFrameTime(self):
+        ''' Seconds of last frame without waiting for vsync: CPU time
+            till swapBuffers or GPU time of render passes, whichever
+            is longer. None till first frame.
+        '''
+        times = [t for t in (self.m_last_render_time, self.telemetry.lastGpuFrameTime) if t is not None]
+        return max(times) if len(times) > 0 else None
+
+    def startupReport(self):
+        ''' Time till first frame and how programs were linked '''
+        links = self.openglResources.programLinkTimes
+        return 'First frame after {:.0f} ms, programs linked in {:.0f} ms ({})'.format(
+                1000 * (time.perf_counter() - self.creationTime),
+                sum(ms for ms, source in links.values()),
+                ', '.join('{} from {}'.format(name, source) for name, (ms, source) in sorted(links.items())))
+
+    def toggleOverlay(self, name):
+        ''' Shows or hides intermediate buffer *name* over window '''
+        if name in self.renderer.overlays:
+            self.renderer.overlays.remove(name)
+        else:
+            self.renderer.overlays.append(name)
 
     def paint(self, painter):
         ''' Draws additional data over window '''
-        if self.drawRefraction:
-            target = QRectF(0, 0, 256, 256)
-            source = QRectF(0, 0, self.openglResources.refractionFramebuffer.width()
-                                , self.openglResources.refractionFramebuffer.height())
-            painter.drawImage(target, self.openglResources.refractionFramebuffer.toImage(), source)
-            painter.drawRect(target)
-
-        if self.drawDepth:
-            target = QRectF(0, 0, 256, 256)
-            source = QRectF(0, 0, self.openglResources.depthFramebuffer.width()
-                                , self.openglResources.depthFramebuffer.height())
-            painter.drawImage(target, self.openglResources.depthFramebuffer.toImage(), source)
-            painter.drawRect(target)
+#       Overlays themselves are drawn by renderer
+        for name, rect in self.renderer.overlayRects():
+            painter.drawRect(rect)
 
         self.drawInstructions(painter)
+        if self.telemetry.enabled:
+            self.drawTelemetry(painter)
+
+    def drawTelemetry(self, painter):
+        ''' Draws frame time percentiles under instructions '''
+        font = QFont("Monospace", 10)
+        font.setStyleHint(QFont.TypeWriter)
+        metrics = QFontMetrics(font)
+        lines = self.telemetry.hudLines() + [
+                'offscreen buffers {0}x{0}'.format(self.openglResources.offscreenFramebufferSize),
+                'skipped passes: depth {depth}, refraction {refraction}'.format(**self.renderer.skippedPasses),
+                'rebuilds/s {}, edits {}, rebuilds {}'.format(self.edits.rebuildsPerSecond(), self.edits.edits, self.edits.rebuilds)
+                ]
+
+        width = max(metrics.width(line) for line in lines) + 8
+        height = metrics.lineSpacing() * len(lines) + 8
+        top = int(self.height()*0.125)
+        painter.setFont(font)
+        painter.fillRect(QRect(self.width() - width, top, width, height), QColor(0, 0, 0, 127))
+        painter.setPen(Qt.white)
+        for k, line in enumerate(lines):
+            painter.drawText(self.width() - width + 4, top + 4 + metrics.ascent() + k*metrics.lineSpacing(), line)
 
     def drawInstructions(self, painter):
         text = 'Press F1 for controls'
@@ -256,11 +373,10 @@ if __name__ == '__main__':
     format.setDepthBufferSize(24)
     format.setOption(QSurfaceFormat.DebugContext)
 
-    window = WaterWindow()
+    window = WaterWindow(instancedColumns='--instanced' in sys.argv, 
+            useProgramCache='--no-program-cache' not in sys.argv)
     window.setFormat(format)
     window.resize(640, 480)
     window.showMaximized()
 
-    window.setAnimating(True)
-
     sys.exit(app.exec_())
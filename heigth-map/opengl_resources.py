@@ -3,8 +3,12 @@ from itertools import repeat, islice, chain
 import math
 import random
 import struct
+import time
 import os.path
 
+from background_builder import BackgroundBuilder
+import telemetry
+
 from PyQt5.QtGui import (
         QImage, QOpenGLFramebufferObject,
         QOpenGLBuffer, QOpenGLTexture,
@@ -14,6 +18,34 @@ from PyQt5.QtGui import (
 """ Landscape height scale """
 ZScale = 1/60
 
+""" Number of landscape cells along side of mesh chunk """
+ChunkSize = 8
+
+""" Number of landscape cells merged along side of one mesh cell
+    for each level of detail. Every step must divide ChunkSize.
+"""
+LevelOfDetailSteps = [1, 2, 4]
+
+""" Part of landscape or water mesh, drawn separately
+    to be culled or simplified when far away.
+"""
+class MeshChunk(object):
+
+    ''' Lower corner of chunk bounding box '''
+    lowerBound = None
+    ''' Upper corner of chunk bounding box '''
+    upperBound = None
+
+    ''' List of (first vertex, number of vertices) in mesh
+        vertex buffer for every level of detail.
+    '''
+    ranges = None
+
+    def __init__(self, lowerBound, upperBound):
+        self.lowerBound = lowerBound
+        self.upperBound = upperBound
+        self.ranges = []
+
 """ Keeps opengl objects """
 class Resources(object):
 
@@ -23,8 +55,14 @@ class Resources(object):
     waterProgram = None
     ''' Vertex Buffer Object with water mesh '''
     waterVBO = None
+    ''' Vertex Buffer Object, which receives next water mesh
+        built in background, while *waterVBO* is drawn.
+    '''
+    waterBackVBO = None
     ''' Number of verticies in water mesh '''
     numberOfWaterVertices = None
+    ''' List of MeshChunk of water mesh '''
+    waterChunks = None
 
     ''' GLSL program to draw simplified scene for use 
         as refraction
@@ -44,12 +82,23 @@ class Resources(object):
     ''' Texture of depth component '''
     depthTexture = None
 
+    ''' Side in pixels of *refractionFramebuffer* and 
+        *depthFramebuffer*, changed by *resizeOffscreenFramebuffers*
+    '''
+    offscreenFramebufferSize = 512
+
     ''' GLSL program to draw landscape '''
     landscapeProgram = None
     ''' Vertex Buffer Object with landscape mesh '''
     landscapeVBO = None
+    ''' Vertex Buffer Object, which receives next landscape mesh
+        built in background, while *landscapeVBO* is drawn.
+    '''
+    landscapeBackVBO = None
     ''' Number of verticies in landscape mesh '''
     numberOfLandscapeVertices = None
+    ''' List of MeshChunk of landscape mesh '''
+    landscapeChunks = None
 
     ''' Texture with information about landscape and 
         water heights. 
@@ -58,12 +107,54 @@ class Resources(object):
     '''
     heightsTexture = None
 
+    ''' Draw landscape and water as unit column instanced 
+        n*m times, displaced by heightsTexture in vertex shader,
+        instead of building meshes on CPU.
+    '''
+    instancedColumns = False
+    ''' Vertex Buffer Object with unit column mesh '''
+    columnVBO = None
+    ''' Number of verticies in unit column mesh '''
+    numberOfColumnVertices = None
+
+    ''' GLSL program to draw texture over window '''
+    overlayProgram = None
+    ''' Vertex Buffer Object with window covering quad '''
+    overlayVBO = None
+
+    ''' background_builder.BackgroundBuilder of meshes and 
+        heights texture data
+    '''
+    builder = None
+
+    ''' telemetry.Telemetry of mesh builds and uploads '''
+    telemetry = None
+
+    ''' Counters incremented whenever landscape or water data
+        on GPU changes, so renderer knows when cached passes
+        must be redrawn.
+    '''
+    landscapeGeneration = 0
+    waterGeneration = 0
+
+    ''' program_cache.ProgramCache of linked GLSL programs, 
+        None - always compile from source
+    '''
+    programCache = None
+    ''' Dictionary program name -> (link time in milliseconds, 
+        'cache' or 'source')
+    '''
+    programLinkTimes = None
+
     ''' logical_resources.Resources '''
     logicalResources = None
 
-    def __init__(self, logicalResources):
+    def __init__(self, logicalResources, instancedColumns=False):
         self.logicalResources = logicalResources
-
+        self.instancedColumns = instancedColumns
+        self.builder = BackgroundBuilder()
+        self.telemetry = telemetry.Telemetry()
+        self.programLinkTimes = {}
 
     def initialize(self, gl):
         """
@@ -71,16 +162,49 @@ class Resources(object):
         """
 
         self.waterProgram = self.linkProgram(gl, 'water')
-        self.waterVBO = QOpenGLBuffer(QOpenGLBuffer.VertexBuffer)
-        assert self.waterVBO.create(), "Can't create water vertex buffer =\\"
-        self.waterVBO.setUsagePattern(QOpenGLBuffer.DynamicDraw)
+        self.waterVBO = self.createVertexBuffer()
+        self.waterBackVBO = self.createVertexBuffer()
 
         self.waterRefractionProgram = self.linkProgram(gl, 'water-refraction')
-        self.refractionFramebuffer = self.createFramebuffer(gl, 512, depth=True)
         self.refractionNormalMap = self.createTexture(gl, wrapMode=QOpenGLTexture.Repeat, filename='normalmap.bmp')
 
         self.depthProgram = self.linkProgram(gl, 'depth')
-        self.depthFramebuffer = self.createFramebuffer(gl, 512)
+
+        self.resizeOffscreenFramebuffers(gl, self.offscreenFramebufferSize)
+
+        self.landscapeProgram = self.linkProgram(gl, 'landscape')
+        self.landscapeVBO = self.createVertexBuffer()
+        self.landscapeBackVBO = self.createVertexBuffer()
+
+        self.heightsTexture = self.createTexture(gl, self.logicalResources.m, self.logicalResources.n, 
+                format=QOpenGLTexture.RG32F, filter=QOpenGLTexture.Nearest)
+
+        if self.instancedColumns:
+            self.columnVBO = self.createVertexBuffer(QOpenGLBuffer.StaticDraw)
+            self.numberOfColumnVertices = self.generateColumnMesh(gl, self.columnVBO)
+
+        self.overlayProgram = self.linkProgram(gl, 'overlay', meshProgram=False)
+        self.overlayVBO = self.createVertexBuffer(QOpenGLBuffer.StaticDraw)
+        quad = struct.pack('8f', -1, -1,  1, -1,  -1, 1,  1, 1)
+        self.overlayVBO.bind()
+        self.overlayVBO.allocate(quad, len(quad))
+        self.overlayVBO.release()
+       
+        self.updateMeshesAndHeightsTexture(gl)
+
+    def resizeOffscreenFramebuffers(self, gl, size):
+        ''' (Re)creates refraction and depth framebuffers of
+            *size* x *size* pixels.
+        '''
+        if self.refractionFramebuffer is not None:
+            if self.refractionFramebuffer.width() == size: return
+#           Old framebuffers are deleted along with their wrappers
+            self.depthTexture.destroy()
+        self.offscreenFramebufferSize = size
+
+        self.refractionFramebuffer = self.createFramebuffer(gl, size, depth=True)
+
+        self.depthFramebuffer = self.createFramebuffer(gl, size)
         self.depthTexture = self.createTexture(gl, self.depthFramebuffer.width(), format=QOpenGLTexture.D32F, allocate=False,
                 GL_TEXTURE_COMPARE_MODE=gl.GL_COMPARE_REF_TO_TEXTURE,
                 GL_TEXTURE_COMPARE_FUNC=gl.GL_LESS)
@@ -93,69 +217,180 @@ class Resources(object):
         gl.glFramebufferTexture2D(gl.GL_FRAMEBUFFER, gl.GL_DEPTH_ATTACHMENT, gl.GL_TEXTURE_2D, self.depthTexture.textureId(), 0)
         assert self.depthFramebuffer.release()
 
-        self.landscapeProgram = self.linkProgram(gl, 'landscape')
-        self.landscapeVBO = QOpenGLBuffer(QOpenGLBuffer.VertexBuffer)
-        assert self.landscapeVBO.create(), "Can't create water vertex buffer =\\"
-        self.landscapeVBO.setUsagePattern(QOpenGLBuffer.DynamicDraw)
-
-        self.heightsTexture = self.createTexture(gl, self.logicalResources.m, self.logicalResources.n, 
-                format=QOpenGLTexture.RG32F, filter=QOpenGLTexture.Nearest)
-       
-        self.updateMeshesAndHeightsTexture(gl)
-
     def updateMeshesAndHeightsTexture(self, gl, water=True, landscape=True):
         ''' Updates water and/or landscape mesh when they have changed '''
-        if landscape:
-            self.numberOfLandscapeVertices = self.generateLandscapeMesh(gl, self.landscapeVBO)
-        if water:
-            self.numberOfWaterVertices = self.generateWaterMesh(gl, self.waterVBO)
+        if landscape and not self.instancedColumns:
+            self.numberOfLandscapeVertices, self.landscapeChunks = self.generateLandscapeMesh(gl, self.landscapeVBO)
+            self.landscapeGeneration += 1
+        if water and not self.instancedColumns:
+            self.numberOfWaterVertices, self.waterChunks = self.generateWaterMesh(gl, self.waterVBO)
+            self.waterGeneration += 1
         if water or landscape:
             self.updateHeightsTexture(gl)
+
+    def requestMeshesAndHeightsTexture(self, water=True, landscape=True):
+        ''' Same as *updateMeshesAndHeightsTexture*, but builds data 
+            in background. Doesn't require OpenGL context, result 
+            is uploaded by *uploadBuiltMeshesAndHeightsTexture*.
+        '''
+        if not (water or landscape): return
+
+        kinds = {'heights'}
+        if landscape and not self.instancedColumns: kinds.add('landscape')
+        if water and not self.instancedColumns: kinds.add('water')
+
+        self.builder.submit(kinds, self.buildMeshesAndHeightsTextureData,
+                self.logicalResources.n, self.logicalResources.m,
+                [row[:] for row in self.logicalResources.landscapeHeightsMatrix],
+                [row[:] for row in self.logicalResources.waterHeightsMatrix])
+
+    def buildMeshesAndHeightsTextureData(self, kinds, n, m, landscapeHeightsMatrix, waterHeightsMatrix):
+        ''' Builds data of *kinds* from snapshot of heights matrices.
+            Runs in background thread.
+        '''
+        payloads = {}
+        if 'landscape' in kinds:
+            with self.telemetry.cpu('cpu landscape build'):
+                payloads['landscape'] = self.buildLandscapeMesh(landscapeHeightsMatrix, dimensions=(n, m))
+        if 'water' in kinds:
+            with self.telemetry.cpu('cpu water build'):
+                payloads['water'] = self.buildLandscapeMesh(waterHeightsMatrix, landscapeHeightsMatrix, (n, m))
+        if 'heights' in kinds:
+            with self.telemetry.cpu('cpu heights build'):
+                payloads['heights'] = (n, m, self.buildHeightsTextureData(landscapeHeightsMatrix, waterHeightsMatrix))
+
+        return payloads
+
+    def uploadBuiltMeshesAndHeightsTexture(self, gl):
+        ''' Uploads the newest data built in background. 
+            Returns whether anything was uploaded.
+        '''
+        payloads = self.builder.take()
+        if len(payloads) == 0: return False
+
+        with self.telemetry.cpu('cpu upload'):
+            self.uploadPayloads(gl, payloads)
+
+        return True
+
+    def uploadPayloads(self, gl, payloads):
+        ''' Uploads built data to vertex buffers and heights texture '''
+        if 'landscape' in payloads:
+            numberOfVertices, chunks, data = payloads['landscape']
+            self.uploadMesh(gl, self.landscapeBackVBO, data)
+            self.landscapeVBO, self.landscapeBackVBO = self.landscapeBackVBO, self.landscapeVBO
+            self.numberOfLandscapeVertices, self.landscapeChunks = numberOfVertices, chunks
+            self.landscapeGeneration += 1
+        if 'water' in payloads:
+            numberOfVertices, chunks, data = payloads['water']
+            self.uploadMesh(gl, self.waterBackVBO, data)
+            self.waterVBO, self.waterBackVBO = self.waterBackVBO, self.waterVBO
+            self.numberOfWaterVertices, self.waterChunks = numberOfVertices, chunks
+            self.waterGeneration += 1
+        if 'heights' in payloads:
+            self.uploadHeightsTexture(gl, *payloads['heights'])
+
+    def updateHeightsTexel(self, gl, i, j):
+        ''' Updates single (i, j) cell of heights texture.
+            With instanced columns that is all needed to show
+            changed cell height, otherwise meshes are rebuilt.
+        '''
+        if not self.instancedColumns:
+            self.requestMeshesAndHeightsTexture()
+            return
+        if self.builder.busy():
+#           Otherwise texture built from older snapshot would overwrite edit
+            self.requestMeshesAndHeightsTexture()
+            return
+
+        data = array.array('f', [ self.logicalResources.landscapeHeightsMatrix[i][j] * ZScale
+                                , self.logicalResources.waterHeightsMatrix[i][j] * ZScale])
+        self.heightsTexture.bind()
+        gl.glTexSubImage2D(gl.GL_TEXTURE_2D, 0, j, i, 1, 1, QOpenGLTexture.RG, QOpenGLTexture.Float32, data)
+        self.heightsTexture.release()
+        self.landscapeGeneration += 1
+        self.waterGeneration += 1
  
     def updateHeightsTexture(self, gl):
         """
         Updates texture with landscape and water heights info
         """
+        self.uploadHeightsTexture(gl, self.logicalResources.n, self.logicalResources.m,
+                self.buildHeightsTextureData(self.logicalResources.landscapeHeightsMatrix, 
+                                             self.logicalResources.waterHeightsMatrix))
 
-        if (self.heightsTexture.width() != self.logicalResources.n or 
-                self.heightsTexture.height() != self.logicalResources.m):
+    def buildHeightsTextureData(self, landscapeHeightsMatrix, waterHeightsMatrix):
+        ''' Packs landscape and water heights as texture data '''
+        data = []
+        for landscapeRow, waterRow in zip(landscapeHeightsMatrix, waterHeightsMatrix):
+            for landscapeHeight, waterHeight in zip(landscapeRow, waterRow):
+                data.extend([landscapeHeight * ZScale, waterHeight * ZScale])
+        return struct.pack('{}f'.format(len(data)), *data)
+
+    def uploadHeightsTexture(self, gl, n, m, data):
+        ''' Uploads heights texture *data* for n x m landscape '''
+        if self.heightsTexture.width() != m or self.heightsTexture.height() != n:
             self.heightsTexture.destroy()
 
-            self.heightsTexture = self.createTexture(gl, self.logicalResources.m, self.logicalResources.n, 
+            self.heightsTexture = self.createTexture(gl, m, n, 
                     format=QOpenGLTexture.RG32F, filter=QOpenGLTexture.Nearest)
-    
-        data = []
-        for i in range(self.logicalResources.n):
-            for j in range(self.logicalResources.m):
-                data.extend([ self.logicalResources.landscapeHeightsMatrix[i][j] * ZScale
-                            , self.logicalResources.waterHeightsMatrix[i][j] * ZScale])
-        data = struct.pack('{}f'.format(len(data)), *data)
 
         self.heightsTexture.setData(QOpenGLTexture.RG, QOpenGLTexture.Float32, data)
+        self.waterGeneration += 1
+#       Instanced columns take landscape heights from texture too
+        if self.instancedColumns:
+            self.landscapeGeneration += 1
 
 
     def loadFile(self, name):
         ''' Loads whole file content as single string '''
         with open(name, 'r') as f: return ''.join(f)
     
-    def loadShaders(self, name):
+    def loadShaders(self, name, meshProgram=True):
         ''' Loads vertex and fragment shader '''
         vertexShaderSource = self.loadFile('{}/shaders/{}.vert'.format(Resources.directory, name))
+        if self.instancedColumns and meshProgram:
+#           Inserting instanced columns code right after #version line
+            version, _, body = vertexShaderSource.partition('\n')
+            vertexShaderSource = '\n'.join([version, '#define INSTANCED_COLUMNS',
+                self.loadFile('{}/shaders/columns.vert'.format(Resources.directory)), body])
         fragmentShaderSource = self.loadFile('{}/shaders/{}.frag'.format(Resources.directory, name))
 
         return vertexShaderSource, fragmentShaderSource
 
-    def linkProgram(self, gl, name, **kwargs):
-        ''' Links GLSL program from *name*.vert and *name*.frag shaders '''
+    def linkProgram(self, gl, name, meshProgram=True, **kwargs):
+        ''' Links GLSL program from *name*.vert and *name*.frag shaders.
+            *meshProgram* tells, whether program draws landscape or water.
+            Binary from *programCache* is used, when valid.
+        '''
+        start = time.perf_counter()
+        vertexShader, fragmentShader = self.loadShaders(name, meshProgram)
+
         program = QOpenGLShaderProgram()
+        source = 'source'
+        if self.programCache is not None:
+            key = self.programCache.key(vertexShader, fragmentShader)
+            assert program.create(), "Can't create ShaderProgram"
+            if self.programCache.load(gl, program, key):
+                source = 'cache'
+            else:
+#               Failed glProgramBinary may leave program unusable
+                program = QOpenGLShaderProgram()
+                assert program.create(), "Can't create ShaderProgram"
+                self.programCache.prepare(gl, program)
+
+        if source == 'source':
+            program.addShaderFromSourceCode(QOpenGLShader.Vertex,
+                    vertexShader)
+            program.addShaderFromSourceCode(QOpenGLShader.Fragment,
+                    fragmentShader)
+
+            assert program.link(), "Can't link ShaderProgram"
 
-        vertexShader, fragmentShader = self.loadShaders(name)
-        program.addShaderFromSourceCode(QOpenGLShader.Vertex,
-                vertexShader)
-        program.addShaderFromSourceCode(QOpenGLShader.Fragment,
-                fragmentShader)
+            if self.programCache is not None:
+                self.programCache.save(gl, program, key)
 
-        assert program.link(), "Can't link ShaderProgram"
+        self.programLinkTimes[name] = (1000 * (time.perf_counter() - start), source)
         assert program.bind(), "Can't bind ShaderProgram for initialization"
 
         for k, v in kwargs.items():
@@ -170,6 +405,14 @@ class Resources(object):
 
 
 
+    def createVertexBuffer(self, usagePattern=QOpenGLBuffer.DynamicDraw):
+        ''' Creates vertex buffer object '''
+        vbo = QOpenGLBuffer(QOpenGLBuffer.VertexBuffer)
+        assert vbo.create(), "Can't create vertex buffer =\\"
+        vbo.setUsagePattern(usagePattern)
+
+        return vbo
+
     def createFramebuffer(self, gl, dim, depth=False, filter=None, internalFormat=None, format=None, type=None):
         ''' Creates framebuffer object with required parameters '''
         if filter is None: filter = gl.GL_LINEAR
@@ -217,34 +460,113 @@ class Resources(object):
 
 
       
-    def safeLandscapeHeightsMatrixIndexer(self, i, j):
-        ''' Accesses landscapeHeightsMatrix preventing out of bound errors.
-            Used as z0 in *generateLandscapeMesh*.
+    def safeIndexer(self, matrix):
+        ''' Returns accessor to *matrix* preventing out of bound errors.
+            Used as z0 in *buildMeshTriangles*.
         '''
-        return self.logicalResources.landscapeHeightsMatrix[max(0, min(i, self.logicalResources.n-1))][max(0, min(j, self.logicalResources.m-1))]
+        n = len(matrix)
+        m = len(matrix[0])
+        return lambda i, j: matrix[max(0, min(i, n-1))][max(0, min(j, m-1))]
+
+    def mergeCells(self, matrix, step):
+        ''' Merges every *step* x *step* block of *matrix* cells 
+            into one cell with maximal height of block.
+        '''
+        if step == 1: return matrix
+
+        n = len(matrix)
+        m = len(matrix[0])
+        return [[max(matrix[i_][j_] 
+                        for i_ in range(i, min(i + step, n)) 
+                        for j_ in range(j, min(j + step, m)))
+                    for j in range(0, m, step)]
+                for i in range(0, n, step)]
 
     def generateWaterMesh(self, gl, vbo):
         ''' Generates water mesh '''
 #       reusing existing code        
-        return self.generateLandscapeMesh(gl, vbo, self.logicalResources.waterHeightsMatrix, self.safeLandscapeHeightsMatrixIndexer)
+        return self.generateLandscapeMesh(gl, vbo, self.logicalResources.waterHeightsMatrix, self.logicalResources.landscapeHeightsMatrix)
 
    
-    def generateLandscapeMesh(self, gl, vbo, matrix=None, z0=0):
+    def generateLandscapeMesh(self, gl, vbo, matrix=None, baseMatrix=None):
         ''' Generates landscape mesh, and stores in *vbo*.
-            Due similiarity also used for generating water mesh. 
+            Due similiarity also used for generating water mesh, 
+            lying on *baseMatrix*.
+            Returns total number of vertices and list of MeshChunk.
         '''
         if matrix is None: matrix = self.logicalResources.landscapeHeightsMatrix
 
-        vbo.bind()
+        numberOfVertices, chunks, data = self.buildLandscapeMesh(matrix, baseMatrix)
+        self.uploadMesh(gl, vbo, data)
+
+        return numberOfVertices, chunks
+
+    def buildLandscapeMesh(self, matrix, baseMatrix=None, dimensions=None):
+        ''' Builds landscape (or water, lying on *baseMatrix*) mesh 
+            split into chunks with all levels of detail.
+            Returns total number of vertices, list of MeshChunk 
+            and packed vertices, normals and vertices' indexes.
+        '''
+        if dimensions is None: dimensions = (self.logicalResources.n, self.logicalResources.m)
+        n, m = dimensions
+
+        if baseMatrix is None:
+            totalMatrix = matrix
+        else:
+            totalMatrix = [[baseMatrix[i][j] + matrix[i][j] for j in range(m)] for i in range(n)]
+
+#       Merged matrices and z0 for every level of detail
+        levels = []
+        for step in LevelOfDetailSteps:
+            if baseMatrix is None:
+                levels.append((self.mergeCells(matrix, step), 0))
+            else:
+#               Water of merged cell reaches the highest water surface of block
+                mergedBase = self.mergeCells(baseMatrix, step)
+                mergedTotal = self.mergeCells(totalMatrix, step)
+                merged = [[total - base for total, base in zip(totalRow, baseRow)] 
+                        for totalRow, baseRow in zip(mergedTotal, mergedBase)]
+                levels.append((merged, self.safeIndexer(mergedBase)))
+
+        vertices = []
+        normals = []
+        indexiesInMatrix = []
+        chunks = []
+        for i0 in range(0, n, ChunkSize):
+            for j0 in range(0, m, ChunkSize):
+                i1 = min(i0 + ChunkSize, n)
+                j1 = min(j0 + ChunkSize, m)
+                maxHeight = max(max(row[j0:j1]) for row in totalMatrix[i0:i1])
+                chunk = MeshChunk((j0/m, i0/n, 0), (j1/m, i1/n, maxHeight * ZScale))
+
+                for step, (merged, z0) in zip(LevelOfDetailSteps, levels):
+                    rows = range(i0 // step, min((i1 + step - 1) // step, len(merged)))
+                    columns = range(j0 // step, min((j1 + step - 1) // step, len(merged[0])))
+                    chunkVertices, chunkNormals, chunkIndexiesInMatrix = self.buildMeshTriangles(merged, z0, rows, columns, step, dimensions,
+                            finest=totalMatrix if step > 1 else None)
+
+                    chunk.ranges.append((len(vertices) // 3, len(chunkVertices) // 3))
+                    vertices.extend(chunkVertices)
+                    normals.extend(chunkNormals)
+                    indexiesInMatrix.extend(chunkIndexiesInMatrix)
+
+                chunks.append(chunk)
 
-        vertices, normals, indexiesInMatrix = self.buildMeshTriangles(matrix, z0)
         numberOfLandscapeVertices = len(vertices) // 3
         vertices = struct.pack('{}f'.format(len(vertices)), *vertices)
         normals = struct.pack('{}f'.format(len(normals)), *normals)
         indexiesInMatrix = struct.pack('{}f'.format(len(indexiesInMatrix)), *indexiesInMatrix)
         assert numberOfLandscapeVertices*3*4 == len(vertices)
+
+        return numberOfLandscapeVertices, chunks, (vertices, normals, indexiesInMatrix)
+
+    def uploadMesh(self, gl, vbo, data):
+        ''' Stores packed vertices, normals and vertices' indexes in *vbo* '''
+        vertices, normals, indexiesInMatrix = data
         size = len(vertices) + len(normals) + len(indexiesInMatrix)
 
+        vbo.bind()
+
         gl.glBufferData(gl.GL_ARRAY_BUFFER, size, None, gl.GL_DYNAMIC_DRAW)
         gl.glBufferSubData(gl.GL_ARRAY_BUFFER, 0, len(vertices), vertices)
         gl.glBufferSubData(gl.GL_ARRAY_BUFFER, len(vertices), len(normals), normals)
@@ -252,11 +574,54 @@ class Resources(object):
 
         vbo.release()
 
-        return numberOfLandscapeVertices
+    def generateColumnMesh(self, gl, vbo):
+        ''' Generates unit column mesh, and stores in *vbo*.
+            Top vertices have z == 1, bottom - z == 0, actual
+            heights are taken from heights texture in shader.
+        '''
+        faces = [
+#           top
+            (( 0, 0, 1), [(0, 0, 1), (1, 0, 1), (1, 1, 1), (0, 0, 1), (1, 1, 1), (0, 1, 1)]),
+#           left
+            ((-1, 0, 0), [(0, 0, 1), (0, 1, 1), (0, 1, 0), (0, 0, 1), (0, 1, 0), (0, 0, 0)]),
+#           right
+            (( 1, 0, 0), [(1, 1, 1), (1, 0, 1), (1, 0, 0), (1, 1, 1), (1, 0, 0), (1, 1, 0)]),
+#           up
+            ((0, -1, 0), [(1, 0, 1), (0, 0, 1), (0, 0, 0), (1, 0, 1), (0, 0, 0), (1, 0, 0)]),
+#           down
+            ((0,  1, 0), [(0, 1, 1), (1, 1, 1), (1, 1, 0), (0, 1, 1), (1, 1, 0), (0, 1, 0)]),
+#           bottom
+            ((0, 0, -1), [(0, 0, 0), (0, 1, 0), (1, 0, 0), (1, 0, 0), (0, 1, 0), (1, 1, 0)]),
+            ]
+
+        positions = []
+        normals = []
+        for normal, vertices in faces:
+            for vertex in vertices:
+                positions.extend(vertex)
+                normals.extend(normal)
+        numberOfColumnVertices = len(positions) // 3
+
+        positions = struct.pack('{}f'.format(len(positions)), *positions)
+        normals = struct.pack('{}f'.format(len(normals)), *normals)
 
-    def buildMeshTriangles(self, matrix, z0):
+        vbo.bind()
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, len(positions) + len(normals), None, gl.GL_STATIC_DRAW)
+        gl.glBufferSubData(gl.GL_ARRAY_BUFFER, 0, len(positions), positions)
+        gl.glBufferSubData(gl.GL_ARRAY_BUFFER, len(positions), len(normals), normals)
+        vbo.release()
+
+        return numberOfColumnVertices
+
+    def buildMeshTriangles(self, matrix, z0, rows=None, columns=None, step=1, dimensions=None, finest=None):
         ''' Generates lists of vertices, normals and vertices' indexes
             of mesh (landscape or water).
+            *rows* and *columns* limit mesh to part of *matrix*, 
+            *step* is number of landscape cells merged into one 
+            cell of *matrix*, *dimensions* - size of whole landscape.
+            *finest* - unmerged surface heights, walls on border of 
+            *rows* and *columns* go down to the lowest of them, so 
+            neighbour chunk drawn with finer level leaves no cracks.
         '''
 
 #       Used for landscape mesh, when z0 is always constant 0
@@ -265,24 +630,28 @@ class Resources(object):
 
 
         triangles = []
-        n = self.logicalResources.n
-        m = self.logicalResources.m
+        n = len(matrix)
+        m = len(matrix[0])
+        if rows is None: rows = range(n)
+        if columns is None: columns = range(m)
 
         if not callable(z0):
+            i0, i1 = rows[0], rows[-1] + 1
+            j0, j1 = columns[0], columns[-1] + 1
             triangles.extend([
-                     0,      0, z0, (0, 0, -1), (-1, -1),
-                     0,      n, z0, (0, 0, -1), (-1, -1),
-                     m,      0, z0, (0, 0, -1), (-1, -1),
+                    j0,     i0, z0, (0, 0, -1), (-1, -1),
+                    j0,     i1, z0, (0, 0, -1), (-1, -1),
+                    j1,     i0, z0, (0, 0, -1), (-1, -1),
 
-                     m,      0, z0, (0, 0, -1), (-1, -1),
-                     0,      n, z0, (0, 0, -1), (-1, -1),
-                     m,      n, z0, (0, 0, -1), (-1, -1),
+                    j1,     i0, z0, (0, 0, -1), (-1, -1),
+                    j0,     i1, z0, (0, 0, -1), (-1, -1),
+                    j1,     i1, z0, (0, 0, -1), (-1, -1),
                 ])
             z0 = constant(z0)
 
-        for i in range(     n):
-            for j in range(     m):
-                p = (j, i)
+        for i in rows:
+            for j in columns:
+                p = (j*step, i*step)
 #       up        
                 z1 = z0(i-1, j) + (0 if i == 0 else matrix[i-1][j])
 #       right        
@@ -294,6 +663,18 @@ class Resources(object):
                 z05 = z0(i, j)
                 z5 = z05 + matrix[i][j]
 
+                if finest is not None:
+                    fineRows = range(i*step, min((i + 1)*step, len(finest)))
+                    fineColumns = range(j*step, min((j + 1)*step, len(finest[0])))
+                    if i == rows[0] and i > 0:
+                        z1 = min([z1] + [finest[fineRows[0] - 1][j_] for j_ in fineColumns])
+                    if j == columns[-1] and j + 1 < m:
+                        z2 = min([z2] + [finest[i_][fineColumns[-1] + 1] for i_ in fineRows])
+                    if i == rows[-1] and i + 1 < n:
+                        z3 = min([z3] + [finest[fineRows[-1] + 1][j_] for j_ in fineColumns])
+                    if j == columns[0] and j > 0:
+                        z4 = min([z4] + [finest[i_][fineColumns[0] - 1] for i_ in fineRows])
+
                 triangles.extend([
                         j,     i, z5, (0, 0, 1), p,
                     j + 1,     i, z5, (0, 0, 1), p,
@@ -353,14 +734,17 @@ class Resources(object):
                             j, i + 1, z3, (0,  1, 0), p,
                         ])
 
+        if dimensions is None: dimensions = (self.logicalResources.n, self.logicalResources.m)
+        n, m = dimensions
         vertices = []
         normals = []
         indexiesInMatrix = []
         i = 0
         while i < len(triangles):
+#           Merged cells on far border may stick out of landscape            
             vertices.extend([
-                triangles[i]/m, 
-                triangles[i+1]/n, 
+                min(triangles[i]*step, m)/m, 
+                min(triangles[i+1]*step, n)/n, 
                 triangles[i+2] * ZScale])
             normals.extend(triangles[i+3])
             indexiesInMatrix.extend([
@@ -1,6 +1,9 @@
 ''' Copypasted from pyqt examples '''
 
-from PyQt5.QtCore import QEvent, QPoint, QRect, QCoreApplication, Qt
+import math
+import time
+
+from PyQt5.QtCore import QEvent, QPoint, QRect, QCoreApplication, QTimer, Qt
 from PyQt5.QtGui import (
         QGuiApplication, QWindow, 
         QMatrix4x4, QVector3D, 
@@ -20,12 +23,72 @@ def exitOnKeyboardInterrupt(method):
 
     return method_
 
+def addGlFunctuins(gl, GL, functions):
+    for function, arguments in functions.items():
+        GL[function].restype = None
+        GL[function].argtypes = arguments
+        setattr(gl, function, GL[function])
+
+def createGlFunctions(context):
+    ''' Returns OpenGL functions of current *context* '''
+#   Sorry, no support for higher versions for now.
+    profile = QOpenGLVersionProfile()
+    profile.setVersion(2, 0)
+
+    gl = context.versionFunctions(profile)
+    gl.initializeOpenGLFunctions()
+
+    #print(context.hasExtension('GL_EXT_framebuffer_object'))
+    #print(context.hasExtension('GL_ARB_texture_float'))
+    #print(*sorted(context.extensions()), sep='\n')
+
+#   Small hack. Guess noone mind?            
+    import ctypes
+    import ctypes.util
+    GL = ctypes.CDLL(ctypes.util.find_library('GL'))
+
+    addGlFunctuins(gl, GL, {
+        'glFramebufferTexture2D': (ctypes.c_uint, ctypes.c_uint, ctypes.c_uint, ctypes.c_uint, ctypes.c_int),
+        'glDrawArraysInstanced': (ctypes.c_uint, ctypes.c_int, ctypes.c_int, ctypes.c_int),
+#       Allows reading into pixel buffer object at offset
+        'glReadPixels': (ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_uint, ctypes.c_uint, ctypes.c_void_p),
+        'glGenQueries': (ctypes.c_int, ctypes.POINTER(ctypes.c_uint)),
+        'glBeginQuery': (ctypes.c_uint, ctypes.c_uint),
+        'glEndQuery': (ctypes.c_uint,),
+        'glGetQueryObjectiv': (ctypes.c_uint, ctypes.c_uint, ctypes.POINTER(ctypes.c_int)),
+        'glGetQueryObjectui64v': (ctypes.c_uint, ctypes.c_uint, ctypes.POINTER(ctypes.c_uint64)),
+        'glGetProgramiv': (ctypes.c_uint, ctypes.c_uint, ctypes.POINTER(ctypes.c_int)),
+        'glProgramParameteri': (ctypes.c_uint, ctypes.c_uint, ctypes.c_int),
+        'glGetProgramBinary': (ctypes.c_uint, ctypes.c_int, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_uint), ctypes.c_void_p),
+        'glProgramBinary': (ctypes.c_uint, ctypes.c_uint, ctypes.c_char_p, ctypes.c_int)
+        })
+
+    return gl
+
+# Posted by *renderLaterFromThread*
+RenderLaterEvent = QEvent.Type(QEvent.registerEventType())
+
 class OpenGLWindow(QWindow):
+
+    ''' Frames per second cap, None - no cap '''
+    targetFps = 60
+    ''' Frames per second cap of animation, while window is inactive '''
+    idleFps = 10
+
     def __init__(self, parent=None):
         super(OpenGLWindow, self).__init__(parent)
 
         self.m_update_pending = False
         self.m_animating = False
+
+        self.m_last_frame_start = 0
+        self.m_first_frame_start = None
+        self.m_frames = 0
+        self.m_frames_cpu_time = 0
+        self.m_frames_wall_time = 0
+        self.m_last_frame_time = None
+#       Frame time without swapBuffers, which waits for vsync
+        self.m_last_render_time = None
         self.m_context = None
         self.m_device = None
         self.m_gl = None
@@ -42,10 +105,51 @@ class OpenGLWindow(QWindow):
         if animating:
             self.renderLater()
 
+    def needsAnimation(self):
+        ''' Whether scene changes by itself, so next frame must
+            be rendered even without new events.
+        '''
+        return False
+
+    def frameInterval(self):
+        ''' Minimal time between frames, 0 - no cap '''
+        fps = self.targetFps
+        if not self.isActive() and self.idleFps:
+            fps = min(fps or self.idleFps, self.idleFps)
+        return 1 / fps if fps else 0
+
     def renderLater(self):
+        ''' Schedules frame, not earlier than frame interval allows '''
         if not self.m_update_pending:
             self.m_update_pending = True
-            QGuiApplication.postEvent(self, QEvent(QEvent.UpdateRequest))
+            delay = self.m_last_frame_start + self.frameInterval() - time.perf_counter()
+            if delay > 0:
+                QTimer.singleShot(int(math.ceil(delay * 1000)), self.postUpdateRequest)
+            else:
+                self.postUpdateRequest()
+
+    def renderLaterFromThread(self):
+        ''' Same as *renderLater*, but may be called from any thread '''
+        QGuiApplication.postEvent(self, QEvent(RenderLaterEvent))
+
+    def postUpdateRequest(self):
+        QGuiApplication.postEvent(self, QEvent(QEvent.UpdateRequest))
+
+    def cpuTimeSaved(self):
+        ''' Estimates CPU time saved, compared to rendering 
+            continuously at frame rate cap.
+        '''
+        if self.m_frames == 0: return 0
+
+        elapsed = time.perf_counter() - self.m_first_frame_start
+        averageWallTime = self.m_frames_wall_time / self.m_frames
+        rate = 1 / max(averageWallTime, 1 / self.targetFps if self.targetFps else 0, 1e-6)
+        continuousFrames = elapsed * rate
+        return max(0, continuousFrames - self.m_frames) * self.m_frames_cpu_time / self.m_frames
+
+    def schedulerReport(self):
+        return 'Frames rendered: {}, average frame CPU time: {:.2f} ms, CPU time saved: {:.2f} s'.format(
+                self.m_frames, 1000 * self.m_frames_cpu_time / max(1, self.m_frames), self.cpuTimeSaved())
 
     def paint(self, painter):
         pass
@@ -53,12 +157,6 @@ class OpenGLWindow(QWindow):
     def render(self, gl):
         pass
 
-    def addGlFunctuins(self, GL, functions):
-        for function, arguments in functions.items():
-            GL[function].restype = None
-            GL[function].argtypes = arguments
-            setattr(self.m_gl, function, GL[function])
-
     @exitOnKeyboardInterrupt
     def renderNow(self):
         if not self.isExposed():
@@ -66,6 +164,12 @@ class OpenGLWindow(QWindow):
 
         self.m_update_pending = False
 
+        frameStart = time.perf_counter()
+        frameCpuStart = time.process_time()
+        self.m_last_frame_start = frameStart
+        if self.m_first_frame_start is None:
+            self.m_first_frame_start = frameStart
+
         needsInitialize = False
 
         if self.m_context is None:
@@ -78,25 +182,7 @@ class OpenGLWindow(QWindow):
         self.m_context.makeCurrent(self)
 
         if needsInitialize:
-#           Sorry, no support for higher versions for now.
-            profile = QOpenGLVersionProfile()
-            profile.setVersion(2, 0)
-
-            self.m_gl = self.m_context.versionFunctions(profile)
-            self.m_gl.initializeOpenGLFunctions()
-
-            #print(self.m_context.hasExtension('GL_EXT_framebuffer_object'))
-            #print(self.m_context.hasExtension('GL_ARB_texture_float'))
-            #print(*sorted(self.m_context.extensions()), sep='\n')
-
-#           Small hack. Guess noone mind?            
-            import ctypes
-            import ctypes.util
-            GL = ctypes.CDLL(ctypes.util.find_library('GL'))
-
-            self.addGlFunctuins(GL, {
-                'glFramebufferTexture2D': (ctypes.c_uint, ctypes.c_uint, ctypes.c_uint, ctypes.c_uint, ctypes.c_int)
-                })
+            self.m_gl = createGlFunctions(self.m_context)
 
             self.logger = QOpenGLDebugLogger()
             self.logger.initialize()
@@ -122,9 +208,15 @@ class OpenGLWindow(QWindow):
 
         self.paint(painter)
 
+        self.m_last_render_time = time.perf_counter() - frameStart
         self.m_context.swapBuffers(self)
 
-        if self.m_animating:
+        self.m_frames += 1
+        self.m_frames_cpu_time += time.process_time() - frameCpuStart
+        self.m_last_frame_time = time.perf_counter() - frameStart
+        self.m_frames_wall_time += self.m_last_frame_time
+
+        if self.m_animating or self.needsAnimation():
             self.renderLater()
 
     def handleLoggedMassage(self, message):
@@ -139,6 +231,9 @@ class OpenGLWindow(QWindow):
         if event.type() == QEvent.UpdateRequest:
             self.renderNow()
             return True
+        if event.type() == RenderLaterEvent:
+            self.renderLater()
+            return True
 
         return super(OpenGLWindow, self).event(event)
 
@@ -0,0 +1,224 @@
+import collections
+import math
+import time
+
+from PyQt5.QtGui import QOpenGLBuffer, QVector4D
+
+import opengl_resources
+
+
+def rayCastHeights(origin, direction, matrix, zScale):
+    ''' Finds first column of heights *matrix* hit by ray.
+        *origin* and *direction* are (x, y, z) in model coordinates,
+        where landscape occupies unit square. Walks grid cells along
+        ray projection, so only crossed cells are checked.
+        Returns (i, j) or None.
+    '''
+    n = len(matrix)
+    m = len(matrix[0])
+    maxHeight = max(map(max, matrix)) * zScale
+
+#   Switching to grid coordinates, where cell is unit square
+    origin = (origin[0] * m, origin[1] * n, origin[2])
+    direction = (direction[0] * m, direction[1] * n, direction[2])
+
+#   Clipping ray to grid bounding box
+    tEnter, tExit = 0.0, float('inf')
+    for axis, upper in enumerate([m, n, maxHeight]):
+        if direction[axis] == 0:
+            if not 0 <= origin[axis] <= upper: return None
+            continue
+        t0 = (0 - origin[axis]) / direction[axis]
+        t1 = (upper - origin[axis]) / direction[axis]
+        tEnter = max(tEnter, min(t0, t1))
+        tExit = min(tExit, max(t0, t1))
+    if tEnter > tExit: return None
+
+    def at(t, axis):
+        return origin[axis] + direction[axis] * t
+
+    j = max(0, min(m - 1, int(math.floor(at(tEnter, 0)))))
+    i = max(0, min(n - 1, int(math.floor(at(tEnter, 1)))))
+
+    stepJ = 1 if direction[0] > 0 else -1
+    stepI = 1 if direction[1] > 0 else -1
+    tDeltaJ = abs(1 / direction[0]) if direction[0] != 0 else float('inf')
+    tDeltaI = abs(1 / direction[1]) if direction[1] != 0 else float('inf')
+    tNextJ = ((j + (stepJ > 0)) - origin[0]) / direction[0] if direction[0] != 0 else float('inf')
+    tNextI = ((i + (stepI > 0)) - origin[1]) / direction[1] if direction[1] != 0 else float('inf')
+
+    t = tEnter
+    while 0 <= i < n and 0 <= j < m and t <= tExit:
+        tLeave = min(tNextJ, tNextI, tExit)
+#       Height along ray is linear, so checking ends of segment is enough
+        if min(at(t, 2), at(tLeave, 2)) <= matrix[i][j] * zScale:
+            return i, j
+
+        t = tLeave
+        if tNextJ < tNextI:
+            j += stepJ
+            tNextJ += tDeltaJ
+        else:
+            i += stepI
+            tNextI += tDeltaI
+
+    return None
+
+
+""" Finds landscape cell under mouse pointer.
+
+    Primary path reads one pixel of depth framebuffer (where cell
+    indexes are coded as color) into pixel buffer object, and maps
+    it on next frame, so pipeline is not stalled. Fallback path
+    casts camera ray against heights matrix on CPU.
+"""
+class Picker(object):
+
+    ''' logical_resources.Resources '''
+    logicalResources = None
+
+    ''' opengl_resources.Resources '''
+    openglResources = None
+
+    ''' Use pixel buffer object readback, else CPU ray casting '''
+    usePixelBuffer = True
+
+    ''' Print latency of every pick '''
+    reportLatency = False
+
+    ''' Requests (x, y, payload, request time) waiting for readback,
+        x and y are relative to window size
+    '''
+    pendingRequests = None
+    ''' Requests, which pixels are being read into *pixelBuffer* '''
+    readingRequests = None
+    ''' Pixel buffer object, which receives read pixels '''
+    pixelBuffer = None
+
+    ''' Dictionary path -> recent pick latencies in seconds '''
+    latencies = None
+    ''' Dictionary path -> [number of picks, total latency in seconds] '''
+    latencyTotals = None
+
+    def __init__(self, logicalResources, openglResources):
+        self.logicalResources = logicalResources
+        self.openglResources = openglResources
+        self.pendingRequests = []
+        self.readingRequests = []
+        self.latencies = {
+                'pbo': collections.deque(maxlen=100),
+                'cpu': collections.deque(maxlen=100)
+                }
+        self.latencyTotals = {path: [0, 0.0] for path in self.latencies}
+
+    def request(self, x, y, width, height, payload):
+        ''' Requests cell under window point (x, y).
+            Returns [(payload, (i, j))] of picks completed right
+            away (CPU path), others are returned by *collect*.
+        '''
+        if not self.usePixelBuffer:
+            requestTime = time.perf_counter()
+            cell = self.castRay(x, y, width, height)
+            self.recordLatency('cpu', requestTime)
+            return [] if cell is None else [(payload, cell)]
+
+#       Depth framebuffer may be resized till readback, so
+#       point is kept in relative coordinates
+        self.pendingRequests.append((x / width, y / height, payload, time.perf_counter()))
+
+        return []
+
+    def busy(self):
+        ''' Whether there are picks waiting for readback '''
+        return len(self.pendingRequests) > 0 or len(self.readingRequests) > 0
+
+    def castRay(self, x, y, width, height):
+        ''' Unprojects window point (x, y) and casts ray from it '''
+        inverted, invertible = self.logicalResources.mvmatrix(width, height).inverted()
+        if not invertible: return None
+
+        ndcX = 2 * x / width - 1
+        ndcY = 1 - 2 * y / height
+        near = inverted.map(QVector4D(ndcX, ndcY, -1, 1))
+        far = inverted.map(QVector4D(ndcX, ndcY, 1, 1))
+        near = near.toVector3DAffine()
+        far = far.toVector3DAffine()
+        direction = far - near
+
+        return rayCastHeights(
+                (near.x(), near.y(), near.z()),
+                (direction.x(), direction.y(), direction.z()),
+                self.logicalResources.landscapeHeightsMatrix,
+                opengl_resources.ZScale)
+
+    def readback(self, gl):
+        ''' Starts asynchronous read of requested pixels from
+            depth framebuffer. Call after depth pass is rendered.
+        '''
+        if len(self.pendingRequests) == 0 or len(self.readingRequests) > 0: return
+
+        if self.pixelBuffer is None:
+            self.pixelBuffer = QOpenGLBuffer(QOpenGLBuffer.PixelPackBuffer)
+            assert self.pixelBuffer.create(), "Can't create pixel buffer =\\"
+            self.pixelBuffer.setUsagePattern(QOpenGLBuffer.StreamRead)
+
+        self.readingRequests, self.pendingRequests = self.pendingRequests, []
+
+        framebuffer = self.openglResources.depthFramebuffer
+        assert framebuffer.bind()
+        self.pixelBuffer.bind()
+        self.pixelBuffer.allocate(4 * len(self.readingRequests))
+        width, height = framebuffer.width(), framebuffer.height()
+        for k, (x, y, payload, requestTime) in enumerate(self.readingRequests):
+            x = min(width - 1, int(x * width))
+            y = min(height - 1, int(y * height))
+#           OpenGL window coordinates start at bottom left
+            gl.glReadPixels(x, height - 1 - y, 1, 1, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, 4 * k)
+        self.pixelBuffer.release()
+        assert framebuffer.release()
+
+    def collect(self, gl):
+        ''' Returns [(payload, (i, j))] of picks read on
+            previous frames.
+        '''
+        if len(self.readingRequests) == 0: return []
+
+        self.pixelBuffer.bind()
+        pointer = self.pixelBuffer.map(QOpenGLBuffer.ReadOnly)
+        if pointer is None:
+            self.pixelBuffer.release()
+#           Picks are lost, later ones are cast on CPU
+            print("Can't map pixel buffer, {} picks dropped, switching to ray casting".format(len(self.readingRequests)))
+            self.usePixelBuffer = False
+            self.readingRequests = []
+            return []
+        data = pointer.asstring(4 * len(self.readingRequests))
+        self.pixelBuffer.unmap()
+        self.pixelBuffer.release()
+
+        picks = []
+        for k, (x, y, payload, requestTime) in enumerate(self.readingRequests):
+            red, green, blue, alpha = data[4*k:4*k + 4]
+            self.recordLatency('pbo', requestTime)
+            if alpha != 0:
+#               In depthFramebuffer color texture indexes info coded as color
+                j = int((red / 256) * self.logicalResources.m)
+                i = int((green / 256) * self.logicalResources.n)
+                picks.append((payload, (i, j)))
+        self.readingRequests = []
+
+        return picks
+
+    def recordLatency(self, path, requestTime):
+        latency = time.perf_counter() - requestTime
+        self.latencies[path].append(latency)
+        self.latencyTotals[path][0] += 1
+        self.latencyTotals[path][1] += latency
+        if self.reportLatency:
+            print('Pick ({}): {:.2f} ms, average {:.2f} ms'.format(path,
+                1000 * latency, 1000 * sum(self.latencies[path]) / len(self.latencies[path])))
+
+    def latencyReport(self):
+        ''' Average pick latency of every path used '''
+        return 'Picks: ' + (', '.join('{} {}, average {:.2f} ms'.format(path, count, 1000 * total / count)
+                for path, (count, total) in self.latencyTotals.items() if count > 0) or 'none')
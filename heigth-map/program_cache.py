@@ -0,0 +1,109 @@
+import ctypes
+import hashlib
+import os
+import os.path
+
+""" OpenGL constants of ARB_get_program_binary """
+GL_PROGRAM_BINARY_RETRIEVABLE_HINT = 0x8257
+GL_PROGRAM_BINARY_LENGTH = 0x8741
+GL_NUM_PROGRAM_BINARY_FORMATS = 0x87FE
+GL_LINK_STATUS = 0x8B82
+
+
+def programBinarySupported(context):
+    ''' Whether *context* can save and load program binaries '''
+    return (context.format().version() >= (4, 1)
+            or context.hasExtension(b'GL_ARB_get_program_binary'))
+
+
+""" Disk cache of linked GLSL program binaries.
+
+    File name is hash of shader sources together with driver
+    vendor, renderer and version strings, so binaries of other
+    sources or drivers are never loaded. Binary, which driver
+    refuses anyway, is deleted and caller compiles from source.
+"""
+class ProgramCache(object):
+
+    ''' Directory with cached binaries '''
+    directory = None
+
+    ''' Driver vendor, renderer and version string '''
+    driver = None
+
+    ''' Counters of 'hits', 'misses', 'rejected' and 'saved' binaries '''
+    stats = None
+
+    def __init__(self, gl, directory=None):
+        if directory is None:
+            directory = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                    'heigth-map', 'programs')
+        self.directory = directory
+        self.driver = '\n'.join(str(gl.glGetString(name)) for name in [gl.GL_VENDOR, gl.GL_RENDERER, gl.GL_VERSION])
+        self.stats = dict.fromkeys(['hits', 'misses', 'rejected', 'saved'], 0)
+
+    def key(self, *sources):
+        ''' Cache key of program linked from *sources* '''
+        digest = hashlib.sha1(self.driver.encode())
+        for source in sources:
+            digest.update(b'\0')
+            digest.update(source.encode())
+        return digest.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, '{}.bin'.format(key))
+
+    def load(self, gl, program, key):
+        ''' Loads binary *key* into created but not linked *program*.
+            Returns whether program is linked now.
+        '''
+        try:
+            with open(self.filename(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            self.stats['misses'] += 1
+            return False
+
+        if len(data) > 4:
+            binaryFormat = int.from_bytes(data[:4], 'little')
+            gl.glProgramBinary(program.programId(), binaryFormat, data[4:], len(data) - 4)
+#           Without attached shaders link() only checks link status
+            if program.link():
+                self.stats['hits'] += 1
+                return True
+
+#       Driver was updated or file is broken
+        self.stats['rejected'] += 1
+        try:
+            os.remove(self.filename(key))
+        except OSError:
+            pass
+        return False
+
+    def prepare(self, gl, program):
+        ''' Asks driver to keep binary of *program*.
+            Call before linking.
+        '''
+        gl.glProgramParameteri(program.programId(), GL_PROGRAM_BINARY_RETRIEVABLE_HINT, 1)
+
+    def save(self, gl, program, key):
+        ''' Saves binary of linked *program* as *key* '''
+        length = ctypes.c_int()
+        gl.glGetProgramiv(program.programId(), GL_PROGRAM_BINARY_LENGTH, ctypes.byref(length))
+        if length.value <= 0: return
+
+        data = ctypes.create_string_buffer(length.value)
+        binaryFormat = ctypes.c_uint()
+        gl.glGetProgramBinary(program.programId(), length.value, ctypes.byref(length), ctypes.byref(binaryFormat), data)
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+#           Writing to temporary file, so other instance never reads half of binary
+            temporary = '{}.{}.tmp'.format(self.filename(key), os.getpid())
+            with open(temporary, 'wb') as f:
+                f.write(binaryFormat.value.to_bytes(4, 'little'))
+                f.write(data.raw[:length.value])
+            os.replace(temporary, self.filename(key))
+            self.stats['saved'] += 1
+        except OSError as error:
+            print("Can't save program binary: {}".format(error))
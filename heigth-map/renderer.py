@@ -4,6 +4,8 @@ import math
 import random
 import struct
 
+import telemetry
+
 from PyQt5.QtCore import QEvent, QPoint, QRect, Qt
 from PyQt5.QtGui import (
         QGuiApplication, QWindow, 
@@ -15,6 +17,40 @@ from PyQt5.QtGui import (
         QSurfaceFormat, QPainter, QColor, QFont, QFontMetrics
         )
 
+''' Resolved locations and last set uniform values 
+    of GLSL program.
+'''
+class ProgramState(object):
+
+    ''' QOpenGLShaderProgram '''
+    program = None
+
+    ''' Dictionary uniform name -> location '''
+    uniformLocations = None
+    ''' Dictionary attribute name -> location '''
+    attributeLocations = None
+    ''' Dictionary uniform name -> last set value '''
+    values = None
+
+    def __init__(self, program):
+        self.program = program
+        self.uniformLocations = {}
+        self.attributeLocations = {}
+        self.values = {}
+
+    def uniformLocation(self, name):
+        location = self.uniformLocations.get(name)
+        if location is None:
+            location = self.uniformLocations[name] = self.program.uniformLocation(name)
+        return location
+
+    def attributeLocation(self, name):
+        location = self.attributeLocations.get(name)
+        if location is None:
+            location = self.attributeLocations[name] = self.program.attributeLocation(name)
+        return location
+
+
 ''' Invokes rendering OpenGL commands. '''
 class Renderer(object):
 
@@ -30,9 +66,88 @@ class Renderer(object):
     ''' Use multisampling '''
     multisample = False
 
+    ''' Draw distant mesh chunks with merged cells '''
+    levelOfDetail = True
+
+    ''' Distances from eye in landscape cells, after which next
+        level of detail is used. Cell merged by it must look small
+        from there, so whole small landscape in default view keeps
+        full detail.
+    '''
+    levelOfDetailDistances = [150, 300]
+
+    ''' Names of intermediate buffers drawn over window:
+        'refraction', 'depth' (cell indexes) and 'shadow' 
+        (depth component)
+    '''
+    overlays = None
+    ''' Size of overlay tile in pixels '''
+    overlaySize = 256
+    ''' Number of overlay tiles in row '''
+    overlayColumns = 3
+
+    ''' Dictionary QOpenGLShaderProgram -> ProgramState '''
+    programStates = None
+    ''' Dictionary attribute location -> (buffer id, size, offset)
+        of vertex attribute pointers set during current frame.
+        QPainter resets them between frames.
+    '''
+    attributePointers = None
+
+    ''' Use vertex array objects, when context supports them '''
+    useVertexArrays = True
+    ''' Whether context supports vertex array objects, 
+        None until checked.
+    '''
+    vertexArraysSupported = None
+    ''' Dictionary (program, buffer id) -> (QOpenGLVertexArrayObject, 
+        layout of mesh it was built for)
+    '''
+    vertexArrays = None
+
+    ''' Counters of GL calls made and saved by caching during 
+        current frame: 'uniforms', 'uniformsSaved', 'attributes',
+        'attributesSaved', 'vertexArrayBuilds'.
+    '''
+    calls = None
+    ''' *calls* of previous frame '''
+    lastFrameCalls = None
+
+    ''' telemetry.Telemetry of render passes '''
+    telemetry = None
+
+    ''' Lists of (opengl_resources.MeshChunk, level of detail) 
+        inside current frustum 
+    '''
+    visibleLandscapeChunks = None
+    visibleWaterChunks = None
+
+    ''' Skip depth and refraction passes, while their inputs 
+        (camera, landscape, water) are unchanged
+    '''
+    cacheOffscreenPasses = True
+    ''' Dictionary pass name -> inputs it was last rendered with '''
+    passInputs = None
+    ''' Dictionary pass name -> number of frames it was skipped '''
+    skippedPasses = None
+
+    ''' QOpenGLFramebufferObject scene is rendered onto,
+        None - default framebuffer of context
+    '''
+    targetFramebuffer = None
+
     def __init__(self, logicalResources, openglResources):
         self.logicalResources = logicalResources
         self.openglResources = openglResources
+        self.overlays = []
+        self.telemetry = telemetry.Telemetry()
+        self.programStates = {}
+        self.attributePointers = {}
+        self.vertexArrays = {}
+        self.passInputs = {}
+        self.skippedPasses = {'depth': 0, 'refraction': 0}
+        self.calls = self.lastFrameCalls = dict.fromkeys(['uniforms', 'uniformsSaved', 
+            'attributes', 'attributesSaved', 'vertexArrayBuilds'], 0)
 
         self.uniforms = {}
         self.uniforms['NormalMapCoordinatesShift1'] = QVector3D(0, 0, 0)
@@ -55,6 +170,9 @@ class Renderer(object):
 
     def render(self, gl, width, height, render_water=False):
         ''' Updates uniforms and renders whole scene '''
+        self.lastFrameCalls = self.calls
+        self.calls = dict.fromkeys(self.lastFrameCalls, 0)
+        self.attributePointers = {}
 
         mvmatrix = self.logicalResources.mvmatrix()
         self.uniforms['Eye'] = self.logicalResources.eye
@@ -84,20 +202,106 @@ class Renderer(object):
                 0.0, 0.0, 0.5, 0.5,
                 0.0, 0.0, 0.0, 1.0) * self.uniforms['MVPMatrix'] 
 
-        self.renderDepth(gl)
-        if render_water:
-            self.renderWaterRefraction(gl)
-
+        if not self.openglResources.instancedColumns:
+            planes = self.frustumPlanes(self.uniforms['MVPMatrix'])
+            self.visibleLandscapeChunks = self.selectChunks(self.openglResources.landscapeChunks, planes)
+            if render_water:
+                self.visibleWaterChunks = self.selectChunks(self.openglResources.waterChunks, planes)
+
+        resources = self.openglResources
+        depthInputs = (tuple(self.uniforms['MVPMatrix'].data()), 
+                (self.uniforms['Dimensions'].x(), self.uniforms['Dimensions'].y()),
+                resources.landscapeGeneration, resources.offscreenFramebufferSize,
+                self.levelOfDetail, tuple(self.levelOfDetailDistances))
+        if self.passNeedsRender('depth', depthInputs):
+            with self.telemetry.gpu(gl, 'gpu depth'):
+                self.renderDepth(gl)
+
+#       Refraction samples depth texture, so depends on its inputs too
+        refractionInputs = (depthInputs, resources.waterGeneration,
+                tuple(self.logicalResources.selectedLandscapeCell),
+                (self.uniforms['LightPosition'].x(), self.uniforms['LightPosition'].y(), self.uniforms['LightPosition'].z()))
+        if render_water and self.passNeedsRender('refraction', refractionInputs):
+            with self.telemetry.gpu(gl, 'gpu refraction'):
+                self.renderWaterRefraction(gl)
+
+#       Releasing of intermediate framebuffers binds default one
+        if self.targetFramebuffer is not None:
+            assert self.targetFramebuffer.bind()
         gl.glViewport(0, 0, width, height)
-        self.renderLandscape(gl, self.openglResources.landscapeProgram)
+        with self.telemetry.gpu(gl, 'gpu landscape'):
+            self.renderLandscape(gl, self.openglResources.landscapeProgram)
         gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
         if render_water:
-             self.renderWater(gl, self.openglResources.waterProgram, RefractionMagnitude=0.7, NormalBumpMagnitude=0.6)
-             pass
+            with self.telemetry.gpu(gl, 'gpu water'):
+                self.renderWater(gl, self.openglResources.waterProgram, RefractionMagnitude=0.7, NormalBumpMagnitude=0.6)
 
         gl.glDisable(gl.GL_CULL_FACE)
         gl.glDisable(gl.GL_DEPTH_TEST)
 
+        if len(self.overlays) > 0:
+            self.renderOverlays(gl, width, height)
+            gl.glViewport(0, 0, width, height)
+
+    def passNeedsRender(self, name, inputs):
+        ''' Whether offscreen pass *name* must be rendered with
+            *inputs*, otherwise its framebuffer is up to date.
+        '''
+        if self.cacheOffscreenPasses and self.passInputs.get(name) == inputs:
+            self.skippedPasses[name] += 1
+            return False
+
+        self.passInputs[name] = inputs
+        return True
+
+    def overlayRects(self):
+        ''' Returns list of (overlay name, QRect of tile in window) '''
+        rects = []
+        for k, name in enumerate(self.overlays):
+            x = (k % self.overlayColumns) * self.overlaySize
+            y = (k // self.overlayColumns) * self.overlaySize
+            rects.append((name, QRect(x, y, self.overlaySize, self.overlaySize)))
+
+        return rects
+
+    def renderOverlays(self, gl, width, height):
+        ''' Draws intermediate buffers over window without 
+            reading them back from GPU.
+        '''
+        program = self.openglResources.overlayProgram
+        program.bind()
+        self.setUniform(program, 'Texture', 0)
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+
+        self.openglResources.overlayVBO.bind()
+        self.setAttributePointer(gl, program, 'vertexPosition', self.openglResources.overlayVBO, 2, 0)
+
+        for name, rect in self.overlayRects():
+            grayscale = name == 'shadow'
+            if name == 'refraction':
+                textureId = self.openglResources.refractionFramebuffer.texture()
+            elif name == 'depth':
+                textureId = self.openglResources.depthFramebuffer.texture()
+            else:
+                textureId = self.openglResources.depthTexture.textureId()
+
+            gl.glBindTexture(gl.GL_TEXTURE_2D, textureId)
+            if grayscale:
+#               Sampling with comparison gives no picture
+                gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_COMPARE_MODE, gl.GL_NONE)
+            self.setUniform(program, 'Grayscale', 1.0 if grayscale else 0.0)
+
+#           Window coordinates of OpenGL start at bottom left
+            gl.glViewport(rect.x(), height - rect.y() - rect.height(), rect.width(), rect.height())
+            gl.glDrawArrays(gl.GL_TRIANGLE_STRIP, 0, 4)
+
+            if grayscale:
+                gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_COMPARE_MODE, gl.GL_COMPARE_REF_TO_TEXTURE)
+
+        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        self.openglResources.overlayVBO.release()
+        program.release()
+
     def renderDepth(self, gl):
         """ Renders depth info. Additionaly renders indexes of 
             landscape cell as color, to retrieve currently 
@@ -114,6 +318,8 @@ class Renderer(object):
 
         gl.glEnable(gl.GL_POLYGON_OFFSET_FILL)
         gl.glPolygonOffset(2.0, 4.0);
+#       Same chunks and levels as landscape pass, so clipping and
+#       picking match drawn surface
         self.renderLandscape(gl, self.openglResources.depthProgram)
         gl.glDisable(gl.GL_POLYGON_OFFSET_FILL)
 
@@ -139,9 +345,141 @@ class Renderer(object):
         ''' Sets GLSL *program* uniforms '''
         for k, v in self.uniforms.items():
             if k not in kwuniforms:
-                program.setUniformValue(k, v)
+                self.setUniform(program, k, v)
         for k, v in kwuniforms.items():
-            program.setUniformValue(k, v)
+            self.setUniform(program, k, v)
+
+    def programState(self, program):
+        state = self.programStates.get(program)
+        if state is None:
+            state = self.programStates[program] = ProgramState(program)
+        return state
+
+    def setUniform(self, program, name, value):
+        ''' Sets uniform of bound *program*, unless it already 
+            has such value or program has no such uniform.
+        '''
+        state = self.programState(program)
+        location = state.uniformLocation(name)
+        if location < 0 or state.values.get(name) == value:
+            self.calls['uniformsSaved'] += 1
+            return
+
+        program.setUniformValue(location, value)
+#       Values like QVector3D are changed inplace, so copy is kept
+        state.values[name] = type(value)(value)
+        self.calls['uniforms'] += 1
+
+    def setAttributePointer(self, gl, program, name, vbo, size, offset):
+        ''' Points attribute *name* of *program* to *vbo* data 
+            at *offset*, unless it already points there.
+        '''
+        location = self.programState(program).attributeLocation(name)
+        if location < 0: return
+
+        pointer = (vbo.bufferId(), size, offset)
+        if self.attributePointers.get(location) == pointer:
+            self.calls['attributesSaved'] += 1
+            return
+
+        self.pointAttribute(gl, program, location, vbo, size, offset)
+        self.attributePointers[location] = pointer
+
+    def pointAttribute(self, gl, program, location, vbo, size, offset):
+        ''' Points attribute at *location* to *vbo* data at *offset* '''
+        vbo.bind()
+        gl.glVertexAttribPointer(location, size, gl.GL_FLOAT, gl.GL_FALSE, 0, offset)
+        program.enableAttributeArray(location)
+        self.calls['attributes'] += 1
+
+    def setMeshAttributes(self, gl, program, vbo, numberOfVertices):
+        ''' Points *program* attributes to landscape or water mesh.
+            Returns bound vertex array object, which caller releases
+            after drawing, or None, if attributes were set directly.
+        '''
+        attributes = [
+                ('vertexPosition', 3, 0),
+                ('vertexNormal', 3, numberOfVertices*3*4),
+                ('vertexIndexInMatrix', 2, numberOfVertices*3*4*2)
+                ]
+
+        vao = self.bindVertexArray(gl, program, vbo, attributes)
+        if vao is None:
+            for name, size, offset in attributes:
+                self.setAttributePointer(gl, program, name, vbo, size, offset)
+
+        return vao
+
+    def bindVertexArray(self, gl, program, vbo, attributes):
+        ''' Binds vertex array object with *attributes* 
+            [(name, size, offset)] of *program* pointing to *vbo*.
+            Vertex array is rebuilt only when *attributes* change.
+            Returns None, if vertex arrays aren't used.
+        '''
+        if not self.useVertexArrays or self.vertexArraysSupported is False: return None
+
+        key = (program, vbo.bufferId())
+        vao, layout = self.vertexArrays.get(key, (None, None))
+        if vao is None:
+            vao = QOpenGLVertexArrayObject()
+            self.vertexArraysSupported = vao.create()
+            if not self.vertexArraysSupported: return None
+
+        vao.bind()
+        if layout != attributes:
+            state = self.programState(program)
+            for name, size, offset in attributes:
+                location = state.attributeLocation(name)
+                if location >= 0:
+                    self.pointAttribute(gl, program, location, vbo, size, offset)
+            self.vertexArrays[key] = (vao, attributes)
+            self.calls['vertexArrayBuilds'] += 1
+        else:
+            self.calls['attributesSaved'] += len(attributes)
+
+        return vao
+
+    def frustumPlanes(self, mvpmatrix):
+        ''' Extracts clipping planes of *mvpmatrix* as QVector4D '''
+        rows = [mvpmatrix.row(i) for i in range(4)]
+        return [rows[3] + rows[i] for i in range(3)] + [rows[3] - rows[i] for i in range(3)]
+
+    def selectChunks(self, chunks, planes):
+        ''' Culls *chunks* lying out of frustum *planes* and 
+            chooses level of detail of others by distance from eye.
+        '''
+        selected = []
+        for chunk in chunks:
+            lower, upper = chunk.lowerBound, chunk.upperBound
+
+            visible = True
+            for plane in planes:
+#               Checking bounding box corner farthest along plane normal
+                x = upper[0] if plane.x() >= 0 else lower[0]
+                y = upper[1] if plane.y() >= 0 else lower[1]
+                z = upper[2] if plane.z() >= 0 else lower[2]
+                if plane.x()*x + plane.y()*y + plane.z()*z + plane.w() < 0:
+                    visible = False
+                    break
+            if not visible: continue
+
+            level = 0
+            if self.levelOfDetail:
+                center = QVector3D(*[(l + u)/2 for l, u in zip(lower, upper)])
+#               Landscape is unit square, so cell side is 1 / cells along longer side
+                cells = max(self.logicalResources.n, self.logicalResources.m)
+                distance = (center - self.logicalResources.eye).length() * cells
+                while level < len(self.levelOfDetailDistances) and distance > self.levelOfDetailDistances[level]:
+                    level += 1
+            selected.append((chunk, min(level, len(chunk.ranges) - 1)))
+
+        return selected
+
+    def drawChunks(self, gl, chunks):
+        ''' Draws visible *chunks* of currently bound mesh '''
+        for chunk, level in chunks:
+            first, count = chunk.ranges[level]
+            gl.glDrawArrays(gl.GL_TRIANGLES, first, count)
 
     def renderLandscape(self, gl, program, **kwuniforms):
         ''' Renders landscape with *program* '''
@@ -150,26 +488,15 @@ class Renderer(object):
 
         gl.glActiveTexture(gl.GL_TEXTURE2)
         gl.glBindTexture(gl.GL_TEXTURE_2D, self.openglResources.depthTexture.textureId())
-        program.setUniformValue('DepthMap', 2)
-
-        self.openglResources.landscapeVBO.bind()
-        vertexPosition = program.attributeLocation('vertexPosition')
-        if vertexPosition >= 0:
-            gl.glVertexAttribPointer(vertexPosition, 3, gl.GL_FLOAT, gl.GL_FALSE, 0, 0)
-            program.enableAttributeArray(vertexPosition)
-
-        vertexNormal = program.attributeLocation('vertexNormal')
-        if vertexNormal >= 0:
-            gl.glVertexAttribPointer(vertexNormal, 3, gl.GL_FLOAT, gl.GL_FALSE, 0, self.openglResources.numberOfLandscapeVertices*3*4)
-            program.enableAttributeArray(vertexNormal)
-        
-        indexInMatrix = program.attributeLocation('vertexIndexInMatrix')
-        if indexInMatrix >= 0:
-            gl.glVertexAttribPointer(indexInMatrix, 2, gl.GL_FLOAT, gl.GL_FALSE, 0, self.openglResources.numberOfLandscapeVertices*3*4*2)
-            program.enableAttributeArray(indexInMatrix)
+        self.setUniform(program, 'DepthMap', 2)
 
-        gl.glDrawArrays(gl.GL_TRIANGLES, 0, self.openglResources.numberOfLandscapeVertices)
-        self.openglResources.landscapeVBO.release()
+        if self.openglResources.instancedColumns:
+            self.renderColumns(gl, program, 0.0)
+        else:
+            vao = self.setMeshAttributes(gl, program, self.openglResources.landscapeVBO, self.openglResources.numberOfLandscapeVertices)
+            self.drawChunks(gl, self.visibleLandscapeChunks)
+            if vao is not None: vao.release()
+            self.openglResources.landscapeVBO.release()
         
 
         program.release()
@@ -181,39 +508,27 @@ class Renderer(object):
 
         gl.glActiveTexture(gl.GL_TEXTURE0)
         self.openglResources.refractionNormalMap.bind()
-        program.setUniformValue('NormalMap', 0)
+        self.setUniform(program, 'NormalMap', 0)
 
         gl.glActiveTexture(gl.GL_TEXTURE1)
         gl.glBindTexture(gl.GL_TEXTURE_2D, self.openglResources.refractionFramebuffer.texture())
-        program.setUniformValue('Refraction', 1)
+        self.setUniform(program, 'Refraction', 1)
 
         gl.glActiveTexture(gl.GL_TEXTURE2)
         gl.glBindTexture(gl.GL_TEXTURE_2D, self.openglResources.depthTexture.textureId())
-        program.setUniformValue('DepthMap', 2)
+        self.setUniform(program, 'DepthMap', 2)
 
         gl.glActiveTexture(gl.GL_TEXTURE3)
         gl.glBindTexture(gl.GL_TEXTURE_2D, self.openglResources.heightsTexture.textureId())
-        program.setUniformValue('HeightMatrix', 3)
-
-        self.openglResources.waterVBO.bind()
-        vertexPosition = program.attributeLocation('vertexPosition')
-        if vertexPosition >= 0:
-            gl.glVertexAttribPointer(vertexPosition, 3, gl.GL_FLOAT, gl.GL_FALSE, 0, 0)
-            program.enableAttributeArray(vertexPosition)
+        self.setUniform(program, 'HeightMatrix', 3)
 
-        vertexNormal = program.attributeLocation('vertexNormal')
-        if vertexNormal >= 0:
-            gl.glVertexAttribPointer(vertexNormal, 3, gl.GL_FLOAT, gl.GL_FALSE, 0, self.openglResources.numberOfWaterVertices*3*4)
-            program.enableAttributeArray(vertexNormal)
-
-        indexInMatrix = program.attributeLocation('vertexIndexInMatrix')
-        if indexInMatrix >= 0:
-            gl.glVertexAttribPointer(indexInMatrix, 2, gl.GL_FLOAT, gl.GL_FALSE, 0, self.openglResources.numberOfWaterVertices*3*4*2)
-            program.enableAttributeArray(indexInMatrix)
-
-        
-        gl.glDrawArrays(gl.GL_TRIANGLES, 0, self.openglResources.numberOfWaterVertices)
-        self.openglResources.waterVBO.release()
+        if self.openglResources.instancedColumns:
+            self.renderColumns(gl, program, 1.0)
+        else:
+            vao = self.setMeshAttributes(gl, program, self.openglResources.waterVBO, self.openglResources.numberOfWaterVertices)
+            self.drawChunks(gl, self.visibleWaterChunks)
+            if vao is not None: vao.release()
+            self.openglResources.waterVBO.release()
 
         for i in range(7):
             gl.glActiveTexture(gl.GL_TEXTURE0 + i)
@@ -221,4 +536,30 @@ class Renderer(object):
 
         program.release()
 
+    def renderColumns(self, gl, program, columnMode):
+        ''' Draws unit column instanced for every landscape cell
+            with already bound *program*. *columnMode* is 0.0 for
+            landscape and 1.0 for water.
+        '''
+        n = self.logicalResources.n
+        m = self.logicalResources.m
 
+        gl.glActiveTexture(gl.GL_TEXTURE3)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.openglResources.heightsTexture.textureId())
+        self.setUniform(program, 'HeightMatrix', 3)
+        self.setUniform(program, 'GridSize', QVector2D(m, n))
+        self.setUniform(program, 'ColumnMode', columnMode)
+
+        vbo = self.openglResources.columnVBO
+        attributes = [
+                ('columnPosition', 3, 0),
+                ('columnNormal', 3, self.openglResources.numberOfColumnVertices*3*4)
+                ]
+        vao = self.bindVertexArray(gl, program, vbo, attributes)
+        if vao is None:
+            for name, size, offset in attributes:
+                self.setAttributePointer(gl, program, name, vbo, size, offset)
+
+        gl.glDrawArraysInstanced(gl.GL_TRIANGLES, 0, self.openglResources.numberOfColumnVertices, n*m)
+        if vao is not None: vao.release()
+        vbo.release()
@@ -0,0 +1,76 @@
+/*
+ * Instanced landscape/water columns.
+ * Inserted by opengl_resources.Resources.linkProgram right after
+ * #version line of every vertex shader when instanced rendering is on.
+ * One unit column is drawn m*n times, column heights are sampled from
+ * HeightMatrix, walls hidden by neighbours are collapsed into
+ * degenerate triangles.
+ */
+#ifdef INSTANCED_COLUMNS
+#extension GL_ARB_draw_instanced : require
+
+uniform sampler2D HeightMatrix;
+// (m, n) - number of columns and rows
+uniform vec2 GridSize;
+// 0.0 - landscape, 1.0 - water
+uniform float ColumnMode;
+
+// x, y - corner of unit column, z - 1.0 for top vertices, 0.0 for bottom
+in vec3 columnPosition;
+in vec3 columnNormal;
+
+vec4 vertexPosition;
+vec3 vertexNormal;
+vec2 vertexIndexInMatrix;
+
+vec2 columnHeights(ivec2 cell) {
+    return texelFetch(HeightMatrix, clamp(cell, ivec2(0), ivec2(GridSize) - 1), 0).rg;
+}
+
+float columnBase(ivec2 cell) {
+    return ColumnMode * columnHeights(cell).r;
+}
+
+float columnTop(ivec2 cell) {
+    vec2 z = columnHeights(cell);
+    float base = ColumnMode * z.r;
+    if (any(lessThan(cell, ivec2(0))) || any(greaterThanEqual(cell, ivec2(GridSize)))) {
+        return base;
+    }
+    return base + mix(z.r, z.g, ColumnMode);
+}
+
+void computeColumnVertex() {
+    int m = int(GridSize.x);
+    ivec2 cell = ivec2(gl_InstanceIDARB % m, gl_InstanceIDARB / m);
+
+    float z0 = columnBase(cell);
+    float z5 = columnTop(cell);
+    float z = z5;
+    vec2 corner = columnPosition.xy;
+
+    vertexNormal = columnNormal;
+    vertexIndexInMatrix = vec2(cell);
+
+    if (columnNormal.z < 0.0) {
+        // Bottom of landscape, water has none
+        z = 0.0;
+        vertexIndexInMatrix = vec2(-1.0);
+        if (ColumnMode > 0.0) {
+            corner = vec2(0.0);
+        }
+    } else if (columnNormal.z == 0.0) {
+        float zn = columnTop(cell + ivec2(columnNormal.xy));
+        if (zn < z5) {
+            if (columnPosition.z == 0.0) {
+                z = max(z0, zn);
+            }
+        } else {
+            // Wall is hidden by neighbour
+            corner = vec2(0.0);
+        }
+    }
+
+    vertexPosition = vec4((vec2(cell) + corner) / GridSize, z, 1.0);
+}
+#endif
@@ -2,12 +2,17 @@
 uniform mat4 MVPMatrix;
 uniform vec2 Dimensions;
 
+#ifndef INSTANCED_COLUMNS
 in vec4 vertexPosition;
 in vec2 vertexIndexInMatrix;
+#endif
 
 out vec2 color;
 
 void main() {
+#ifdef INSTANCED_COLUMNS
+    computeColumnVertex();
+#endif
     gl_Position = MVPMatrix * vertexPosition;
     color = vertexIndexInMatrix / Dimensions;
 }
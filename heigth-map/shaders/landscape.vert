@@ -6,9 +6,11 @@ uniform mat4 MVPMatrix;
 uniform mat4 DepthMVPMatrix;
 uniform vec2 SelectedLandscapeCell;
 
+#ifndef INSTANCED_COLUMNS
 in vec4 vertexPosition;
 in vec3 vertexNormal;
 in vec2 vertexIndexInMatrix;
+#endif
 
 flat out vec4 color;
 out vec3 normal;
@@ -17,6 +19,9 @@ out vec4 position;
 float gl_ClipDistance[1];
 
 void main() {
+#ifdef INSTANCED_COLUMNS
+    computeColumnVertex();
+#endif
     if (vertexIndexInMatrix == SelectedLandscapeCell) {
         color = vec4(1.0, 0.0, 0.0, 1.0);
     } else {
@@ -0,0 +1,11 @@
+#version 130
+uniform sampler2D Texture;
+// 1.0 for depth textures, which are shown in shades of gray
+uniform float Grayscale;
+
+in vec2 textureCoordinates;
+
+void main() {
+    vec4 color = texture2D(Texture, textureCoordinates);
+    gl_FragColor = mix(color, vec4(vec3(color.r), 1.0), Grayscale);
+}
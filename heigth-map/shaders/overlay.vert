@@ -0,0 +1,9 @@
+#version 130
+in vec2 vertexPosition;
+
+out vec2 textureCoordinates;
+
+void main() {
+    textureCoordinates = (vertexPosition + 1.0) * 0.5;
+    gl_Position = vec4(vertexPosition, 0.0, 1.0);
+}
@@ -2,14 +2,19 @@
 uniform mat4 MVPMatrix;
 uniform mat4 DepthMVPMatrix;
 
+#ifndef INSTANCED_COLUMNS
 in vec4 vertexPosition;
 in vec3 vertexNormal;
+#endif
 
 out vec3 position;
 out vec3 normal;
 out vec4 depthViewPosition;
 
 void main() {
+#ifdef INSTANCED_COLUMNS
+    computeColumnVertex();
+#endif
     position = vertexPosition.xyz;
     normal = vertexNormal;
     gl_Position = MVPMatrix * vertexPosition;
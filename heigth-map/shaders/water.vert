@@ -1,14 +1,19 @@
 #version 130
 uniform mat4 MVPMatrix;
 
+#ifndef INSTANCED_COLUMNS
 in vec4 vertexPosition;
 in vec3 vertexNormal;
+#endif
 
 out vec3 position;
 out vec3 normal;
 out vec4 viewPosition;
 
 void main() {
+#ifdef INSTANCED_COLUMNS
+    computeColumnVertex();
+#endif
     position = vertexPosition.xyz;
     normal = vertexNormal;
     viewPosition = MVPMatrix * vertexPosition;
@@ -0,0 +1,158 @@
+import multiprocessing
+import multiprocessing.shared_memory
+import queue
+import time
+
+import numpy as np
+
+import solver
+
+""" Minimal interval between event batches sent by worker """
+BatchInterval = 1/60
+""" Maximal number of steps in one batch, so skipping till end
+    never sends whole solution as one huge message
+"""
+MaxBatchSteps = 10000
+
+
+def run(sharedMemoryName, matrix, events, skipToEnd, stop, stepDelay):
+    ''' Worker process body. Runs solver.Solver over landscape *matrix*,
+        writes water heights into shared memory and sends
+        ('Events', [solver steps]), ('Progress', number of steps)
+        and finally ('Done',) through *events* queue.
+    '''
+    sharedMemory = multiprocessing.shared_memory.SharedMemory(name=sharedMemoryName)
+    heights = np.ndarray(np.shape(matrix), dtype=np.int64, buffer=sharedMemory.buf)
+
+    try:
+        batch = []
+        numberOfSteps = 0
+        timeOfLastBatch = time.time()
+        for step in solver.Solver(matrix).compute():
+            if stop.is_set(): break
+
+            numberOfSteps += 1
+            stepWasMeaningful = True
+            if step[0] == 'Zero':
+                heights[step[1]] = 0
+            elif step[0] == 'Lower height':
+                heights[step[1]] = step[2]
+            elif step[0] != 'Select':
+                stepWasMeaningful = False
+            batch.append(step)
+
+#           While skipping till end batches are still sent on interval,
+#           so window shows progress
+            playing = stepWasMeaningful and not skipToEnd.is_set()
+            if playing or len(batch) >= MaxBatchSteps or time.time() - timeOfLastBatch >= BatchInterval:
+                events.put(('Events', batch))
+                events.put(('Progress', numberOfSteps))
+                batch = []
+                timeOfLastBatch = time.time()
+                if playing:
+#                   Playback speed, skipToEnd wakes us immediately
+                    skipToEnd.wait(stepDelay)
+
+        events.put(('Events', batch))
+        events.put(('Progress', numberOfSteps))
+        events.put(('Done',))
+    finally:
+        del heights
+        sharedMemory.close()
+
+
+""" Runs solver.Solver in separate process, so neither solver
+    speed ties frame rate nor skipping till end freezes window.
+    Water heights are shared through multiprocessing.shared_memory,
+    render loop samples them with *poll*.
+"""
+class SolverProcess(object):
+
+    ''' Pause after every meaningful solver step '''
+    stepDelay = 0.05
+
+    ''' Shared memory with water heights matrix '''
+    sharedMemory = None
+    ''' Numpy view of *sharedMemory* '''
+    heights = None
+
+    ''' Queue of event batches and progress sent by worker '''
+    events = None
+    ''' Set to make worker proceed till end without pauses '''
+    skipToEndEvent = None
+    ''' Set to make worker quit '''
+    stopEvent = None
+
+    process = None
+
+    ''' Number of solver steps done '''
+    numberOfSteps = 0
+    ''' Whether solver has finished '''
+    finished = False
+
+    def __init__(self, matrix, stepDelay=None):
+        if stepDelay is not None: self.stepDelay = stepDelay
+
+        matrix = np.array(matrix, dtype=np.int64)
+        self.sharedMemory = multiprocessing.shared_memory.SharedMemory(create=True, size=max(1, matrix.nbytes))
+        self.heights = np.ndarray(matrix.shape, dtype=np.int64, buffer=self.sharedMemory.buf)
+        self.heights[:] = np.max(matrix) - matrix
+
+#       Forking process with running Qt application is not safe
+        context = multiprocessing.get_context('spawn')
+        self.events = context.Queue()
+        self.skipToEndEvent = context.Event()
+        self.stopEvent = context.Event()
+        self.process = context.Process(target=run, daemon=True,
+                args=(self.sharedMemory.name, matrix.tolist(), self.events,
+                    self.skipToEndEvent, self.stopEvent, self.stepDelay))
+        self.process.start()
+
+    def skipToEnd(self):
+        ''' Makes solver proceed till end without pauses '''
+        self.skipToEndEvent.set()
+
+    def poll(self):
+        ''' Takes all events sent by worker since last call.
+            Returns list of solver steps and copy of current
+            water heights matrix (or None, if nothing changed).
+        '''
+        steps = []
+        if self.process is None: return steps, None
+
+        while not self.finished:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+
+            if event[0] == 'Events':
+                steps.extend(event[1])
+            elif event[0] == 'Progress':
+                self.numberOfSteps = event[1]
+            elif event[0] == 'Done':
+                self.finished = True
+
+        if len(steps) == 0 and not self.finished:
+            return steps, None
+
+        heights = self.heights.tolist()
+        if self.finished:
+            self.close()
+
+        return steps, heights
+
+    def close(self):
+        ''' Stops worker and frees shared memory '''
+        if self.process is None: return
+
+        self.stopEvent.set()
+        self.skipToEndEvent.set()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process = None
+
+        self.heights = None
+        self.sharedMemory.close()
+        self.sharedMemory.unlink()
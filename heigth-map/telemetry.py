@@ -0,0 +1,185 @@
+import collections
+import contextlib
+import csv
+import ctypes
+import json
+import threading
+import time
+
+""" OpenGL constants of ARB_timer_query """
+GL_TIME_ELAPSED = 0x88BF
+GL_QUERY_RESULT = 0x8866
+GL_QUERY_RESULT_AVAILABLE = 0x8867
+
+""" Timer used while telemetry is off """
+NoTimer = contextlib.nullcontext()
+
+
+""" Collects frame time telemetry: GPU time of render passes via
+    GL_TIME_ELAPSED queries and CPU time of arbitrary code blocks.
+    Keeps rolling window of samples and computes percentiles.
+    While disabled timers are no-ops.
+"""
+class Telemetry(object):
+
+    ''' Whether samples are collected '''
+    enabled = False
+
+    ''' Whether context supports timer queries '''
+    gpuTimersSupported = False
+
+    ''' Whether GPU timers run while disabled too, only to sum
+        *lastGpuFrameTime*
+    '''
+    gpuFrameTimed = False
+    ''' GPU seconds of all timed passes of latest frame whose
+        queries are read, None - not known yet
+    '''
+    lastGpuFrameTime = None
+    ''' Dictionary frame -> GPU milliseconds read so far '''
+    gpuFrameTotals = None
+
+    ''' Number of samples kept for every timer '''
+    windowSize = 1000
+
+    ''' Dictionary timer name -> deque of (frame, milliseconds) '''
+    samples = None
+
+    ''' List of (frame, timer name, query id) not read yet '''
+    pendingQueries = None
+    ''' Query ids ready for reuse '''
+    freeQueries = None
+
+    ''' Number of current frame '''
+    frame = 0
+
+    ''' Guards *samples*, CPU timers may run in other threads '''
+    lock = None
+
+    def __init__(self):
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=self.windowSize))
+        self.pendingQueries = []
+        self.freeQueries = []
+        self.gpuFrameTotals = collections.defaultdict(float)
+        self.lock = threading.Lock()
+
+    def record(self, name, milliseconds, frame=None):
+        with self.lock:
+            self.samples[name].append((self.frame if frame is None else frame, milliseconds))
+
+    def startFrame(self, gl):
+        ''' Advances frame counter and reads finished GPU timers '''
+        self.frame += 1
+        if self.gpuTimersSupported and len(self.pendingQueries) > 0:
+            self.collectQueries(gl)
+
+    def cpu(self, name):
+        ''' Measures CPU time of block in milliseconds '''
+        if not self.enabled: return NoTimer
+        return self.cpuTimer(name)
+
+    def gpu(self, gl, name):
+        ''' Measures GPU time of block with timer query. Result is
+            read on later frames, so pipeline isn't stalled.
+        '''
+        if not ((self.enabled or self.gpuFrameTimed) and self.gpuTimersSupported): return NoTimer
+        return self.gpuTimer(gl, name)
+
+    @contextlib.contextmanager
+    def cpuTimer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, 1000 * (time.perf_counter() - start))
+
+    @contextlib.contextmanager
+    def gpuTimer(self, gl, name):
+        if len(self.freeQueries) == 0:
+            query = ctypes.c_uint()
+            gl.glGenQueries(1, ctypes.byref(query))
+            self.freeQueries.append(query.value)
+
+        query = self.freeQueries.pop()
+        gl.glBeginQuery(GL_TIME_ELAPSED, query)
+        try:
+            yield
+        finally:
+            gl.glEndQuery(GL_TIME_ELAPSED)
+            self.pendingQueries.append((self.frame, name, query))
+
+    def collectQueries(self, gl):
+        ''' Reads results of available timer queries '''
+        available = ctypes.c_int()
+        result = ctypes.c_uint64()
+        pending = []
+        for frame, name, query in self.pendingQueries:
+            gl.glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE, ctypes.byref(available))
+            if not available.value:
+                pending.append((frame, name, query))
+                continue
+
+            gl.glGetQueryObjectui64v(query, GL_QUERY_RESULT, ctypes.byref(result))
+            if self.enabled:
+                self.record(name, result.value / 1e6, frame)
+            self.gpuFrameTotals[frame] += result.value / 1e6
+            self.freeQueries.append(query)
+
+        self.pendingQueries = pending
+
+#       Queries of frames before current one are all issued, frame
+#       without pending ones is complete
+        waiting = set(frame for frame, name, query in pending)
+        for frame in sorted(self.gpuFrameTotals):
+            if frame not in waiting:
+                self.lastGpuFrameTime = self.gpuFrameTotals.pop(frame) / 1000
+
+    def percentiles(self, name, ps=(50, 95, 99)):
+        ''' Returns list of *ps* percentiles of timer *name* '''
+        with self.lock:
+            values = sorted(ms for frame, ms in self.samples.get(name, []))
+        if len(values) == 0: return [0.0] * len(ps)
+
+        return [values[min(len(values) - 1, int(len(values) * p / 100))] for p in ps]
+
+    def summary(self):
+        ''' Returns dictionary timer name -> {'p50', 'p95', 'p99', 'count'} '''
+        with self.lock:
+            names = sorted(self.samples)
+
+        summary = {}
+        for name in names:
+            p50, p95, p99 = self.percentiles(name)
+            summary[name] = {'p50': p50, 'p95': p95, 'p99': p99, 'count': len(self.samples[name])}
+        return summary
+
+    def hudLines(self):
+        ''' Lines of on-screen telemetry '''
+        lines = ['{:<24} {:>7} {:>7} {:>7}'.format('ms', 'p50', 'p95', 'p99')]
+        for name, stats in self.summary().items():
+            lines.append('{:<24} {:>7.2f} {:>7.2f} {:>7.2f}'.format(name, stats['p50'], stats['p95'], stats['p99']))
+        if not self.gpuTimersSupported:
+            lines.append('(no GPU timer queries)')
+        return lines
+
+    def export(self, filename):
+        ''' Saves samples to *filename*, format is chosen
+            by extension: .csv or .json
+        '''
+        with self.lock:
+            samples = {name: list(values) for name, values in self.samples.items()}
+
+        if filename.endswith('.json'):
+            with open(filename, 'w') as f:
+                json.dump({
+                    'summary': self.summary(),
+                    'samples': {name: [{'frame': frame, 'ms': ms} for frame, ms in values]
+                                    for name, values in samples.items()}
+                    }, f, indent=2)
+        else:
+            with open(filename, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['frame', 'timer', 'ms'])
+                for name, values in sorted(samples.items()):
+                    for frame, ms in values:
+                        writer.writerow([frame, name, ms])